@@ -0,0 +1,280 @@
+"""
+Benchmark the login flow against a token table of realistic size.
+
+Run from the src directory:
+
+    python -m benchmarks.run --rows 10000 1000000 --output bench.json
+
+For each size the database is flushed and seeded by the stagedoor_seed command
+with that many live tokens, spread over as many contacts, half email addresses
+and half phone numbers, before each step of the login flow is timed. Email and
+SMS delivery use the in-memory backends. The results are written as JSON, so
+runs can be diffed between releases.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from collections.abc import Callable
+from datetime import timedelta
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from stagedoor.models import AuthToken
+
+DEFAULT_ROWS = [10_000]
+SEED_BATCH_SIZE = 10_000
+
+
+def seed_token(token_string: str, **contact: Any) -> "AuthToken":
+    """An unsaved token stored the way generate_token() stores it."""
+    from stagedoor.models import AuthToken
+
+    token = AuthToken(**contact)
+    token.set_token(token_string)
+    token.set_expiry()
+    return token
+
+
+def seed(rows: int) -> None:
+    """Insert rows live tokens, half for email addresses and half for phone numbers.
+
+    The stagedoor_seed command generates the contacts and token strings, so
+    the benchmark table looks like the ones seeded for load tests.
+    """
+    from django.core.management import call_command
+
+    call_command(
+        "stagedoor_seed",
+        emails=rows - rows // 2,
+        phone_numbers=rows // 2,
+        tokens=rows,
+        user_ratio=0,
+        stale_ratio=0,
+        approval_ratio=1,
+        batch_size=SEED_BATCH_SIZE,
+        stdout=io.StringIO(),
+    )
+
+
+def summarize(durations: list[float]) -> dict[str, float | int]:
+    """Throughput and latency percentiles, in milliseconds, for timed calls."""
+    ordered = sorted(durations)
+    if len(ordered) > 1:
+        cuts = statistics.quantiles(ordered, n=100, method="inclusive")
+    else:
+        cuts = ordered * 99
+    total = sum(ordered)
+    return {
+        "iterations": len(ordered),
+        "ops_per_sec": round(len(ordered) / total, 2) if total else 0,
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "min_ms": round(ordered[0] * 1000, 3),
+        "p50_ms": round(cuts[49] * 1000, 3),
+        "p90_ms": round(cuts[89] * 1000, 3),
+        "p99_ms": round(cuts[98] * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def timed(
+    call: Callable[[int], Any],
+    iterations: int,
+    prepare: Callable[[int], Any] | None = None,
+) -> dict[str, float | int]:
+    """Time call(i) for each iteration, running prepare(i) untimed before it."""
+    durations = []
+    for i in range(iterations):
+        if prepare:
+            prepare(i)
+        started = time.perf_counter()
+        call(i)
+        durations.append(time.perf_counter() - started)
+    return summarize(durations)
+
+
+def make_request(method: str = "post", path: str = "/", data=None):
+    from django.contrib.auth.models import AnonymousUser
+    from django.contrib.messages.storage.fallback import FallbackStorage
+    from django.contrib.sessions.backends.db import SessionStore
+    from django.test import RequestFactory
+
+    request = getattr(RequestFactory(), method)(path, data or {})
+    request.user = AnonymousUser()
+    request.session = SessionStore()
+    request._messages = FallbackStorage(request)
+    return request
+
+
+def run(rows: int, iterations: int) -> dict[str, dict[str, float | int]]:
+    """Time each step of the login flow against the seeded table."""
+    from django.contrib.admin.sites import site
+    from django.core import mail
+    from django.utils.timezone import now
+
+    from stagedoor import sms
+    from stagedoor.admin import AuthTokenAdmin
+    from stagedoor.management.commands.stagedoor_seed import (
+        seed_email,
+        seed_phone_number,
+    )
+    from stagedoor.models import AuthToken, Email, generate_token
+    from stagedoor.views import login_post, token_login, token_post
+
+    def seeded_email(i: int) -> str:
+        return seed_email(i % max(rows - rows // 2, 1))
+
+    def seeded_phone(i: int) -> str:
+        return seed_phone_number(i % max(rows // 2, 1))
+
+    results = {}
+    results["generate_token_email"] = timed(
+        lambda i: generate_token(email=seeded_email(i)), iterations
+    )
+    results["generate_token_sms"] = timed(
+        lambda i: generate_token(phone_number=seeded_phone(i)), iterations
+    )
+    results["login_post_email"] = timed(
+        lambda i: login_post(make_request(data={"email": seeded_email(i)})),
+        iterations,
+    )
+    results["login_post_sms"] = timed(
+        lambda i: login_post(make_request(data={"phone_number": seeded_phone(i)})),
+        iterations,
+    )
+
+    email_tokens = [
+        generate_token(email=seeded_email(i)).login_token  # type: ignore[union-attr]
+        for i in range(iterations)
+    ]
+    results["token_login_email"] = timed(
+        lambda i: token_login(make_request("get"), email_tokens[i]), iterations
+    )
+    sms_tokens = [
+        generate_token(phone_number=seeded_phone(i)).login_token  # type: ignore[union-attr]
+        for i in range(iterations)
+    ]
+    results["token_post_sms"] = timed(
+        lambda i: token_post(make_request(data={"token": sms_tokens[i]})),
+        iterations,
+    )
+    results["token_login_invalid"] = timed(
+        lambda i: token_login(make_request("get"), f"invalid{i}"), iterations
+    )
+
+    def add_stale_tokens(i: int) -> None:
+        email = Email.objects.get(email=seeded_email(i))
+        stale = AuthToken.objects.bulk_create(
+            seed_token(f"stale{i}-{n}", email=email) for n in range(100)
+        )
+        AuthToken.objects.filter(pk__in=[token.pk for token in stale]).update(
+            expires_at=now() - timedelta(minutes=1)
+        )
+
+    results["delete_stale_100"] = timed(
+        lambda i: AuthToken.delete_stale(), iterations, prepare=add_stale_tokens
+    )
+
+    admin = AuthTokenAdmin(AuthToken, site)
+    pending: list[int] = []
+
+    def add_pending_tokens(i: int) -> None:
+        pending[:] = []
+        for n in range(50):
+            contact = seeded_email(i * 50 + n) if n % 2 == 0 else None
+            token = generate_token(
+                email=contact,
+                phone_number=None if contact else seeded_phone(i * 50 + n),
+            )
+            token.approved = False  # type: ignore[union-attr]
+            token.save()  # type: ignore[union-attr]
+            pending.append(token.pk)  # type: ignore[union-attr]
+
+    results["approve_tokens_50"] = timed(
+        lambda i: admin.approve_tokens(
+            make_request(), AuthToken.objects.filter(pk__in=pending)
+        ),
+        max(iterations // 10, 1),
+        prepare=add_pending_tokens,
+    )
+
+    mail.outbox = []
+    sms.outbox.clear()
+    return results
+
+
+def benchmark(rows_list: list[int], iterations: int) -> dict[str, Any]:
+    """Seed and time each table size in turn."""
+    import django
+    from django.core.management import call_command
+    from django.db import connection
+
+    runs = []
+    for rows in rows_list:
+        call_command("flush", interactive=False, verbosity=0)
+        started = time.perf_counter()
+        seed(rows)
+        seed_seconds = time.perf_counter() - started
+        runs.append(
+            {
+                "rows": rows,
+                "seed_seconds": round(seed_seconds, 2),
+                "results": run(rows, iterations),
+            }
+        )
+    return {
+        "meta": {
+            "database": connection.vendor,
+            "django": django.get_version(),
+            "python": platform.python_version(),
+            "iterations": iterations,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "runs": runs,
+    }
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument(
+        "--rows",
+        type=int,
+        nargs="+",
+        default=DEFAULT_ROWS,
+        help="Token table sizes to benchmark, e.g. 10000 1000000 10000000.",
+    )
+    parser.add_argument(
+        "--iterations", type=int, default=200, help="Timed calls per step."
+    )
+    parser.add_argument(
+        "--database",
+        choices=["sqlite", "postgresql"],
+        default="sqlite",
+        help="PostgreSQL is configured from the PG* environment variables.",
+    )
+    parser.add_argument("--output", help="Write the JSON here instead of stdout.")
+    args = parser.parse_args(argv)
+
+    os.environ["STAGEDOOR_BENCH_DATABASE"] = args.database
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+    import django
+    from django.core.management import call_command
+
+    django.setup()
+    call_command("migrate", interactive=False, verbosity=0)
+
+    report = json.dumps(benchmark(args.rows, args.iterations), indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report + "\n")
+    else:
+        sys.stdout.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
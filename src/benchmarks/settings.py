@@ -0,0 +1,42 @@
+"""
+Benchmark settings for django-stagedoor.
+
+STAGEDOOR_BENCH_DATABASE picks "sqlite" (the default, a file named by
+STAGEDOOR_BENCH_SQLITE_PATH) or "postgresql", configured from the usual PG*
+environment variables.
+"""
+
+import os
+import tempfile
+
+from tests.settings import *  # noqa: F403
+
+DEBUG = False
+
+if os.environ.get("STAGEDOOR_BENCH_DATABASE") == "postgresql":
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": os.environ.get("PGDATABASE", "stagedoor_bench"),
+            "USER": os.environ.get("PGUSER", ""),
+            "PASSWORD": os.environ.get("PGPASSWORD", ""),
+            "HOST": os.environ.get("PGHOST", ""),
+            "PORT": os.environ.get("PGPORT", ""),
+        }
+    }
+else:
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": os.environ.get(
+                "STAGEDOOR_BENCH_SQLITE_PATH",
+                os.path.join(tempfile.gettempdir(), "stagedoor_bench.sqlite3"),
+            ),
+        }
+    }
+
+# Use the real migrations, so the benchmark sees the production indexes.
+MIGRATION_MODULES = {}  # type: ignore[assignment]
+
+EMAIL_BACKEND = "django.core.mail.backends.locmem.EmailBackend"
+STAGEDOOR_SMS_TRANSPORT = "stagedoor.sms.LocmemTransport"
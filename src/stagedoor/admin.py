@@ -1,40 +1,136 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import QuerySet
+from django.utils.functional import cached_property
+from django.utils.timezone import now
 
-from stagedoor.helpers import email_login_link, sms_login_link
+from stagedoor import settings as stagedoor_settings
+from stagedoor.helpers import approve_and_send
 
-from .models import AuthToken, Email, PhoneNumber
+from .models import TOKEN_RELATED, AuthToken, Email, PhoneNumber
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that estimates the size of large unfiltered tables.
+
+    On PostgreSQL an unfiltered changelist takes its count from the planner's
+    statistics in pg_class instead of running COUNT(*). Tables estimated at
+    fewer than exact_below rows, filtered lists and other databases are
+    counted exactly.
+    """
+
+    exact_below = 100_000
+
+    @cached_property
+    def count(self) -> int:
+        estimate = self.estimated_count()
+        if estimate is not None and estimate >= self.exact_below:
+            return estimate
+        return super().count
+
+    def estimated_count(self) -> int | None:
+        queryset = self.object_list
+        if not isinstance(queryset, QuerySet):
+            return None
+        if queryset.query.where or queryset.query.distinct:
+            return None
+        connection = connections[queryset.db]
+        if connection.vendor != "postgresql":
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)",
+                [queryset.model._meta.db_table],
+            )
+            row = cursor.fetchone()
+        # reltuples is -1 for a table that has never been analyzed.
+        return row[0] if row and row[0] >= 0 else None
+
+
+class ExpiryFilter(admin.SimpleListFilter):
+    """Split tokens on expires_at, so each choice is a range on its index."""
+
+    title = "expiry"
+    parameter_name = "expiry"
+
+    def lookups(self, request, model_admin):
+        return [("live", "Not expired"), ("expired", "Expired")]
+
+    def queryset(self, request, queryset):
+        if self.value() == "live":
+            return queryset.filter(expires_at__gt=now())
+        if self.value() == "expired":
+            return queryset.filter(expires_at__lte=now())
+        return queryset
+
+
+class ContactAdmin(admin.ModelAdmin):
+    # Users are picked by id, so the forms don't render the whole user table.
+    list_select_related = ("user", "potential_user")
+    raw_id_fields = ("user", "potential_user")
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 @admin.register(Email)
-class EmailAdmin(admin.ModelAdmin):
+class EmailAdmin(ContactAdmin):
     list_display = ("email", "user", "potential_user")
+    # Prefix matches can use the unique index on PostgreSQL.
+    search_fields = ("email__startswith",)
 
 
 @admin.register(PhoneNumber)
-class PhoneNumberAdmin(admin.ModelAdmin):
+class PhoneNumberAdmin(ContactAdmin):
     list_display = ("phone_number", "user", "potential_user")
+    search_fields = ("phone_number__startswith",)
 
 
 @admin.register(AuthToken)
 class AuthTokenAdmin(admin.ModelAdmin):
-    list_display = ["email", "phone_number", "approved", "timestamp", "next_url"]
+    list_display = [
+        "email",
+        "phone_number",
+        "approved",
+        "timestamp",
+        "expires_at",
+        "next_url",
+    ]
+    # The contacts' __str__ shows their users, so join those as well.
+    list_select_related = TOKEN_RELATED
+    raw_id_fields = ("email", "phone_number")
+    # "No" lists the tokens waiting for approval, from the partial index.
+    list_filter = ("approved", ExpiryFilter)
+    search_fields = (
+        "email__email__startswith",
+        "phone_number__phone_number__startswith",
+    )
     ordering = ["-timestamp"]
     actions = ["approve_tokens"]
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
     @admin.action(description="Approve selected accounts.")
     def approve_tokens(self, request, queryset):
-        """Admin action to approve selected accounts."""
-        approved_count = 0
-
-        for token in queryset:
-            token.approved = True
-            token.save()
-            if token.email:
-                email_login_link(request=request, token=token)
-            if token.phone_number:
-                sms_login_link(request=request, token=token)
-            approved_count += 1
-
-        self.message_user(
-            request, f"Successfully approved and sent {approved_count} searches."
-        )
+        """Admin action to approve selected accounts.
+
+        The selection is approved by the token store, with a single UPDATE for
+        the database store. Login emails are then sent in chunks of
+        STAGEDOOR_EMAIL_BATCH_SIZE over one mail connection, or queued for the
+        stagedoor_deliver worker with STAGEDOOR_ASYNC_DELIVERY.
+        """
+        tokens = list(queryset.select_related("email", "phone_number"))
+        sent, errors = approve_and_send(request, tokens)
+        for error in errors:
+            self.message_user(request, error, messages.ERROR)
+
+        if stagedoor_settings.ASYNC_DELIVERY:
+            self.message_user(
+                request,
+                f"Successfully approved {sent} searches and queued their "
+                "login messages.",
+            )
+        else:
+            self.message_user(
+                request, f"Successfully approved and sent {sent} searches."
+            )
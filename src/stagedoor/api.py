@@ -0,0 +1,223 @@
+"""
+JSON endpoints for apps that drive the login flow themselves.
+
+Include ``stagedoor.api_urls`` to use them. Requests and responses are JSON,
+nothing is flashed with ``messages``, and the session is only written when a
+login succeeds. The POST endpoints only accept ``application/json`` bodies,
+which browsers won't send cross-site without a CORS preflight.
+
+``request_code`` and ``verify_code`` are exempt from CSRF checks: they are
+called before there is a session, often by clients that keep no cookies and so
+have no CSRF token to send, and neither acts with the session's user.
+``approve_pending`` acts as the logged-in staff user, so it needs the CSRF
+token in the ``X-CSRFToken`` header like any other session-authenticated POST.
+"""
+
+import json
+from typing import Any
+
+from django.contrib.auth import authenticate
+from django.contrib.auth import login as django_login
+from django.http import HttpRequest, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+
+from . import settings as stagedoor_settings
+from .helpers import (
+    approve_and_send,
+    email_admin_approval,
+    email_login_link,
+    sms_login_link,
+)
+from .models import TOKEN_RELATED, AuthToken
+from .ratelimit import (
+    login_allowed,
+    token_attempt_allowed,
+    token_attempt_failed,
+    token_attempt_succeeded,
+)
+from .views import LoginForm, issue_token
+
+PENDING_PAGE_SIZE = 50
+PENDING_MAX_PAGE_SIZE = 500
+
+
+def json_response(data: dict[str, Any], status: int = 200) -> JsonResponse:
+    return JsonResponse(
+        data, status=status, json_dumps_params={"separators": (",", ":")}
+    )
+
+
+def error_response(error: str, status: int) -> JsonResponse:
+    return json_response({"error": error}, status=status)
+
+
+def json_body(request: HttpRequest) -> dict[str, Any] | None:
+    """The request's JSON object body, or None if it isn't one."""
+    if request.content_type != "application/json":
+        return None
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def request_code(request: HttpRequest) -> JsonResponse:
+    """Send a login code to the email address or phone number posted.
+
+    Takes ``{"contact": ...}`` (or ``email`` / ``phone_number``) and an
+    optional ``next`` URL.
+    """
+    data = json_body(request)
+    if data is None:
+        return error_response("invalid_json", 400)
+    form = LoginForm(data)
+    if not form.is_valid():
+        return error_response("invalid_contact", 400)
+
+    email = form.cleaned_data["email"]
+    phone_number = form.cleaned_data["phone_number"]
+    if not login_allowed(request, str(email or phone_number)):
+        return error_response("rate_limited", 429)
+
+    next_url = data.get("next") or ""
+    if email:
+        contact, channel = {"email": email}, "email"
+    else:
+        contact, channel = {"phone_number": phone_number}, "sms"
+    token, pending = issue_token(request, next_url=str(next_url), **contact)
+    if not token:
+        return error_response("contact_taken", 409)
+    if pending:
+        email_admin_approval(request=request, token=token)
+        return json_response({"status": "approval_needed"}, status=202)
+
+    if not stagedoor_settings.ASYNC_DELIVERY:
+        if email:
+            email_login_link(request=request, token=token)
+        else:
+            sms_login_link(request=request, token=token)
+    return json_response({"status": "sent", "channel": channel}, status=202)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def verify_code(request: HttpRequest) -> JsonResponse:
+    """Log in with a code.
+
+    Takes ``{"token": ...}`` and, for SMS codes, ``phone_number``.
+    """
+    data = json_body(request)
+    if data is None:
+        return error_response("invalid_json", 400)
+    token = data.get("token")
+    phone_number = data.get("phone_number")
+    if not token or not isinstance(token, str):
+        return error_response("invalid_token", 400)
+    if phone_number is not None and not isinstance(phone_number, str):
+        return error_response("invalid_contact", 400)
+
+    if not token_attempt_allowed(request, phone_number):
+        return error_response("locked_out", 429)
+
+    credentials = {"token": token}
+    if phone_number:
+        credentials["phone_number"] = phone_number
+    user = authenticate(request, **credentials)
+    if user is None:
+        token_attempt_failed(request, phone_number)
+        return error_response("invalid_token", 401)
+
+    token_attempt_succeeded(request, phone_number)
+    next_url = getattr(user, "_stagedoor_next_url", None)
+    if next_url is not None:
+        del user._stagedoor_next_url  # type: ignore
+    else:
+        next_url = stagedoor_settings.LOGIN_REDIRECT
+
+    if not request.user.is_authenticated:
+        django_login(request, user)
+    return json_response({"status": "ok", "user": user.pk, "next": next_url})
+
+
+@require_http_methods(["GET"])
+def status(request: HttpRequest) -> JsonResponse:
+    """Whether this session is logged in, and as whom."""
+    user = request.user
+    return json_response(
+        {
+            "authenticated": user.is_authenticated,
+            "user": user.pk if user.is_authenticated else None,
+        }
+    )
+
+
+def staff_allowed(request: HttpRequest, permission: str) -> bool:
+    user = request.user
+    return bool(user.is_active and user.is_staff and user.has_perm(permission))  # type: ignore[attr-defined]
+
+
+@require_http_methods(["GET"])
+def pending(request: HttpRequest) -> JsonResponse:
+    """Tokens waiting for approval, for staff with the view permission.
+
+    Takes ``after``, the ``next`` of the previous page, and ``limit``. Pages
+    are found through the pending index, however long the table is.
+    """
+    if not staff_allowed(request, "stagedoor.view_authtoken"):
+        return error_response("forbidden", 403)
+    try:
+        after = int(request.GET.get("after", 0))
+        limit = int(request.GET.get("limit", PENDING_PAGE_SIZE))
+    except ValueError:
+        return error_response("invalid_page", 400)
+    if not 0 < limit <= PENDING_MAX_PAGE_SIZE:
+        return error_response("invalid_page", 400)
+
+    tokens = list(
+        AuthToken.objects.pending()
+        .filter(pk__gt=after)
+        .select_related(*TOKEN_RELATED)[:limit]
+    )
+    results = [
+        {
+            "id": token.pk,
+            "email": token.email.email if token.email else None,
+            "phone_number": token.phone_number.phone_number.as_e164  # type: ignore[union-attr]
+            if token.phone_number
+            else None,
+            "next_url": token.next_url,
+            "requested": token.timestamp.isoformat(),
+        }
+        for token in tokens
+    ]
+    next_page = tokens[-1].pk if len(tokens) == limit else None
+    return json_response({"results": results, "next": next_page})
+
+
+@require_http_methods(["POST"])
+def approve_pending(request: HttpRequest) -> JsonResponse:
+    """Approve tokens and send their login messages, for staff who may change them.
+
+    Takes ``{"ids": [...]}``. Ids of tokens that are no longer pending are
+    ignored.
+    """
+    if not staff_allowed(request, "stagedoor.change_authtoken"):
+        return error_response("forbidden", 403)
+    data = json_body(request)
+    if data is None:
+        return error_response("invalid_json", 400)
+    ids = data.get("ids")
+    if not isinstance(ids, list) or not all(
+        isinstance(pk, int) and not isinstance(pk, bool) for pk in ids
+    ):
+        return error_response("invalid_ids", 400)
+
+    tokens = list(
+        AuthToken.objects.pending().filter(pk__in=ids).select_related(*TOKEN_RELATED)
+    )
+    sent, errors = approve_and_send(request, tokens)
+    return json_response({"approved": len(tokens), "sent": sent, "errors": errors})
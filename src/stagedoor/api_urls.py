@@ -0,0 +1,12 @@
+from django.urls import path
+
+from . import api
+
+app_name = "stagedoor-api"
+urlpatterns = [
+    path("login", api.request_code, name="login"),  # type: ignore
+    path("token", api.verify_code, name="token"),  # type: ignore
+    path("status", api.status, name="status"),  # type: ignore
+    path("pending", api.pending, name="pending"),  # type: ignore
+    path("pending/approve", api.approve_pending, name="approve-pending"),  # type: ignore
+]
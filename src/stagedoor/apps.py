@@ -1,5 +1,14 @@
 from django.apps import AppConfig
+from django.core.signals import setting_changed
 
 
 class StagedoorConfig(AppConfig):
     name = "stagedoor"
+
+    def ready(self):
+        from .helpers import clear_email_templates
+        from .users import clear_user_model_fields, user_model_fields
+
+        setting_changed.connect(clear_email_templates)
+        setting_changed.connect(clear_user_model_fields)
+        user_model_fields()
@@ -0,0 +1,12 @@
+from django.urls import path
+
+from . import async_views
+
+app_name = "stagedoor"
+urlpatterns = [
+    path("login", async_views.login_post, name="login"),  # type: ignore
+    path("login/<str:token>", async_views.token_login, name="token-login"),  # type: ignore
+    path("logout", async_views.logout, name="logout"),  # type: ignore
+    path("token", async_views.token_post, name="token-post"),  # type: ignore
+    path("approval-needed", async_views.approval_needed, name="approval-needed"),  # type: ignore
+]
@@ -0,0 +1,164 @@
+"""
+Async versions of the stagedoor views, for projects served over ASGI.
+
+Include ``stagedoor.async_urls`` instead of ``stagedoor.urls`` to use them.
+Token checks go through the backends' aauthenticate() and the async ORM, so a
+login doesn't tie up a worker thread. Creating a token still runs in one,
+since it needs a transaction. Requires Django 5.1 or later.
+"""
+
+from urllib.parse import parse_qs, urlparse
+
+from asgiref.sync import sync_to_async
+from django.contrib import messages
+from django.contrib.auth import aauthenticate, alogin, alogout
+from django.contrib.auth.views import redirect_to_login
+from django.http import HttpRequest, HttpResponse
+from django.shortcuts import redirect, render
+from django.urls import reverse
+from django.utils.translation import gettext_lazy as _
+from django.views.decorators.http import require_http_methods
+
+from . import settings as stagedoor_settings
+from .helpers import aemail_login_link, asms_login_link, email_admin_approval
+from .ratelimit import (
+    alogin_allowed,
+    atoken_attempt_allowed,
+    atoken_attempt_failed,
+    atoken_attempt_succeeded,
+)
+from .views import PHONE_NUMBER_SESSION_KEY, LoginForm, issue_token
+
+
+@require_http_methods(["POST"])
+async def login_post(request: HttpRequest) -> HttpResponse:
+    """Process the submission of the form with the user's email and mail them a link."""
+    form = LoginForm(request.POST)
+    if not form.is_valid():
+        messages.error(
+            request,
+            _("Please use a valid email address or phone number."),
+        )
+        return redirect(stagedoor_settings.LOGIN_URL)
+
+    email = form.cleaned_data["email"]
+    phone_number = form.cleaned_data["phone_number"]
+    if not email and not phone_number:
+        return redirect(stagedoor_settings.LOGIN_URL)
+
+    if not await alogin_allowed(request, str(email or phone_number)):
+        messages.error(
+            request,
+            _("Too many login attempts. Please wait a few minutes and try again."),
+        )
+        return redirect(stagedoor_settings.LOGIN_URL)
+
+    next_url: str | None = ""
+    if parsed_next_url := parse_qs(urlparse(request.get_full_path()).query).get("next"):
+        next_url = parsed_next_url[0]
+
+    if email:
+        contact = {"email": email}
+    else:
+        contact = {"phone_number": phone_number}
+    token, pending = await sync_to_async(issue_token)(
+        request, next_url=next_url, **contact
+    )
+    if not token:
+        if email:
+            messages.error(request, _("A user with that email already exists."))
+        else:
+            messages.error(request, _("A user with that phone number already exists."))
+        return redirect(stagedoor_settings.LOGIN_URL)
+    if pending:
+        await sync_to_async(email_admin_approval)(request=request, token=token)
+        return redirect(reverse("stagedoor:approval-needed"))
+
+    if email:
+        if not stagedoor_settings.ASYNC_DELIVERY:
+            await aemail_login_link(request=request, token=token)
+        if stagedoor_settings.SMS_CODE_REQUIRES_CONTACT:
+            await request.session.apop(PHONE_NUMBER_SESSION_KEY, None)
+        messages.success(request, _("Check your email to log in!"))
+    else:
+        if not stagedoor_settings.ASYNC_DELIVERY:
+            await asms_login_link(request=request, token=token)
+        if stagedoor_settings.SMS_CODE_REQUIRES_CONTACT:
+            # Prefill the number on the code entry page.
+            await request.session.aset(PHONE_NUMBER_SESSION_KEY, str(phone_number))
+        messages.success(request, _("Check your text messages to log in!"))
+    return redirect(reverse("stagedoor:token-post"))
+
+
+async def process_token(
+    request: HttpRequest, token: str | None, phone_number: str | None = None
+) -> HttpResponse:
+    if not await atoken_attempt_allowed(request, phone_number):
+        messages.error(
+            request,
+            _("Too many failed login attempts. Please wait a while and try again."),
+        )
+        return redirect(stagedoor_settings.LOGIN_URL)
+
+    credentials = {"token": token}
+    if phone_number:
+        credentials["phone_number"] = phone_number
+    user = await aauthenticate(request, **credentials)
+    if user is None:
+        await atoken_attempt_failed(request, phone_number)
+        messages.error(
+            request,
+            _(
+                "The login link is invalid or has expired, or you are not allowed to "
+                "log in. Please try again."
+            ),
+        )
+        return redirect(stagedoor_settings.LOGIN_URL)
+
+    await atoken_attempt_succeeded(request, phone_number)
+    next_url = getattr(user, "_stagedoor_next_url", None)
+    if next_url is not None:
+        # Remove the next URL from the user object.
+        del user._stagedoor_next_url  # type: ignore
+    else:
+        next_url = stagedoor_settings.LOGIN_REDIRECT
+
+    if not (await request.auser()).is_authenticated:
+        await alogin(request, user)
+    messages.success(request, _("Login successful."))
+    return redirect(next_url)
+
+
+async def token_post(request: HttpRequest) -> HttpResponse:
+    phone_number = request.POST.get("phone_number")
+    if not phone_number and stagedoor_settings.SMS_CODE_REQUIRES_CONTACT:
+        phone_number = await request.session.aget(PHONE_NUMBER_SESSION_KEY)
+    if request.POST:
+        token = request.POST.get("token")
+        return await process_token(request, token, phone_number=phone_number)
+    return render(
+        request,
+        template_name="stagedoor_token_input.html",
+        context={
+            "require_phone_number": stagedoor_settings.SMS_CODE_REQUIRES_CONTACT,
+            "phone_number": phone_number or "",
+        },
+    )
+
+
+@require_http_methods(["GET"])
+async def token_login(request: HttpRequest, token: str) -> HttpResponse:
+    """Validate the token the user submitted."""
+    return await process_token(request, token)
+
+
+async def logout(request: HttpRequest) -> HttpResponse:
+    if not (await request.auser()).is_authenticated:
+        return redirect_to_login(request.get_full_path())
+    await alogout(request)
+    messages.success(request, _("You have been logged out."))
+    return redirect(stagedoor_settings.LOGOUT_REDIRECT)
+
+
+async def approval_needed(request: HttpRequest) -> HttpResponse:
+    return render(request, template_name="stagedoor_approval_needed.html")
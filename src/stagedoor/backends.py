@@ -1,15 +1,26 @@
+import time
 from typing import Any
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import BaseBackend
 from django.contrib.auth.models import AbstractBaseUser
+from django.db import transaction
 from django.http import HttpRequest
+from django.utils.module_loading import import_string
+from phonenumber_field.phonenumber import to_python
 
+from . import metrics, signals
 from . import settings as stagedoor_settings
-from .models import AuthToken, Email, generate_token_string
+from .models import AuthToken, Email, PhoneNumber, generate_token_string
+from .stores import get_token_store
+from .users import user_model_fields
 
 
 class StageDoorBackend(BaseBackend):
+    # "email" or "sms" to only accept tokens issued for that channel.
+    channel: str | None = None
+
     def get_user(self, user_id: int | str) -> AbstractBaseUser | None:
         """Get a user by their primary key."""
         User = get_user_model()
@@ -18,126 +29,501 @@ class StageDoorBackend(BaseBackend):
         except User.DoesNotExist:
             return None
 
-    def get_token_object(self, token: str | int) -> AuthToken | None:
-        """Get token object by token string."""
-        AuthToken.delete_stale()
-        return AuthToken.objects.filter(token=token).first()
+    async def aget_user(self, user_id: int | str) -> AbstractBaseUser | None:
+        """Async version of get_user()."""
+        User = get_user_model()
+        try:
+            return await User.objects.aget(pk=user_id)
+        except User.DoesNotExist:
+            return None
 
-    def authenticate(
-        self, request: HttpRequest | None, **kwargs: Any
-    ) -> AbstractBaseUser | None:
-        """Authenticate a user given a token"""
-        token = kwargs.get("token")
-        user = None
-        AuthToken.delete_stale()
+    def _token_query(
+        self, phone_number: str | None
+    ) -> tuple[str | None, str | None] | None:
+        """The channel and phone number to look a token up by.
 
-        token_object: AuthToken | None = AuthToken.objects.filter(token=token).first()
-        if not token_object:
-            return None
+        Returns None when no token could match, so the lookup can be skipped.
+        """
+        channel = self.channel
+        if phone_number:
+            parsed = to_python(phone_number)
+            if channel == "email" or not parsed or not parsed.is_valid():
+                return None
+            return channel, parsed.as_e164
+        if stagedoor_settings.SMS_CODE_REQUIRES_CONTACT:
+            if channel == "sms":
+                return None
+            return "email", None
+        return channel, None
 
-        if stagedoor_settings.SINGLE_USE_LINK:
-            token_object.delete()
+    def get_token_object(
+        self, token: str | int, phone_number: str | None = None
+    ) -> AuthToken | None:
+        """Get token object by token string.
 
-        User = get_user_model()
+        SMS codes are only matched when phone_number is given, if
+        STAGEDOOR_SMS_CODE_REQUIRES_CONTACT is set. With
+        STAGEDOOR_SINGLE_USE_LINK the token is deleted as it is fetched, so it
+        can only ever be handed out once.
+        """
+        return self.find_token(token, phone_number)[0]
 
-        user_args = {}
+    async def aget_token_object(
+        self, token: str | int, phone_number: str | None = None
+    ) -> AuthToken | None:
+        """Async version of get_token_object()."""
+        return (await self.afind_token(token, phone_number))[0]
 
-        if token_object.email and token_object.email.user:  # type: ignore[attr-defined]
-            user = token_object.email.user  # type: ignore[attr-defined]
-        if token_object.phone_number and token_object.phone_number.user:  # type: ignore[attr-defined]
-            user = token_object.phone_number.user  # type: ignore[attr-defined]
+    def find_token(
+        self, token: str | int, phone_number: str | None = None
+    ) -> tuple[AuthToken | None, str | None]:
+        """The live token for a token string, or None and why there is none.
 
-        if not user and not stagedoor_settings.DISABLE_USER_CREATION:
-            if "username" in [
-                field.name for field in User._meta.get_fields(include_hidden=True)
-            ]:
-                user_args["username"] = f"u{generate_token_string()[:8]}"
-            if token_object.email and "email" in [
-                field.name for field in User._meta.get_fields(include_hidden=True)
-            ]:
-                user_args["email"] = token_object.email.email  # type: ignore[attr-defined]
-            if token_object.phone_number and "phone_number" in [
-                field.name for field in User._meta.get_fields(include_hidden=True)
-            ]:
-                user_args["phone_number"] = token_object.phone_number.phone_number  # type: ignore[attr-defined]
-
-            user, _ = User.objects.get_or_create(**user_args)  # type: ignore[arg-type]
-
-        if token_object.next_url:
-            user._stagedoor_next_url = token_object.next_url  # type: ignore
+        The reason is one of signals.REJECTION_REASONS, worked out from the
+        rows the lookup fetched anyway. Consuming a single-use token and
+        checking a signed link only tell whether it worked, so their
+        failures are "unknown".
+        """
+        if stagedoor_settings.SIGNED_LINKS and ":" in str(token):
+            # Signed links are validated without touching the token table.
+            if self.channel == "sms":
+                return None, signals.REJECTED_UNKNOWN
+            return self._found(AuthToken.from_signed(str(token)))
 
-        return user
+        query = self._token_query(phone_number)
+        if not query:
+            return None, signals.REJECTED_UNKNOWN
+        channel, phone_number = query
+
+        store = get_token_store()
+        if stagedoor_settings.SINGLE_USE_LINK:
+            found = self._found(store.consume(token, channel, phone_number))
+        else:
+            found = self._classify(store.find(token, channel, phone_number))
+        if stagedoor_settings.PURGE_ON_LOOKUP:
+            # After the lookup, so an expired token is still there to report.
+            # One batch at most; a backlog is left to stagedoor_purge.
+            store.purge(max_batches=1)
+        return found
 
+    async def afind_token(
+        self, token: str | int, phone_number: str | None = None
+    ) -> tuple[AuthToken | None, str | None]:
+        """Async version of find_token()."""
+        if stagedoor_settings.SIGNED_LINKS and ":" in str(token):
+            if self.channel == "sms":
+                return None, signals.REJECTED_UNKNOWN
+            return self._found(await AuthToken.afrom_signed(str(token)))
+
+        query = self._token_query(phone_number)
+        if not query:
+            return None, signals.REJECTED_UNKNOWN
+        channel, phone_number = query
+
+        store = get_token_store()
+        if stagedoor_settings.SINGLE_USE_LINK:
+            found = self._found(await store.aconsume(token, channel, phone_number))
+        else:
+            found = self._classify(await store.afind(token, channel, phone_number))
+        if stagedoor_settings.PURGE_ON_LOOKUP:
+            await store.apurge(max_batches=1)
+        return found
+
+    @staticmethod
+    def _found(
+        token_object: AuthToken | None,
+    ) -> tuple[AuthToken | None, str | None]:
+        if token_object is None:
+            return None, signals.REJECTED_UNKNOWN
+        return token_object, None
+
+    @staticmethod
+    def _classify(
+        matches: list[AuthToken],
+    ) -> tuple[AuthToken | None, str | None]:
+        """The live token among matches, or None and why none of them is."""
+        reason = signals.REJECTED_UNKNOWN
+        for token_object in matches:
+            if token_object.is_live():
+                return token_object, None
+            if reason == signals.REJECTED_UNKNOWN:
+                if token_object.is_expired():
+                    reason = signals.REJECTED_EXPIRED
+                else:
+                    reason = signals.REJECTED_UNAPPROVED
+        return None, reason
 
-class EmailTokenBackend(StageDoorBackend):
     def authenticate(
         self, request: HttpRequest | None, **kwargs: Any
     ) -> AbstractBaseUser | None:
+        """Authenticate a user given a token.
+
+        Subclasses that have already fetched the token pass it as token_object.
+        """
         token = kwargs.get("token")
         if not token:
             return None
-        token_object = self.get_token_object(token)
+
+        token_object: AuthToken | None = kwargs.get(
+            "token_object"
+        ) or self.get_token_object(token, kwargs.get("phone_number"))
         if not token_object:
             return None
-        user = super().authenticate(request, token=token_object.token)
-        if not user:
+
+        user = self._contact_user(token_object)
+        if not user and (potential_user := self._potential_user(token_object)):
+            # Only the user who asked for a login to this contact may finish it.
+            requester = getattr(request, "user", None)
+            if not requester or requester.pk != potential_user.pk:
+                return None
+            user = potential_user
+        if not user and not stagedoor_settings.DISABLE_USER_CREATION:
+            started = time.perf_counter()
+            user, created = user_model_fields().model._default_manager.get_or_create(  # type: ignore[assignment]
+                **self._new_user_args(token_object)
+            )
+            if created:
+                self._user_created(user, token_object, started)  # type: ignore[arg-type]
+        return self._with_next_url(user, token_object)
+
+    async def aauthenticate(
+        self, request: HttpRequest | None, **kwargs: Any
+    ) -> AbstractBaseUser | None:
+        """Async version of authenticate()."""
+        token = kwargs.get("token")
+        if not token:
+            return None
+
+        token_object: AuthToken | None = kwargs.get(
+            "token_object"
+        ) or await self.aget_token_object(token, kwargs.get("phone_number"))
+        if not token_object:
             return None
 
-        email: Email | None = token_object.email  # type: ignore[assignment]
-        if not email:
+        user = self._contact_user(token_object)
+        if not user and (potential_user := self._potential_user(token_object)):
+            auser = getattr(request, "auser", None)
+            requester = await auser() if auser else None
+            if not requester or requester.pk != potential_user.pk:
+                return None
+            user = potential_user
+        if not user and not stagedoor_settings.DISABLE_USER_CREATION:
+            started = time.perf_counter()
+            manager = user_model_fields().model._default_manager
+            user, created = await manager.aget_or_create(  # type: ignore[assignment]
+                **self._new_user_args(token_object)
+            )
+            if created:
+                self._user_created(user, token_object, started)  # type: ignore[arg-type]
+        return self._with_next_url(user, token_object)
+
+    def _user_created(
+        self, user: AbstractBaseUser, token_object: AuthToken, started: float
+    ) -> None:
+        signals.user_created_via_stagedoor.send(
+            sender=type(user),
+            user=user,
+            token=token_object,
+            elapsed=time.perf_counter() - started,
+        )
+
+    def _contact_user(self, token_object: AuthToken) -> AbstractBaseUser | None:
+        user = None
+        for contact in (token_object.email, token_object.phone_number):
+            if contact:
+                user = contact.user or user  # type: ignore[attr-defined]
+        return user
+
+    def _potential_user(self, token_object: AuthToken) -> AbstractBaseUser | None:
+        """The logged-in user who asked for a login to the token's contact."""
+        user = None
+        for contact in (token_object.email, token_object.phone_number):
+            if contact:
+                user = contact.potential_user or user  # type: ignore[attr-defined]
+        return user
+
+    def _new_user_args(self, token_object: AuthToken) -> dict[str, Any]:
+        user_fields = user_model_fields()
+        user_args: dict[str, Any] = {}
+        if user_fields.has_username:
+            user_args["username"] = f"u{generate_token_string()[:8]}"
+        if token_object.email and user_fields.has_email:
+            user_args["email"] = token_object.email.email  # type: ignore[attr-defined]
+        if token_object.phone_number and user_fields.has_phone_number:
+            user_args["phone_number"] = token_object.phone_number.phone_number  # type: ignore[attr-defined]
+        return user_args
+
+    def _with_next_url(
+        self, user: AbstractBaseUser | None, token_object: AuthToken
+    ) -> AbstractBaseUser | None:
+        if user and token_object.next_url:
+            user._stagedoor_next_url = token_object.next_url  # type: ignore
+        return user
+
+    def finish_email_login(
+        self, user: AbstractBaseUser, token_object: AuthToken
+    ) -> AbstractBaseUser | None:
+        """Attach the token's email address to the user who logged in with it."""
+        changes = self._attach_contact(
+            user, token_object.email, "email", user_model_fields().has_email
+        )
+        return self._save_changes(user, token_object.email, "email", changes)
+
+    def finish_sms_login(
+        self, user: AbstractBaseUser, token_object: AuthToken
+    ) -> AbstractBaseUser | None:
+        """Attach the token's phone number to the user who logged in with it."""
+        changes = self._attach_contact(
+            user,
+            token_object.phone_number,
+            "phone_number",
+            user_model_fields().has_phone_number,
+        )
+        return self._save_changes(
+            user, token_object.phone_number, "phone_number", changes
+        )
+
+    async def afinish_email_login(
+        self, user: AbstractBaseUser, token_object: AuthToken
+    ) -> AbstractBaseUser | None:
+        """Async version of finish_email_login()."""
+        changes = self._attach_contact(
+            user, token_object.email, "email", user_model_fields().has_email
+        )
+        return await self._asave_changes(user, token_object.email, "email", changes)
+
+    async def afinish_sms_login(
+        self, user: AbstractBaseUser, token_object: AuthToken
+    ) -> AbstractBaseUser | None:
+        """Async version of finish_sms_login()."""
+        changes = self._attach_contact(
+            user,
+            token_object.phone_number,
+            "phone_number",
+            user_model_fields().has_phone_number,
+        )
+        return await self._asave_changes(
+            user, token_object.phone_number, "phone_number", changes
+        )
+
+    def _attach_contact(
+        self,
+        user: AbstractBaseUser,
+        contact: Email | PhoneNumber | None,
+        field_name: str,
+        copy_to_user: bool,
+    ) -> tuple[list[str], bool] | None:
+        """Point the contact at the user, returning what needs saving.
+
+        Returns the changed contact fields and whether the user's copy of the
+        contact changed, or None if the login should be refused.
+        """
+        if not contact:
             # Something has gone _real_ weird, let's be safe and return None
             return None
-        if email.potential_user and email.potential_user != user:  # type: ignore[attr-defined]
+        if contact.potential_user_id and contact.potential_user_id != user.pk:  # type: ignore[union-attr]
             # Something has gone _real_ weird, let's be safe and return None
             return None
 
-        email.user = user  # type: ignore[attr-defined]
-        email.potential_user = None  # type: ignore[attr-defined]
+        # Only write what changed; a returning user usually needs no writes.
+        changed = []
+        if contact.user_id != user.pk:  # type: ignore[union-attr]
+            contact.user = user  # type: ignore[attr-defined]
+            changed.append("user")
+        if contact.potential_user_id:  # type: ignore[union-attr]
+            contact.potential_user = None  # type: ignore[attr-defined]
+            changed.append("potential_user")
+        value = getattr(contact, field_name)
+        user_changed = copy_to_user and getattr(user, field_name) != value
+        if user_changed:
+            setattr(user, field_name, value)
+        return changed, user_changed
 
-        User = get_user_model()
-        if "email" in [
-            field.name for field in User._meta.get_fields(include_hidden=True)
-        ]:
-            user.email = email.email  # type: ignore
-        if stagedoor_settings.SINGLE_USE_LINK:
-            token_object.delete()
-        user.save()
-        email.save()  # type: ignore[attr-defined]
+    def _save_changes(
+        self,
+        user: AbstractBaseUser,
+        contact: Email | PhoneNumber | None,
+        field_name: str,
+        changes: tuple[list[str], bool] | None,
+    ) -> AbstractBaseUser | None:
+        if changes is None:
+            return None
+        changed, user_changed = changes
+        if user_changed:
+            user.save(update_fields=[field_name])
+        if changed:
+            contact.save(update_fields=changed)  # type: ignore[union-attr]
         return user
 
+    async def _asave_changes(
+        self,
+        user: AbstractBaseUser,
+        contact: Email | PhoneNumber | None,
+        field_name: str,
+        changes: tuple[list[str], bool] | None,
+    ) -> AbstractBaseUser | None:
+        if changes is None:
+            return None
+        changed, user_changed = changes
+        if user_changed:
+            await user.asave(update_fields=[field_name])
+        if changed:
+            await contact.asave(update_fields=changed)  # type: ignore[union-attr]
+        return user
+
+
+class TokenBackend(StageDoorBackend):
+    """Authenticate email and SMS tokens with a single token fetch.
+
+    The token row is loaded once, together with its contact and their users,
+    and the login is then finished for whichever channel the token belongs to.
+    This replaces listing both EmailTokenBackend and SMSTokenBackend.
+
+    Query budget per login, with STAGEDOOR_PURGE_ON_LOOKUP off:
+
+    - unknown token: the token fetch only;
+    - returning user: the token fetch only;
+    - new user: the token fetch, the user get_or_create, and one UPDATE of the
+      contact;
+    - potential_user link: the token fetch and one UPDATE of the contact.
+
+    Copying the email address or phone number onto the user adds one UPDATE of
+    that single column, and only when it differs.
+
+    STAGEDOOR_SINGLE_USE_LINK turns the token fetch into a DELETE ... RETURNING
+    plus one joined fetch of the contact. Everything after the token fetch runs
+    in one transaction.
+    """
 
-class SMSTokenBackend(StageDoorBackend):
     def authenticate(
         self, request: HttpRequest | None, **kwargs: Any
     ) -> AbstractBaseUser | None:
         token = kwargs.get("token")
         if not token:
             return None
-        token_object = self.get_token_object(token)
-        if not token_object:
-            return None
-        user = super().authenticate(request, token=token_object.token)
-        if not user:
-            return None
+        phone_number = kwargs.get("phone_number")
+        user = None
+        with metrics.timer(
+            "stagedoor_login_seconds", channel=self.channel or "any"
+        ) as timing:
+            token_object, reason = self.find_token(token, phone_number)
+            if token_object:
+                with transaction.atomic():
+                    user = super().authenticate(
+                        request, token=token, token_object=token_object
+                    )
+                    if user and self._email_login(token_object):
+                        user = self.finish_email_login(user, token_object)
+                    elif user:
+                        user = self.finish_sms_login(user, token_object)
+        if user:
+            self._accepted(token_object, user, timing.elapsed)  # type: ignore[arg-type]
+        else:
+            # A token that was found but logged no one in is a mismatch.
+            reason = reason or signals.REJECTED_MISMATCH
+            self._rejected(request, token, reason, timing.elapsed)
+        return user
 
-        phone_number = token_object.phone_number
-        if not phone_number:
-            # Something has gone _real_ weird, let's be safe and return None
-            return None
-        if phone_number.potential_user and phone_number.potential_user != user:  # type: ignore[attr-defined]
-            # Something has gone _real_ weird, let's be safe and return None
+    async def aauthenticate(
+        self, request: HttpRequest | None, **kwargs: Any
+    ) -> AbstractBaseUser | None:
+        """Async version of authenticate().
+
+        The token fetch, user creation and contact update use the async ORM, so
+        a login needs no worker thread, except the DELETE ... RETURNING of
+        STAGEDOOR_SINGLE_USE_LINK. The async ORM has no transactions, so unlike
+        authenticate() the writes are not wrapped in one.
+        """
+        token = kwargs.get("token")
+        if not token:
             return None
+        phone_number = kwargs.get("phone_number")
+        user = None
+        with metrics.timer(
+            "stagedoor_login_seconds", channel=self.channel or "any"
+        ) as timing:
+            token_object, reason = await self.afind_token(token, phone_number)
+            if token_object:
+                user = await super().aauthenticate(
+                    request, token=token, token_object=token_object
+                )
+                if user and self._email_login(token_object):
+                    user = await self.afinish_email_login(user, token_object)
+                elif user:
+                    user = await self.afinish_sms_login(user, token_object)
+        if user:
+            self._accepted(token_object, user, timing.elapsed)  # type: ignore[arg-type]
+        else:
+            # A token that was found but logged no one in is a mismatch.
+            reason = reason or signals.REJECTED_MISMATCH
+            self._rejected(request, token, reason, timing.elapsed)
+        return user
 
-        phone_number.user = user  # type: ignore[attr-defined]
-        phone_number.potential_user = None  # type: ignore[attr-defined]
+    def _email_login(self, token_object: AuthToken) -> bool:
+        return bool(token_object.email_id and self.channel != "sms")  # type: ignore[attr-defined]
 
-        User = get_user_model()
-        if "phone_number" in [
-            field.name for field in User._meta.get_fields(include_hidden=True)
-        ]:
-            user.phone_number = phone_number.phone_number  # type: ignore
-        if stagedoor_settings.SINGLE_USE_LINK:
-            token_object.delete()
-        user.save()
-        phone_number.save()  # type: ignore[attr-defined]
-        return user
+    def _accepted(
+        self, token_object: AuthToken, user: AbstractBaseUser, elapsed: float
+    ) -> None:
+        metrics.increment(
+            "stagedoor_logins_total", channel=self.channel or "any", result="ok"
+        )
+        signals.token_consumed.send(
+            sender=AuthToken,
+            token=token_object,
+            user=user,
+            channel="email" if self._email_login(token_object) else "sms",
+            elapsed=elapsed,
+        )
+
+    def _rejected(
+        self,
+        request: HttpRequest | None,
+        token: str | int,
+        reason: str,
+        elapsed: float,
+    ) -> None:
+        """Report a refused token, once per login attempt.
+
+        A token this backend found is refused here and now, and the request
+        remembers it. A token it couldn't find may still be found by a later
+        token backend, so only the last one reports it, and only if no
+        backend before it already did.
+        """
+        if reason != signals.REJECTED_UNKNOWN:
+            if request is not None:
+                request._stagedoor_rejected = token  # type: ignore[attr-defined]
+        elif not self._last_token_backend() or (
+            getattr(request, "_stagedoor_rejected", None) == token
+        ):
+            return
+        channel = self.channel or "any"
+        metrics.increment("stagedoor_logins_total", channel=channel, result=reason)
+        signals.token_rejected.send(
+            sender=AuthToken, channel=channel, reason=reason, elapsed=elapsed
+        )
+
+    def _last_token_backend(self) -> bool:
+        """Whether no token backend is listed after this one.
+
+        A token this backend can't find may still be accepted by a later
+        backend in AUTHENTICATION_BACKENDS, as with the EmailTokenBackend and
+        SMSTokenBackend pair, so only the last one reports it rejected. A
+        backend that isn't listed counts as the last.
+        """
+        path = f"{type(self).__module__}.{type(self).__qualname__}"
+        backends = list(settings.AUTHENTICATION_BACKENDS)
+        if path not in backends:
+            return True
+        return not any(
+            issubclass(import_string(later), TokenBackend)
+            for later in backends[backends.index(path) + 1 :]
+        )
+
+
+class EmailTokenBackend(TokenBackend):
+    channel = "email"
+
+
+class SMSTokenBackend(TokenBackend):
+    channel = "sms"
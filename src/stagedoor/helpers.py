@@ -1,43 +1,232 @@
+import logging
+import time
+from collections.abc import Iterable, Iterator, Sequence
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import cache
+from typing import TYPE_CHECKING, Any
+
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.contrib.sites.models import Site
+from django.contrib.sites.requests import RequestSite
 from django.contrib.sites.shortcuts import get_current_site
-from django.core.mail import send_mail
+from django.core.mail import (
+    EmailMessage,
+    EmailMultiAlternatives,
+    get_connection,
+    send_mail,
+)
+from django.db import connections, router, transaction
+from django.db.models import F, Q
 from django.http import HttpRequest
-from django.template.loader import get_template, render_to_string
+from django.template.loader import get_template
+from django.utils.timezone import now
+from django.utils.translation import get_language
 
+from . import metrics, signals
 from . import settings as stagedoor_settings
-from .models import AuthToken
+from .models import (
+    AuthToken,
+    Delivery,
+    Email,
+    PhoneNumber,
+    generate_token_string,
+    sign_login_token,
+)
+from .sms import get_sms_transport
+from .stores import get_token_store
 
+if TYPE_CHECKING:
+    from django.template.backends.base import _EngineTemplate as Template
 
-def email_login_link(request: HttpRequest, token: AuthToken) -> None:
-    current_site = get_current_site(request)
+logger = logging.getLogger(__name__)
 
-    # Send the link by email.
-    send_mail(
-        subject=f"Here's your login to {stagedoor_settings.SITE_NAME}",
-        message=render_to_string(
-            stagedoor_settings.EMAIL_TXT_TEMPLATE,
-            {
-                "current_site": current_site,
-                "token": token.token,
-                "site_name": stagedoor_settings.SITE_NAME,
-                "support_email": stagedoor_settings.SUPPORT_EMAIL,
-            },
-            request=request,
-        ),
-        from_email=stagedoor_settings.DEFAULT_FROM_EMAIL,
-        recipient_list=[token.email.email],  # type: ignore
-        html_message=get_template(stagedoor_settings.EMAIL_HTML_TEMPLATE).render(
-            {
-                "current_site": current_site,
-                "token": token.token,
-                "site_name": stagedoor_settings.SITE_NAME,
-                "support_email": stagedoor_settings.SUPPORT_EMAIL,
-            },
-        ),
-        fail_silently=False,
+
+@cache
+def _compiled_template(name: str, language: str | None) -> "Template":
+    return get_template(name)
+
+
+def clear_email_templates(*, setting: str, **kwargs) -> None:
+    """setting_changed receiver that forgets the compiled email templates."""
+    if setting == "TEMPLATES":
+        _compiled_template.cache_clear()
+
+
+class EmailRenderer:
+    """Render an email's subject, text body and HTML body from one context.
+
+    Template names are stagedoor setting names, read at render time. The
+    templates are looked up and compiled once per process and language (or on
+    every render with DEBUG on, so edits show up), so sending many emails only
+    pays for the rendering itself.
+    """
+
+    def __init__(self, subject: str, txt_setting: str, html_setting: str) -> None:
+        self.subject = subject
+        self.txt_setting = txt_setting
+        self.html_setting = html_setting
+
+    def templates(self) -> tuple["Template", "Template"]:
+        names = (
+            getattr(stagedoor_settings, self.txt_setting),
+            getattr(stagedoor_settings, self.html_setting),
+        )
+        if settings.DEBUG:
+            return get_template(names[0]), get_template(names[1])
+        language = get_language()
+        return (
+            _compiled_template(names[0], language),
+            _compiled_template(names[1], language),
+        )
+
+    def render(
+        self, context: dict[str, Any], request: HttpRequest | None = None
+    ) -> tuple[str, str, str]:
+        return self.render_many([context], request)[0]
+
+    def render_many(
+        self, contexts: Iterable[dict[str, Any]], request: HttpRequest | None = None
+    ) -> list[tuple[str, str, str]]:
+        """Render (subject, text, html) for each context with the same templates."""
+        txt_template, html_template = self.templates()
+        return [
+            (
+                self.subject.format(**context),
+                txt_template.render(context, request),
+                html_template.render(context, request),
+            )
+            for context in contexts
+        ]
+
+
+LOGIN_EMAIL = EmailRenderer(
+    "Here's your login to {site_name}", "EMAIL_TXT_TEMPLATE", "EMAIL_HTML_TEMPLATE"
+)
+APPROVAL_EMAIL = EmailRenderer(
+    "New account created on {site_name}",
+    "APPROVAL_TXT_TEMPLATE",
+    "APPROVAL_HTML_TEMPLATE",
+)
+
+
+@contextmanager
+def _sending(token: AuthToken, channel: str) -> Iterator[None]:
+    """Time sending a token's login message, and signal how it went."""
+    timing: metrics.Timing | None = None
+    try:
+        with metrics.timer(
+            "stagedoor_delivery_seconds", "stagedoor_deliveries_total", channel=channel
+        ) as timing:
+            yield
+    except Exception as error:
+        signals.token_delivery_failed.send(
+            sender=AuthToken,
+            token=token,
+            channel=channel,
+            error=error,
+            elapsed=timing.elapsed if timing else 0.0,
+        )
+        raise
+    signals.token_delivered.send(
+        sender=AuthToken, token=token, channel=channel, elapsed=timing.elapsed
     )
 
 
+def login_email_context(
+    token: AuthToken, current_site: Site | RequestSite
+) -> dict[str, Any]:
+    return {
+        "current_site": current_site,
+        "token": token.login_token,
+        "site_name": stagedoor_settings.SITE_NAME,
+        "support_email": stagedoor_settings.SUPPORT_EMAIL,
+    }
+
+
+def email_login_link(
+    request: HttpRequest | None,
+    token: AuthToken,
+    current_site: Site | RequestSite | None = None,
+) -> None:
+    current_site = current_site or get_current_site(request)
+    with _sending(token, "email"):
+        subject, message, html_message = LOGIN_EMAIL.render(
+            login_email_context(token, current_site), request
+        )
+
+        # Send the link by email.
+        send_mail(
+            subject=subject,
+            message=message,
+            from_email=stagedoor_settings.DEFAULT_FROM_EMAIL,
+            recipient_list=[token.email.email],  # type: ignore
+            html_message=html_message,
+            fail_silently=False,
+        )
+
+
+def login_email_messages(
+    request: HttpRequest | None,
+    tokens: Sequence[AuthToken],
+    current_site: Site | RequestSite | None = None,
+) -> list[EmailMultiAlternatives]:
+    """Build the login emails for several tokens without sending them."""
+    current_site = current_site or get_current_site(request)
+    rendered = LOGIN_EMAIL.render_many(
+        (login_email_context(token, current_site) for token in tokens), request
+    )
+    messages = []
+    for token, (subject, message, html_message) in zip(tokens, rendered, strict=True):
+        email = EmailMultiAlternatives(
+            subject=subject,
+            body=message,
+            from_email=stagedoor_settings.DEFAULT_FROM_EMAIL,
+            to=[token.email.email],  # type: ignore
+        )
+        email.attach_alternative(html_message, "text/html")
+        messages.append(email)
+    return messages
+
+
+def send_email_batch(
+    messages: Sequence[EmailMessage], batch_size: int | None = None
+) -> list[tuple[int, int, Exception | None, float]]:
+    """Send emails in chunks of batch_size over a single mail connection.
+
+    A failing chunk is logged and skipped so the rest still go out. Returns
+    (sent, failed, error, elapsed) for each chunk, elapsed in seconds.
+    """
+    batch_size = batch_size or stagedoor_settings.EMAIL_BATCH_SIZE
+    results: list[tuple[int, int, Exception | None, float]] = []
+    with get_connection(fail_silently=False) as connection:
+        for start in range(0, len(messages), batch_size):
+            chunk = messages[start : start + batch_size]
+            started = time.perf_counter()
+            try:
+                sent = connection.send_messages(chunk) or 0
+            except Exception as error:
+                logger.exception(
+                    "Could not send login emails %d-%d", start + 1, start + len(chunk)
+                )
+                results.append((0, len(chunk), error, time.perf_counter() - started))
+            else:
+                results.append(
+                    (sent, len(chunk) - sent, None, time.perf_counter() - started)
+                )
+    for sent, failed, _, _ in results:
+        if sent:
+            metrics.increment(
+                "stagedoor_deliveries_total", sent, channel="email", result="ok"
+            )
+        if failed:
+            metrics.increment(
+                "stagedoor_deliveries_total", failed, channel="email", result="error"
+            )
+    return results
+
+
 def email_admin_approval(request: HttpRequest, token: AuthToken) -> None:
     current_site = get_current_site(request)
 
@@ -52,52 +241,272 @@ def email_admin_approval(request: HttpRequest, token: AuthToken) -> None:
         contact_info = "unknown"
         contact_type = "contact method"
 
+    subject, message, html_message = APPROVAL_EMAIL.render(
+        {
+            "current_site": current_site,
+            "token": token.login_token,
+            "site_name": stagedoor_settings.SITE_NAME,
+            "support_email": stagedoor_settings.SUPPORT_EMAIL,
+            "contact_info": contact_info,
+            "contact_type": contact_type,
+        },
+        request,
+    )
+
     # Send the approval request email to support/admin email
     send_mail(
-        subject=f"New account created on {stagedoor_settings.SITE_NAME}",
-        message=render_to_string(
-            stagedoor_settings.APPROVAL_TXT_TEMPLATE,
-            {
-                "current_site": current_site,
-                "token": token.token,
-                "site_name": stagedoor_settings.SITE_NAME,
-                "support_email": stagedoor_settings.SUPPORT_EMAIL,
-                "contact_info": contact_info,
-                "contact_type": contact_type,
-            },
-            request=request,
-        ),
+        subject=subject,
+        message=message,
         from_email=stagedoor_settings.DEFAULT_FROM_EMAIL,
         recipient_list=[stagedoor_settings.SUPPORT_EMAIL],
-        html_message=get_template(stagedoor_settings.APPROVAL_HTML_TEMPLATE).render(
-            {
-                "current_site": current_site,
-                "token": token.token,
-                "site_name": stagedoor_settings.SITE_NAME,
-                "support_email": stagedoor_settings.SUPPORT_EMAIL,
-                "contact_info": contact_info,
-                "contact_type": contact_type,
-            },
-        ),
+        html_message=html_message,
         fail_silently=False,
     )
 
 
-def sms_login_link(request: HttpRequest, token: AuthToken) -> None:
-    current_site = get_current_site(request)
-    if (
-        hasattr(settings, "TWILIO_ACCOUNT_SID")
-        and hasattr(settings, "TWILIO_AUTH_TOKEN")
-        and hasattr(settings, "TWILIO_NUMBER")
-        and settings.TWILIO_ACCOUNT_SID is not None
-        and settings.TWILIO_AUTH_TOKEN is not None
-        and settings.TWILIO_NUMBER is not None
-    ):
-        from twilio.rest import Client
-
-        client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
-        client.messages.create(
-            body=f"Your {stagedoor_settings.SITE_NAME} code is {token.token}\n\nGo to https://{current_site.domain}/auth/token to login.",  # noqa: E501
-            from_=settings.TWILIO_NUMBER,
+def sms_login_body(token: AuthToken, current_site: Site | RequestSite) -> str:
+    return f"Your {stagedoor_settings.SITE_NAME} code is {token.login_token}\n\nGo to https://{current_site.domain}/auth/token to login."  # noqa: E501
+
+
+def sms_login_link(
+    request: HttpRequest | None,
+    token: AuthToken,
+    current_site: Site | RequestSite | None = None,
+) -> None:
+    current_site = current_site or get_current_site(request)
+    with _sending(token, "sms"):
+        get_sms_transport().send(
+            to=str(token.phone_number.phone_number),  # type: ignore
+            body=sms_login_body(token, current_site),
+        )
+
+
+async def aemail_login_link(
+    request: HttpRequest | None,
+    token: AuthToken,
+    current_site: Site | RequestSite | None = None,
+) -> None:
+    """Async version of email_login_link().
+
+    The email is rendered and sent in a worker thread of its own, so a slow mail
+    server doesn't hold up the shared sync thread.
+    """
+    current_site = current_site or await sync_to_async(get_current_site)(request)
+    await sync_to_async(email_login_link, thread_sensitive=False)(
+        request, token, current_site
+    )
+
+
+async def asms_login_link(
+    request: HttpRequest | None,
+    token: AuthToken,
+    current_site: Site | RequestSite | None = None,
+) -> None:
+    """Async version of sms_login_link(), sending with the transport's asend()."""
+    current_site = current_site or await sync_to_async(get_current_site)(request)
+    with _sending(token, "sms"):
+        await get_sms_transport().asend(
             to=str(token.phone_number.phone_number),  # type: ignore
+            body=sms_login_body(token, current_site),
+        )
+
+
+def _delivery(token: AuthToken, domain: str) -> Delivery:
+    if token.email:
+        channel, recipient = Delivery.EMAIL, token.email.email  # type: ignore[attr-defined]
+    else:
+        channel, recipient = Delivery.SMS, str(token.phone_number.phone_number)  # type: ignore[union-attr]
+    return Delivery(
+        channel=channel,
+        recipient=recipient,
+        auth_token=token if token.pk else None,
+        next_url=token.next_url,
+        domain=domain,
+        expires_at=token.expires_at,
+    )
+
+
+def queue_login_link(request: HttpRequest, token: AuthToken) -> Delivery:
+    """Record a token's login email or SMS for the stagedoor_deliver worker.
+
+    Call this in the same transaction that creates the token, so the message
+    is queued if and only if the token exists.
+    """
+    delivery = _delivery(token, get_current_site(request).domain)
+    delivery.save()
+    return delivery
+
+
+def queue_login_links(
+    request: HttpRequest, tokens: Iterable[AuthToken]
+) -> list[Delivery]:
+    """Queue the login messages for several tokens with a single insert."""
+    domain = get_current_site(request).domain
+    return Delivery.objects.bulk_create(_delivery(token, domain) for token in tokens)
+
+
+def approve_and_send(
+    request: HttpRequest, tokens: list[AuthToken]
+) -> tuple[int, list[str]]:
+    """Approve tokens that were waiting for an admin and send their login messages.
+
+    The tokens are approved by the token store. With STAGEDOOR_ASYNC_DELIVERY
+    their messages are queued in the same transaction. Otherwise, emails are
+    sent in chunks of STAGEDOOR_EMAIL_BATCH_SIZE over one mail connection and
+    SMS one at a time. Returns the number of messages sent or queued, and a
+    description of each failure.
+    """
+    with transaction.atomic():
+        get_token_store().approve(tokens)
+        if stagedoor_settings.ASYNC_DELIVERY:
+            queue_login_links(request, tokens)
+    if stagedoor_settings.ASYNC_DELIVERY:
+        return len(tokens), []
+
+    current_site = get_current_site(request)
+    sent_count = 0
+    errors = []
+
+    email_tokens = [token for token in tokens if token.email]
+    emails = login_email_messages(request, email_tokens, current_site)
+    start = 0
+    for sent, failed, error, elapsed in send_email_batch(emails):
+        sent_count += sent
+        chunk = email_tokens[start : start + sent + failed]
+        if failed:
+            errors.append(
+                f"Could not send login emails {start + 1}-{start + sent + failed}"
+                f" of {len(emails)}: {error or f'{failed} rejected'}"
+            )
+        for token in chunk:
+            if failed:
+                signals.token_delivery_failed.send(
+                    sender=AuthToken,
+                    token=token,
+                    channel="email",
+                    error=error,
+                    elapsed=elapsed,
+                )
+            else:
+                signals.token_delivered.send(
+                    sender=AuthToken, token=token, channel="email", elapsed=elapsed
+                )
+        start += sent + failed
+
+    for token in tokens:
+        if token.phone_number:
+            try:
+                sms_login_link(request=request, token=token)
+            except Exception as error:
+                logger.exception("Could not send login SMS for %s", token)
+                errors.append(
+                    f"Could not send login SMS to "
+                    f"{token.phone_number.phone_number}: {error}"  # type: ignore[attr-defined]
+                )
+            else:
+                sent_count += 1
+    return sent_count, errors
+
+
+def delivery_token(delivery: Delivery) -> AuthToken:
+    """The token to send for a queued message, with a string nobody has seen.
+
+    A token stored as a row is given a new string in place. Otherwise a new
+    token is issued for the same contact, lasting as long as the queued one
+    would have; a cached token's original entry is left to expire.
+    """
+    sms = delivery.channel == Delivery.SMS
+    token = delivery.auth_token
+    if token is not None:
+        token.set_token(generate_token_string(sms=sms))
+        with transaction.atomic():
+            token.save(update_fields=["token", "token_digest"])
+        return token
+    if sms:
+        token = AuthToken(
+            phone_number=PhoneNumber.objects.get(phone_number=delivery.recipient)
         )
+    else:
+        token = AuthToken(email=Email.objects.get(email=delivery.recipient))
+    token.next_url = delivery.next_url
+    token.timestamp = now()
+    token.expires_at = delivery.expires_at
+    if token.email and stagedoor_settings.SIGNED_LINKS:
+        token.set_token(sign_login_token(token.email, delivery.next_url))
+    else:
+        token.set_token(generate_token_string(sms=sms))
+        get_token_store().save(token)
+    return token
+
+
+def send_delivery(delivery: Delivery) -> None:
+    """Send one queued login email or SMS."""
+    current_site = Site(domain=delivery.domain, name=delivery.domain)
+    token = delivery_token(delivery)
+    if delivery.channel == Delivery.EMAIL:
+        email_login_link(None, token, current_site=current_site)
+    else:
+        sms_login_link(None, token, current_site=current_site)
+
+
+def claim_deliveries(batch_size: int | None = None) -> list[Delivery]:
+    """Lease up to batch_size queued messages to this worker.
+
+    Rows are picked with SELECT ... FOR UPDATE SKIP LOCKED where the database
+    supports it, and marked claimed for STAGEDOOR_DELIVERY_LEASE seconds, all in
+    one short transaction. Messages that expired or ran out of attempts are
+    skipped.
+    """
+    batch_size = batch_size or stagedoor_settings.DELIVERY_BATCH_SIZE
+    connection = connections[router.db_for_write(Delivery)]
+    current = now()
+    with transaction.atomic(using=connection.alias):
+        claimable = (
+            Delivery.objects.filter(
+                attempts__lt=stagedoor_settings.DELIVERY_MAX_ATTEMPTS,
+                expires_at__gt=current,
+            )
+            .filter(Q(claimed_until__isnull=True) | Q(claimed_until__lte=current))
+            .order_by("pk")
+        )
+        if connection.features.has_select_for_update_skip_locked:
+            claimable = claimable.select_for_update(skip_locked=True)
+        pks = list(claimable.values_list("pk", flat=True)[:batch_size])
+        Delivery.objects.filter(pk__in=pks).update(
+            claimed_until=current + timedelta(seconds=stagedoor_settings.DELIVERY_LEASE)
+        )
+    return list(
+        Delivery.objects.filter(pk__in=pks)
+        .select_related("auth_token__email", "auth_token__phone_number")
+        .order_by("pk")
+    )
+
+
+def deliver_pending(batch_size: int | None = None) -> tuple[int, int]:
+    """Send up to batch_size queued login messages.
+
+    The messages are claimed first, see claim_deliveries(), and sent outside
+    any transaction, so a slow provider holds no locks. Each row is deleted as
+    soon as it is sent; failed rows are released with their error and retried
+    until STAGEDOOR_DELIVERY_MAX_ATTEMPTS is reached. Rows whose token was
+    used or deleted since they were queued are dropped unsent. A worker that
+    dies mid-batch leaves its rows to be retried once the lease runs out.
+    Returns (sent, failed).
+    """
+    sent = failed = 0
+    for delivery in claim_deliveries(batch_size):
+        if delivery.auth_token_id and delivery.auth_token is None:  # type: ignore[attr-defined]
+            Delivery.objects.filter(pk=delivery.pk).delete()
+            continue
+        try:
+            send_delivery(delivery)
+        except Exception as error:
+            logger.exception("Could not deliver %s", delivery)
+            Delivery.objects.filter(pk=delivery.pk).update(
+                attempts=F("attempts") + 1, last_error=str(error), claimed_until=None
+            )
+            failed += 1
+        else:
+            Delivery.objects.filter(pk=delivery.pk).delete()
+            sent += 1
+    return sent, failed
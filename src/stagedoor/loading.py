@@ -0,0 +1,24 @@
+"""Loading the pluggable classes named in settings."""
+
+import threading
+from typing import Any
+
+from django.utils.module_loading import import_string
+
+_instances: dict[str, Any] = {}
+_instances_lock = threading.Lock()
+
+
+def shared_instance(path: str) -> Any:
+    """An instance of the class at dotted path, created on first use.
+
+    Every caller in the process gets the same instance, so the class must be
+    safe to call from several threads.
+    """
+    try:
+        return _instances[path]
+    except KeyError:
+        with _instances_lock:
+            if path not in _instances:
+                _instances[path] = import_string(path)()
+            return _instances[path]
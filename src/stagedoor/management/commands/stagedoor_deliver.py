@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from stagedoor import settings as stagedoor_settings
+from stagedoor.helpers import deliver_pending
+
+
+class Command(BaseCommand):
+    help = "Send queued stagedoor login emails and SMS messages."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=stagedoor_settings.DELIVERY_BATCH_SIZE,
+            help="Maximum number of messages claimed per batch.",
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep polling for new messages instead of exiting.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=1.0,
+            help="Seconds to wait when nothing was sent, with --loop.",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = deliver_pending(batch_size=options["batch_size"])
+            if sent or failed or not options["loop"]:
+                self.stdout.write(f"Sent {sent} messages, {failed} failed.")
+            if not options["loop"]:
+                return
+            if not sent:
+                time.sleep(options["interval"])
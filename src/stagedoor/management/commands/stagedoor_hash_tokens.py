@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from stagedoor import settings as stagedoor_settings
+from stagedoor.models import AuthToken
+
+
+class Command(BaseCommand):
+    help = "Store digests for stagedoor tokens created before digests existed."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=stagedoor_settings.PURGE_BATCH_SIZE,
+            help="Maximum number of rows updated per batch.",
+        )
+
+    def handle(self, *args, **options):
+        updated = AuthToken.backfill_digests(batch_size=options["batch_size"])
+        self.stdout.write(f"Stored digests for {updated} tokens.")
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from stagedoor import settings as stagedoor_settings
+from stagedoor.models import AuthToken, Delivery
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete expired stagedoor tokens and undeliverable queued messages "
+        "in bounded batches."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=stagedoor_settings.PURGE_BATCH_SIZE,
+            help="Maximum number of rows deleted per statement.",
+        )
+
+    def handle(self, *args, **options):
+        deleted = AuthToken.purge_stale(batch_size=options["batch_size"])
+        self.stdout.write(f"Deleted {deleted} stale tokens.")
+        dead = Delivery.purge_dead(batch_size=options["batch_size"])
+        self.stdout.write(f"Deleted {dead} undeliverable messages.")
@@ -0,0 +1,258 @@
+import math
+import random
+from collections.abc import Iterator
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import cache
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.timezone import now
+
+from stagedoor import settings as stagedoor_settings
+from stagedoor.models import AuthToken, Email, PhoneNumber, token_duration
+from stagedoor.users import user_model_fields
+
+EMAIL_CHARSET = "abcdefghijkmnopqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXYZ123456789"
+SMS_CHARSET = "123456789"
+GOLDEN_RATIO = (math.sqrt(5) - 1) / 2
+
+# Each area code holds 8 million numbers, from 200-0000 to 999-9999.
+AREA_CODES = ("415", "212", "312", "617", "206", "303", "512", "702", "305", "404")
+NUMBERS_PER_AREA = 8_000_000
+
+
+def seed_email(n: int) -> str:
+    return f"seed{n}@example.com"
+
+
+def seed_phone_number(n: int) -> str:
+    area, number = divmod(n, NUMBERS_PER_AREA)
+    return f"+1{AREA_CODES[area]}{2_000_000 + number:07d}"
+
+
+def token_space(sms: bool) -> tuple[str, int]:
+    """The charset and length of token strings for a channel."""
+    if sms:
+        return SMS_CHARSET, stagedoor_settings.SMS_TOKEN_LENGTH
+    return EMAIL_CHARSET, stagedoor_settings.EMAIL_TOKEN_LENGTH
+
+
+@cache
+def token_step(space: int) -> int:
+    """A step that visits every value below space once before repeating.
+
+    It is coprime to space, and near the golden ratio of it, so consecutive
+    steps land far apart.
+    """
+    step = int(space * GOLDEN_RATIO)
+    while math.gcd(step, space) != 1:
+        step += 1
+    return step
+
+
+def seed_token_string(index: int, offset: int, sms: bool) -> str:
+    """The index'th token string, distinct from the others until the space runs out."""
+    charset, length = token_space(sms)
+    space = len(charset) ** length
+    value = (offset + index * token_step(space)) % space
+    chars = []
+    for _ in range(length):
+        value, digit = divmod(value, len(charset))
+        chars.append(charset[digit])
+    return "".join(chars)
+
+
+@contextmanager
+def explicit_timestamps() -> Iterator[None]:
+    """Let bulk_create() keep the timestamps set on new tokens."""
+    field = AuthToken._meta.get_field("timestamp")
+    field.auto_now_add = False  # type: ignore[union-attr]
+    try:
+        yield
+    finally:
+        field.auto_now_add = True  # type: ignore[union-attr]
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill the stagedoor tables with generated emails, phone numbers, users "
+        "and tokens for load testing. The same --seed always produces the same "
+        "rows, with ages relative to the time the command runs."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--emails", type=int, default=1000)
+        parser.add_argument("--phone-numbers", type=int, default=1000)
+        parser.add_argument(
+            "--tokens",
+            type=int,
+            default=2000,
+            help="Tokens spread at random over the emails and phone numbers.",
+        )
+        parser.add_argument(
+            "--user-ratio",
+            type=float,
+            default=0.5,
+            help="Fraction of emails and phone numbers that belong to a user.",
+        )
+        parser.add_argument(
+            "--stale-ratio",
+            type=float,
+            default=0.5,
+            help="Fraction of tokens that have expired.",
+        )
+        parser.add_argument(
+            "--approval-ratio",
+            type=float,
+            default=1.0,
+            help="Fraction of tokens that are approved.",
+        )
+        parser.add_argument(
+            "--max-age",
+            type=int,
+            default=7 * 24 * 60 * 60,
+            help="Age in seconds of the oldest stale token.",
+        )
+        parser.add_argument(
+            "--age-distribution",
+            choices=["uniform", "exponential"],
+            default="exponential",
+            help="How stale token ages are spread; exponential favours recent ones.",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10_000,
+            help="Emails and phone numbers, with their users and tokens, per insert.",
+        )
+
+    def handle(self, *args, **options):
+        emails = options["emails"]
+        phone_numbers = options["phone_numbers"]
+        contacts = emails + phone_numbers
+        tokens = options["tokens"]
+        batch_size = options["batch_size"]
+        for name in ("user_ratio", "stale_ratio", "approval_ratio"):
+            if not 0 <= options[name] <= 1:
+                raise CommandError(f"--{name.replace('_', '-')} must be from 0 to 1.")
+        if min(emails, phone_numbers, tokens) < 0:
+            raise CommandError("Counts must not be negative.")
+        if batch_size < 1:
+            raise CommandError("--batch-size must be at least 1.")
+        if tokens and not contacts:
+            raise CommandError("Tokens need at least one email or phone number.")
+        if phone_numbers > len(AREA_CODES) * NUMBERS_PER_AREA:
+            raise CommandError("Too many phone numbers.")
+        if options["max_age"] <= max(token_duration(False), token_duration(True)):
+            raise CommandError("--max-age must be longer than the token durations.")
+
+        rng = random.Random(options["seed"])
+        self.offsets = {}
+        for sms in (False, True):
+            charset, length = token_space(sms)
+            self.offsets[sms] = rng.randrange(len(charset) ** length)
+        self.token_counts = {False: 0, True: 0}
+        self.started = now()
+        users = 0
+        with explicit_timestamps():
+            for start in range(0, contacts, batch_size):
+                end = min(start + batch_size, contacts)
+                # Share the tokens out over the chunks by their size.
+                chunk_tokens = tokens * end // contacts - tokens * start // contacts
+                with transaction.atomic():
+                    users += self.seed_chunk(rng, start, end, chunk_tokens, options)
+                if options["verbosity"] > 1:
+                    self.stdout.write(f"Seeded {end} of {contacts} contacts.")
+
+        self.stdout.write(
+            f"Seeded {emails} emails, {phone_numbers} phone numbers, "
+            f"{users} users and {tokens} tokens."
+        )
+
+    def seed_chunk(
+        self, rng: random.Random, start: int, end: int, tokens: int, options: dict
+    ) -> int:
+        """Insert the contacts numbered start to end, and tokens for them.
+
+        Contacts below --emails are emails, the rest phone numbers. Returns the
+        number of users created.
+        """
+        emails = options["emails"]
+        numbers = range(start, end)
+        owned = [n for n in numbers if rng.random() < options["user_ratio"]]
+        users = dict(zip(owned, self.create_users(owned, emails), strict=True))
+
+        contacts: list[Email | PhoneNumber] = []
+        contacts += Email.objects.bulk_create(
+            Email(email=seed_email(n), user=users.get(n)) for n in numbers if n < emails
+        )
+        contacts += PhoneNumber.objects.bulk_create(
+            PhoneNumber(phone_number=seed_phone_number(n - emails), user=users.get(n))
+            for n in numbers
+            if n >= emails
+        )
+
+        new_tokens = []
+        # Digests are unique per contact, and a chunk's tokens only go to its
+        # own contacts, so only strings given out in this chunk can clash.
+        taken: set[tuple[bool, int, str]] = set()
+        for _ in range(tokens):
+            contact = rng.choice(contacts)
+            sms = isinstance(contact, PhoneNumber)
+            token = AuthToken(
+                timestamp=self.seed_timestamp(rng, options, token_duration(sms)),
+                approved=rng.random() < options["approval_ratio"],
+            )
+            if sms:
+                token.phone_number = contact
+            else:
+                token.email = contact
+            token.set_expiry(token.timestamp)
+            charset, length = token_space(sms)
+            for _ in range(len(charset) ** length):
+                index = self.token_counts[sms]
+                self.token_counts[sms] += 1
+                token_string = seed_token_string(index, self.offsets[sms], sms)
+                # Like generate_token(), draw again if the contact has it.
+                if (sms, contact.pk, token_string) not in taken:
+                    break
+            else:
+                raise CommandError(f"Ran out of token strings for {contact}.")
+            taken.add((sms, contact.pk, token_string))
+            token.set_token(token_string)
+            new_tokens.append(token)
+        AuthToken.objects.bulk_create(new_tokens)
+        return len(users)
+
+    def create_users(self, numbers: list[int], emails: int) -> list:
+        """Create one user per contact number, named after it."""
+        User = get_user_model()
+        fields = user_model_fields()
+        new_users = []
+        for n in numbers:
+            user = User(password="!")  # An unusable password.
+            if fields.has_username:
+                user.username = f"seed{n}"  # type: ignore[attr-defined]
+            if fields.has_email and n < emails:
+                user.email = seed_email(n)  # type: ignore[attr-defined]
+            if fields.has_phone_number and n >= emails:
+                user.phone_number = seed_phone_number(n - emails)  # type: ignore[attr-defined]
+            new_users.append(user)
+        return User.objects.bulk_create(new_users)
+
+    def seed_timestamp(
+        self, rng: random.Random, options: dict, duration: int
+    ) -> datetime:
+        """A creation time for a token that lasts duration seconds once approved."""
+        if rng.random() >= options["stale_ratio"]:
+            return self.started - timedelta(seconds=rng.uniform(0, duration))
+        span = options["max_age"] - duration
+        if options["age_distribution"] == "uniform":
+            age = rng.uniform(0, span)
+        else:
+            # A mean of a fifth of the span, with the rare longer ages clipped.
+            age = min(rng.expovariate(5 / span), span)
+        return self.started - timedelta(seconds=duration + age)
@@ -0,0 +1,205 @@
+"""Pluggable metrics for the login flow.
+
+STAGEDOOR_METRICS_SINK names the sink class that records counters and latency
+histograms, or is None, the default, to record nothing. The sink is shared
+by stagedoor.loading.shared_instance().
+
+The metrics, labelled by channel ("email" or "sms"):
+
+- stagedoor_tokens_issued_total and stagedoor_token_issue_seconds, for
+  generate_token();
+- stagedoor_token_collisions_total, for new token strings that were taken;
+- stagedoor_tokens_purged_total, unlabelled, for expired rows deleted;
+- stagedoor_logins_total, with result "ok" or one of the reasons in
+  stagedoor.signals.REJECTION_REASONS, and stagedoor_login_seconds, for
+  TokenBackend;
+- stagedoor_deliveries_total, with result "ok" or "error", and
+  stagedoor_delivery_seconds, for login emails and SMS.
+
+Logins through a backend without a channel are labelled "any".
+"""
+
+import logging
+import socket
+import threading
+import time
+from bisect import bisect_left
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+
+from . import settings as stagedoor_settings
+from .loading import shared_instance
+
+logger = logging.getLogger(__name__)
+
+# The Prometheus client's default buckets, in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelKey = tuple[str, tuple[tuple[str, str], ...]]
+
+
+class BaseMetricsSink:
+    def increment(self, name: str, labels: dict[str, str], value: int = 1) -> None:
+        raise NotImplementedError
+
+    def observe(self, name: str, labels: dict[str, str], seconds: float) -> None:
+        raise NotImplementedError
+
+
+class RegistrySink(BaseMetricsSink):
+    """Keep metrics in this process, for the Prometheus view to serve.
+
+    Every process has a registry of its own, so with several worker processes
+    each scrape sees one of them. Use StatsDSink to add them up instead.
+    """
+
+    buckets = DEFAULT_BUCKETS
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.counters: dict[LabelKey, int] = {}
+        # Per-bucket counts, the last for +Inf, and the sum of the observations.
+        self.histograms: dict[LabelKey, tuple[list[int], list[float]]] = {}
+
+    def increment(self, name: str, labels: dict[str, str], value: int = 1) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: dict[str, str], seconds: float) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            counts, total = self.histograms[key]
+            counts[index] += 1
+            total[0] += seconds
+
+    def clear(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def exposition(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (key, (list(counts), total[0]))
+                for key, (counts, total) in self.histograms.items()
+            )
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), (counts, total) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            bounds = [*(repr(bound) for bound in self.buckets), "+Inf"]
+            for bound, count in zip(bounds, counts, strict=True):
+                cumulative += count
+                bucket_labels = format_labels((*labels, ("le", bound)))
+                lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total!r}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        return "".join(f"{line}\n" for line in lines)
+
+
+class LoggingSink(BaseMetricsSink):
+    """Log each metric to the stagedoor.metrics logger at INFO level."""
+
+    def increment(self, name: str, labels: dict[str, str], value: int = 1) -> None:
+        logger.info("%s%s +%d", name, format_labels(labels.items()), value)
+
+    def observe(self, name: str, labels: dict[str, str], seconds: float) -> None:
+        logger.info("%s%s %.6f", name, format_labels(labels.items()), seconds)
+
+
+class StatsDSink(BaseMetricsSink):
+    """Send metrics over UDP to the StatsD agent at STAGEDOOR_STATSD_HOST.
+
+    Label values are appended to the name, as in stagedoor_logins_total.sms.ok,
+    and timings are sent in milliseconds. Sending never blocks or raises, so
+    metrics are lost, not errors raised, while no agent is listening.
+    """
+
+    def __init__(self) -> None:
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def increment(self, name: str, labels: dict[str, str], value: int = 1) -> None:
+        self.send(f"{self.metric_name(name, labels)}:{value}|c")
+
+    def observe(self, name: str, labels: dict[str, str], seconds: float) -> None:
+        self.send(f"{self.metric_name(name, labels)}:{seconds * 1000:.3f}|ms")
+
+    @staticmethod
+    def metric_name(name: str, labels: dict[str, str]) -> str:
+        return ".".join([name, *labels.values()])
+
+    def send(self, line: str) -> None:
+        address = (stagedoor_settings.STATSD_HOST, stagedoor_settings.STATSD_PORT)
+        try:
+            self._socket.sendto(line.encode(), address)
+        except OSError:
+            pass
+
+
+def format_labels(labels: Iterable[tuple[str, str]]) -> str:
+    """Prometheus label syntax for (name, value) pairs, e.g. {channel="sms"}."""
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in labels]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def get_metrics_sink() -> BaseMetricsSink | None:
+    """The configured sink, or None if metrics are off."""
+    path = stagedoor_settings.METRICS_SINK
+    if path is None:
+        return None
+    return shared_instance(path)
+
+
+def increment(name: str, value: int = 1, **labels: str) -> None:
+    """Add value to the name counter."""
+    sink = get_metrics_sink()
+    if sink is not None:
+        sink.increment(name, labels, value)
+
+
+class Timing:
+    """How long a timer() block took, in seconds, once it has finished."""
+
+    elapsed = 0.0
+
+
+@contextmanager
+def timer(name: str, counter: str | None = None, **labels: str) -> Iterator[Timing]:
+    """Observe how long the block takes in the name histogram.
+
+    With counter, the block is also counted there, labelled result "ok", or
+    "error" if it raised. The block is timed even without a sink, for the
+    elapsed times that signals carry.
+    """
+    sink = get_metrics_sink()
+    timing = Timing()
+    started = time.perf_counter()
+    result = "error"
+    try:
+        yield timing
+        result = "ok"
+    finally:
+        timing.elapsed = time.perf_counter() - started
+        if sink is not None:
+            sink.observe(name, labels, timing.elapsed)
+            if counter:
+                sink.increment(counter, {**labels, "result": result})
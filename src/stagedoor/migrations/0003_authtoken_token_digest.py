@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-16 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("stagedoor", "0002_authtoken_approved"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="authtoken",
+            name="token_digest",
+            field=models.CharField(
+                blank=True, db_index=True, editable=False, max_length=64, null=True
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="authtoken",
+            constraint=models.UniqueConstraint(
+                fields=("email", "token_digest"), name="stagedoor_auth_email_digest"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="authtoken",
+            constraint=models.UniqueConstraint(
+                fields=("phone_number", "token_digest"),
+                name="stagedoor_auth_phone_digest",
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("stagedoor", "0003_authtoken_token_digest"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="authtoken",
+            index=models.Index(
+                fields=["phone_number", "token"], name="stagedoor_auth_phone_token_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("stagedoor", "0004_authtoken_phone_token_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Delivery",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "channel",
+                    models.CharField(
+                        choices=[("email", "Email"), ("sms", "SMS")], max_length=5
+                    ),
+                ),
+                ("recipient", models.CharField(max_length=254)),
+                (
+                    "auth_token",
+                    models.ForeignKey(
+                        blank=True,
+                        db_constraint=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        to="stagedoor.authtoken",
+                    ),
+                ),
+                ("next_url", models.CharField(blank=True, max_length=2000)),
+                ("domain", models.CharField(max_length=255)),
+                ("timestamp", models.DateTimeField(auto_now_add=True)),
+                ("expires_at", models.DateTimeField()),
+                ("claimed_until", models.DateTimeField(blank=True, null=True)),
+                ("attempts", models.PositiveSmallIntegerField(default=0)),
+                ("last_error", models.TextField(blank=True)),
+            ],
+            options={
+                "verbose_name_plural": "deliveries",
+            },
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("stagedoor", "0005_delivery"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="authtoken",
+            index=models.Index(
+                condition=models.Q(("approved", False)),
+                fields=["id"],
+                name="stagedoor_auth_pending_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:14
+
+from datetime import timedelta
+
+from django.db import migrations, models
+
+
+def set_expires_at(apps, schema_editor):
+    """Give existing tokens the expiry they had under STAGEDOOR_TOKEN_DURATION.
+
+    Rows are updated in primary key ranges of STAGEDOOR_PURGE_BATCH_SIZE, each
+    its own statement, so a large table is never locked as a whole. Tokens
+    waiting for approval keep no expiry, as they never expired before.
+    """
+    from stagedoor import settings as stagedoor_settings
+
+    AuthToken = apps.get_model("stagedoor", "AuthToken")
+    tokens = AuthToken.objects.using(schema_editor.connection.alias)
+    duration = timedelta(seconds=stagedoor_settings.TOKEN_DURATION)
+    expires_at = models.ExpressionWrapper(
+        models.F("timestamp") + duration, output_field=models.DateTimeField()
+    )
+    pending = tokens.filter(approved=True, expires_at__isnull=True).order_by("pk")
+    last_pk = 0
+    while True:
+        pks = list(
+            pending.filter(pk__gt=last_pk).values_list("pk", flat=True)[
+                : stagedoor_settings.PURGE_BATCH_SIZE
+            ]
+        )
+        if not pks:
+            return
+        pending.filter(pk__gt=last_pk, pk__lte=pks[-1]).update(expires_at=expires_at)
+        last_pk = pks[-1]
+
+
+class Migration(migrations.Migration):
+    # Each batch of the backfill commits on its own.
+    atomic = False
+
+    dependencies = [
+        ("stagedoor", "0006_authtoken_pending_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="authtoken",
+            name="expires_at",
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(set_expires_at, migrations.RunPython.noop),
+    ]
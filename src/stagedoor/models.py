@@ -1,13 +1,19 @@
 import logging
-from datetime import timedelta
+from datetime import datetime, timedelta
 from random import SystemRandom
+from typing import Any
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib.auth.models import AbstractBaseUser, AnonymousUser
-from django.db import models
+from django.core import signing
+from django.core.cache import caches
+from django.db import IntegrityError, connections, models, router, transaction
+from django.utils.crypto import salted_hmac
 from django.utils.timezone import now
 from phonenumber_field.modelfields import PhoneNumberField
 
+from . import metrics, signals
 from . import settings as stagedoor_settings
 
 logger = logging.getLogger(__name__)
@@ -60,8 +66,86 @@ class PhoneNumber(models.Model):
         return f"{self.phone_number}: {self.user} (Maybe: {self.potential_user})"
 
 
+def supports_returning(connection) -> bool:
+    """Whether raw INSERT/DELETE ... RETURNING statements can be used."""
+    return (
+        connection.vendor in ("postgresql", "sqlite")
+        and connection.features.can_return_columns_from_insert
+    )
+
+
+def upsert_contact(
+    model: type[Email] | type[PhoneNumber], field_name: str, value: str
+) -> Email | PhoneNumber:
+    """Get or create the contact with this email address or phone number.
+
+    PostgreSQL and SQLite do this in one INSERT ... ON CONFLICT DO UPDATE ...
+    RETURNING statement, which returns the row whether or not it was already
+    there. Other databases use get_or_create().
+    """
+    connection = connections[router.db_for_write(model)]
+    if not supports_returning(connection):
+        return model.objects.get_or_create(**{field_name: value})[0]  # type: ignore[arg-type]
+    opts = model._meta
+    qn = connection.ops.quote_name
+    field = opts.get_field(field_name)
+    column = qn(field.column)  # type: ignore[union-attr,arg-type]
+    columns = ", ".join(qn(f.column) for f in opts.concrete_fields)  # type: ignore[arg-type]
+    sql = (
+        f"INSERT INTO {qn(opts.db_table)} ({column}) VALUES (%s) "
+        # A no-op update, so that RETURNING also gives back existing rows.
+        f"ON CONFLICT ({column}) DO UPDATE SET {column} = EXCLUDED.{column} "
+        f"RETURNING {columns}"
+    )
+    params = [field.get_db_prep_save(value, connection)]  # type: ignore[union-attr]
+    return next(iter(model.objects.using(connection.alias).raw(sql, params)))  # type: ignore[return-value]
+
+
+# Everything a login needs from a token, fetched in the same query.
+TOKEN_RELATED = (
+    "email__user",
+    "email__potential_user",
+    "phone_number__user",
+    "phone_number__potential_user",
+)
+
+
+class AuthTokenQuerySet(models.QuerySet):
+    def live(self) -> "AuthTokenQuerySet":
+        """Approved tokens that have not yet expired."""
+        return self.filter(approved=True, expires_at__gt=now())
+
+    def stale(self) -> "AuthTokenQuerySet":
+        """Tokens that have expired and are waiting to be purged.
+
+        Tokens waiting for approval without an expiry never go stale.
+        """
+        return self.filter(expires_at__lte=now())
+
+    def pending(self) -> "AuthTokenQuerySet":
+        """Tokens waiting for an admin to approve them, in the order requested."""
+        return self.filter(approved=False).order_by("pk")
+
+
+class AuthTokenManager(models.Manager):
+    def get_queryset(self) -> AuthTokenQuerySet:
+        return AuthTokenQuerySet(self.model, using=self._db)
+
+    def live(self) -> AuthTokenQuerySet:
+        return self.get_queryset().live()
+
+    def stale(self) -> AuthTokenQuerySet:
+        return self.get_queryset().stale()
+
+    def pending(self) -> AuthTokenQuerySet:
+        return self.get_queryset().pending()
+
+
 class AuthToken(models.Model):
     token = models.CharField(max_length=200, db_index=True)
+    token_digest = models.CharField(
+        max_length=64, null=True, blank=True, editable=False, db_index=True
+    )
     timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
     email = models.ForeignKey(Email, blank=True, null=True, on_delete=models.CASCADE)
     phone_number = models.ForeignKey(
@@ -69,18 +153,567 @@ class AuthToken(models.Model):
     )
     next_url = models.CharField(max_length=2000, blank=True)
     approved = models.BooleanField(default=True)
+    expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    objects = AuthTokenManager()
+
+    class Meta:
+        # A token string is only unique for its contact, so SMS codes entered
+        # with their phone number can repeat across numbers. save_new_token()
+        # keeps the rest apart from other contacts' unexpired tokens.
+        constraints = [
+            models.UniqueConstraint(
+                fields=["email", "token_digest"], name="stagedoor_auth_email_digest"
+            ),
+            models.UniqueConstraint(
+                fields=["phone_number", "token_digest"],
+                name="stagedoor_auth_phone_digest",
+            ),
+        ]
+        indexes = [
+            # SMS codes checked together with the phone number they were sent to.
+            models.Index(
+                fields=["phone_number", "token"], name="stagedoor_auth_phone_token_idx"
+            ),
+            # The few tokens waiting for approval, without scanning the rest, in
+            # the pk order pending() and the API page by. Databases without
+            # partial indexes skip it.
+            models.Index(
+                fields=["id"],
+                condition=models.Q(approved=False),
+                name="stagedoor_auth_pending_idx",
+            ),
+        ]
+
+    @classmethod
+    def token_filter(
+        cls,
+        token: str | int,
+        channel: str | None = None,
+        phone_number: str | None = None,
+    ) -> dict:
+        """Field lookups matching a token string, optionally for one channel.
+
+        channel is "email" or "sms"; None matches tokens for either. Passing
+        phone_number restricts the match to SMS codes sent to that number.
+        """
+        if stagedoor_settings.HASH_TOKENS:
+            lookups: dict = {"token_digest": hash_token(str(token))}
+        else:
+            lookups = {"token": str(token)}
+        if phone_number:
+            lookups["phone_number__phone_number"] = phone_number
+        elif channel == "email":
+            lookups["email__isnull"] = False
+        elif channel == "sms":
+            lookups["phone_number__isnull"] = False
+        return lookups
+
+    @classmethod
+    def lookup(
+        cls,
+        token: str | int,
+        channel: str | None = None,
+        phone_number: str | None = None,
+    ) -> "AuthToken | None":
+        """Find the live token matching a token string.
+
+        With STAGEDOOR_HASH_TOKENS this is a single equality probe on the
+        token_digest index, with no ORDER BY: save_new_token() keeps the
+        digests of live tokens that are looked up without their contact
+        distinct, and a contact's digests are unique.
+        """
+        matches = (
+            cls.objects.live()
+            .select_related(*TOKEN_RELATED)
+            .filter(**cls.token_filter(token, channel, phone_number))
+        )
+        return next(iter(matches[:1]), None)
+
+    @classmethod
+    async def alookup(
+        cls,
+        token: str | int,
+        channel: str | None = None,
+        phone_number: str | None = None,
+    ) -> "AuthToken | None":
+        """Async version of lookup()."""
+        matches = (
+            cls.objects.live()
+            .select_related(*TOKEN_RELATED)
+            .filter(**cls.token_filter(token, channel, phone_number))
+        )
+        async for token_object in matches[:1]:
+            return token_object
+        return None
+
+    @classmethod
+    def find(
+        cls,
+        token: str | int,
+        channel: str | None = None,
+        phone_number: str | None = None,
+    ) -> list["AuthToken"]:
+        """Every stored token matching a token string, live or not.
+
+        The same probe as lookup() without its live() conditions, so a caller
+        can tell from is_live() why a token can't be used, at no extra cost.
+        There is at most one live match; expired tokens that haven't been
+        purged may add a few more.
+        """
+        return list(
+            cls.objects.select_related(*TOKEN_RELATED).filter(
+                **cls.token_filter(token, channel, phone_number)
+            )
+        )
+
+    @classmethod
+    async def afind(
+        cls,
+        token: str | int,
+        channel: str | None = None,
+        phone_number: str | None = None,
+    ) -> list["AuthToken"]:
+        """Async version of find()."""
+        return [
+            token_object
+            async for token_object in cls.objects.select_related(*TOKEN_RELATED).filter(
+                **cls.token_filter(token, channel, phone_number)
+            )
+        ]
+
+    def is_expired(self) -> bool:
+        return self.expires_at is not None and self.expires_at <= now()
+
+    def is_live(self) -> bool:
+        """Whether the token can log someone in, as AuthTokenQuerySet.live()."""
+        return self.approved and self.expires_at is not None and not self.is_expired()
+
+    @classmethod
+    def consume(
+        cls,
+        token: str | int,
+        channel: str | None = None,
+        phone_number: str | None = None,
+    ) -> "AuthToken | None":
+        """Find the live token matching a token string and delete it, atomically.
+
+        Of any number of concurrent calls for the same token, exactly one gets
+        it back. PostgreSQL and SQLite do this in one DELETE ... RETURNING
+        statement; other databases lock the row with SELECT ... FOR UPDATE and
+        then delete it.
+        """
+        lookups = cls.token_filter(token, channel, phone_number)
+        connection = connections[router.db_for_write(cls)]
+        if supports_returning(connection):
+            token_object = cls._delete_returning(connection, lookups)
+            if token_object:
+                token_object._load_contacts()
+            return token_object
+        with transaction.atomic(using=connection.alias):
+            token_object = (
+                cls.objects.live()
+                .select_related(*TOKEN_RELATED)
+                .filter(**lookups)
+                .select_for_update(of=("self",))
+                .first()
+            )
+            if token_object:
+                cls.objects.filter(pk=token_object.pk).delete()
+            return token_object
+
+    @classmethod
+    async def aconsume(
+        cls,
+        token: str | int,
+        channel: str | None = None,
+        phone_number: str | None = None,
+    ) -> "AuthToken | None":
+        """Async version of consume().
+
+        The async ORM has neither raw queries nor transactions, so this runs
+        consume() in a worker thread.
+        """
+        return await sync_to_async(cls.consume)(token, channel, phone_number)
+
+    @classmethod
+    def _delete_returning(cls, connection, lookups: dict) -> "AuthToken | None":
+        opts = cls._meta
+        qn = connection.ops.quote_name
+        table = qn(opts.db_table)
+        pk = qn(opts.pk.column)
+        match = cls.objects.live().filter(**lookups).values("pk")[:1]
+        match_sql, params = match.query.get_compiler(connection=connection).as_sql()
+        columns = ", ".join(qn(field.column) for field in opts.concrete_fields)
+        sql = (
+            f"DELETE FROM {table} WHERE {pk} = ({match_sql}) "  # nosec B608
+            f"RETURNING {columns}"
+        )
+        return next(iter(cls.objects.using(connection.alias).raw(sql, params)), None)
+
+    def _insert_unless_taken(self, connection) -> bool:
+        """INSERT this token unless its digest is taken, returning whether it was.
+
+        Digests are unique per contact, see Meta.constraints. A single
+        INSERT ... ON CONFLICT DO NOTHING RETURNING, so a collision needs no
+        savepoint to recover from. Model signals are not sent.
+        """
+        opts = self._meta
+        qn = connection.ops.quote_name
+        fields = [field for field in opts.concrete_fields if not field.primary_key]
+        values = [
+            field.get_db_prep_save(field.pre_save(self, True), connection)
+            for field in fields
+        ]
+        sql = (
+            f"INSERT INTO {qn(opts.db_table)} "  # nosec B608
+            f"({', '.join(qn(field.column) for field in fields)}) "
+            f"VALUES ({', '.join(['%s'] * len(fields))}) "
+            f"ON CONFLICT DO NOTHING RETURNING {qn(opts.pk.column)}"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, values)
+            row = cursor.fetchone()
+        if row is None:
+            return False
+        self.pk = row[0]
+        self._state.adding = False
+        self._state.db = connection.alias
+        return True
+
+    def _load_contacts(self) -> None:
+        """Fetch this token's contacts and their users, one query per contact."""
+        for field, model in (("email", Email), ("phone_number", PhoneNumber)):
+            contact_id = getattr(self, f"{field}_id")
+            if contact_id:
+                contact = model.objects.select_related("user", "potential_user")
+                setattr(self, field, contact.filter(pk=contact_id).first())
+
+    async def _aload_contacts(self) -> None:
+        """Async version of _load_contacts()."""
+        for field, model in (("email", Email), ("phone_number", PhoneNumber)):
+            contact_id = getattr(self, f"{field}_id")
+            if contact_id:
+                contact = model.objects.select_related("user", "potential_user")
+                setattr(self, field, await contact.filter(pk=contact_id).afirst())
+
+    @classmethod
+    def from_signed(cls, value: str) -> "AuthToken | None":
+        """Rebuild an unsaved token from a signed email login link.
+
+        The link is checked by signature and age only. With
+        STAGEDOOR_SINGLE_USE_LINK, each link is also recorded in the
+        STAGEDOOR_SIGNED_LINK_CACHE cache until it expires, and is refused if it
+        has been seen before.
+        """
+        payload = cls._signed_payload(value)
+        if payload is None:
+            return None
+        if stagedoor_settings.SINGLE_USE_LINK and not caches[
+            stagedoor_settings.SIGNED_LINK_CACHE
+        ].add(*cls._signed_ledger_entry(value)):
+            return None
+        email = (
+            Email.objects.select_related("user", "potential_user")
+            .filter(pk=payload["e"])
+            .first()
+        )
+        return cls._from_signed_payload(value, payload, email)
+
+    @classmethod
+    async def afrom_signed(cls, value: str) -> "AuthToken | None":
+        """Async version of from_signed()."""
+        payload = cls._signed_payload(value)
+        if payload is None:
+            return None
+        if stagedoor_settings.SINGLE_USE_LINK and not await caches[
+            stagedoor_settings.SIGNED_LINK_CACHE
+        ].aadd(*cls._signed_ledger_entry(value)):
+            return None
+        email = (
+            await Email.objects.select_related("user", "potential_user")
+            .filter(pk=payload["e"])
+            .afirst()
+        )
+        return cls._from_signed_payload(value, payload, email)
+
+    @staticmethod
+    def _signed_payload(value: str) -> dict | None:
+        try:
+            return signing.TimestampSigner(salt=SIGNED_LINK_SALT).unsign_object(
+                value, max_age=token_duration(sms=False)
+            )
+        except signing.BadSignature:
+            return None
+
+    @staticmethod
+    def _signed_ledger_entry(value: str) -> tuple[str, bool, int]:
+        return (
+            f"stagedoor:used:{hash_token(value)}",
+            True,
+            token_duration(sms=False),
+        )
 
     @classmethod
-    def delete_stale(cls) -> None:
-        """Delete stale tokens; tokens that are more than TOKEN_DURATION seconds old"""
-        cls.objects.filter(
-            timestamp__lt=now() - timedelta(seconds=stagedoor_settings.TOKEN_DURATION)
-        ).delete()
+    def _from_signed_payload(
+        cls, value: str, payload: dict, email: Email | None
+    ) -> "AuthToken | None":
+        if not email:
+            return None
+        token = cls(email=email, next_url=payload.get("n", ""))
+        token._raw_token = value
+        return token
+
+    @classmethod
+    def backfill_digests(cls, batch_size: int | None = None) -> int:
+        """Fill in token_digest for rows created before digests were stored.
+
+        Rows are walked in primary key order, batch_size at a time. If
+        STAGEDOOR_HASH_TOKENS is set the plaintext token is cleared as well.
+        Tokens whose string is shared with another row for the same contact are
+        ambiguous and are skipped. Returns the number of rows updated.
+        """
+        batch_size = batch_size or stagedoor_settings.PURGE_BATCH_SIZE
+        pending = cls.objects.filter(token_digest__isnull=True).exclude(token="")
+        last_pk = 0
+        updated = 0
+        while True:
+            batch = list(pending.filter(pk__gt=last_pk).order_by("pk")[:batch_size])
+            if not batch:
+                return updated
+            last_pk = batch[-1].pk
+            digests = {token.pk: hash_token(token.token) for token in batch}
+            taken = set()
+            for email_id, phone_number_id, digest in cls.objects.filter(
+                token_digest__in=digests.values()
+            ).values_list("email_id", "phone_number_id", "token_digest"):
+                taken.update(cls._digest_keys(email_id, phone_number_id, digest))
+            changed = []
+            for token in batch:
+                digest = digests[token.pk]
+                keys = cls._digest_keys(token.email_id, token.phone_number_id, digest)  # type: ignore[attr-defined]
+                if not taken.isdisjoint(keys):
+                    continue
+                taken.update(keys)
+                token.token_digest = digest
+                if stagedoor_settings.HASH_TOKENS:
+                    token.token = ""
+                changed.append(token)
+            updated += cls.objects.bulk_update(changed, ["token", "token_digest"])
+
+    @staticmethod
+    def _digest_keys(
+        email_id: int | None, phone_number_id: int | None, digest: str
+    ) -> set[tuple[str, int, str]]:
+        """The (contact, digest) pairs the unique constraints hold a token to."""
+        keys = set()
+        if email_id is not None:
+            keys.add(("email", email_id, digest))
+        if phone_number_id is not None:
+            keys.add(("phone_number", phone_number_id, digest))
+        return keys
+
+    @classmethod
+    def purge_stale(
+        cls, batch_size: int | None = None, max_batches: int | None = None
+    ) -> int:
+        """Delete stale tokens in chunks of at most batch_size rows.
+
+        Each chunk is its own short DELETE, so a large backlog of expired tokens
+        never holds a long lock on the table. With max_batches, stop after that
+        many chunks even if stale tokens remain. Returns the number of rows
+        removed.
+        """
+        batch_size = batch_size or stagedoor_settings.PURGE_BATCH_SIZE
+        stale = cls.objects.stale()
+        deleted = 0
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            pks = list(stale.values_list("pk", flat=True)[:batch_size])
+            if not pks:
+                break
+            count, _ = cls.objects.filter(pk__in=pks).delete()
+            deleted += count
+            batches += 1
+        if deleted:
+            metrics.increment("stagedoor_tokens_purged_total", deleted)
+        return deleted
+
+    @classmethod
+    async def apurge_stale(
+        cls, batch_size: int | None = None, max_batches: int | None = None
+    ) -> int:
+        """Async version of purge_stale()."""
+        batch_size = batch_size or stagedoor_settings.PURGE_BATCH_SIZE
+        stale = cls.objects.stale()
+        deleted = 0
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            pks = [pk async for pk in stale.values_list("pk", flat=True)[:batch_size]]
+            if not pks:
+                break
+            count, _ = await cls.objects.filter(pk__in=pks).adelete()
+            deleted += count
+            batches += 1
+        if deleted:
+            metrics.increment("stagedoor_tokens_purged_total", deleted)
+        return deleted
+
+    @classmethod
+    def delete_stale(cls) -> int:
+        """Delete stale tokens; tokens whose expires_at has passed.
+
+        Tokens waiting for approval are kept; see AuthTokenQuerySet.stale().
+        """
+        return cls.purge_stale()
+
+    @classmethod
+    async def adelete_stale(cls) -> int:
+        """Async version of delete_stale()."""
+        return await cls.apurge_stale()
+
+    @property
+    def login_token(self) -> str:
+        """The token string to send to the user."""
+        return getattr(self, "_raw_token", "") or self.token
+
+    def set_token(self, token: str) -> None:
+        """Assign a new token string.
+
+        The digest is always stored; the plaintext is only stored when
+        STAGEDOOR_HASH_TOKENS is off. Either way it stays available on this
+        instance as login_token so it can be delivered.
+        """
+        self._raw_token = token
+        self.token_digest = hash_token(token)
+        self.token = "" if stagedoor_settings.HASH_TOKENS else token
+
+    def set_expiry(self, start: datetime | None = None) -> None:
+        """Set expires_at to the token's lifetime after start, or now.
+
+        Approved tokens last STAGEDOOR_SMS_TOKEN_DURATION or
+        STAGEDOOR_EMAIL_TOKEN_DURATION, by channel. Tokens waiting for approval
+        last STAGEDOOR_PENDING_TOKEN_DURATION, or never expire if it is None.
+        """
+        start = start or now()
+        duration: int | None
+        if self.approved:
+            duration = token_duration(sms=self.phone_number_id is not None)  # type: ignore[attr-defined]
+        else:
+            duration = stagedoor_settings.PENDING_TOKEN_DURATION
+        self.expires_at = (
+            None if duration is None else start + timedelta(seconds=duration)
+        )
+
+    @classmethod
+    def from_db(cls, *args: Any, **kwargs: Any) -> "AuthToken":
+        token = super().from_db(*args, **kwargs)
+        if "approved" in token.__dict__:
+            token._approved_in_db = token.approved
+        return token
+
+    def save(self, *args, **kwargs) -> None:
+        if self._state.adding:
+            if self.expires_at is None:
+                self.set_expiry(self.timestamp)
+        elif self.approved and getattr(self, "_approved_in_db", True) is False:
+            # Approved by editing the row, e.g. in the admin: the token's
+            # lifetime starts now, as with BaseTokenStore.approve().
+            self.set_expiry()
+            update_fields = kwargs.get("update_fields")
+            if update_fields is not None and "approved" in update_fields:
+                kwargs["update_fields"] = {*update_fields, "expires_at"}
+        super().save(*args, **kwargs)
+        self._approved_in_db = self.approved
 
     def __str__(self) -> str:
         return self.timestamp.strftime("%Y-%m-%d %H:%M:%S")  # type: ignore
 
 
+class Delivery(models.Model):
+    """A login email or SMS waiting for the stagedoor_deliver worker.
+
+    No token string is kept. The worker gives the token a fresh one as it
+    sends the message, see stagedoor.helpers.send_delivery().
+    """
+
+    EMAIL = "email"
+    SMS = "sms"
+
+    channel = models.CharField(max_length=5, choices=[(EMAIL, "Email"), (SMS, "SMS")])
+    recipient = models.CharField(max_length=254)
+    # The token's row, or None for tokens that aren't stored as rows. There
+    # is no database constraint, so consuming or purging a token doesn't have
+    # to touch its messages; the worker drops messages whose token is gone.
+    auth_token = models.ForeignKey(
+        AuthToken,
+        blank=True,
+        null=True,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+    )
+    next_url = models.CharField(max_length=2000, blank=True)
+    domain = models.CharField(max_length=255)
+    timestamp = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+    claimed_until = models.DateTimeField(blank=True, null=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        verbose_name_plural = "deliveries"
+
+    def __str__(self) -> str:
+        return f"{self.channel} to {self.recipient}"
+
+    @classmethod
+    def purge_dead(cls, batch_size: int | None = None) -> int:
+        """Delete messages that expired or ran out of attempts, batch_size at a time.
+
+        Returns the number of rows removed.
+        """
+        batch_size = batch_size or stagedoor_settings.PURGE_BATCH_SIZE
+        dead = cls.objects.filter(
+            models.Q(expires_at__lte=now())
+            | models.Q(attempts__gte=stagedoor_settings.DELIVERY_MAX_ATTEMPTS)
+        )
+        deleted = 0
+        while True:
+            pks = list(dead.values_list("pk", flat=True)[:batch_size])
+            if not pks:
+                return deleted
+            count, _ = cls.objects.filter(pk__in=pks).delete()
+            deleted += count
+
+
+SIGNED_LINK_SALT = "stagedoor.login"
+
+
+def sign_login_token(email: Email, next_url: str = "") -> str:
+    """Build a stateless login token for an email address.
+
+    The token carries the Email id, the next URL and the time it was issued.
+    """
+    payload: dict[str, int | str] = {"e": email.pk}
+    if next_url:
+        payload["n"] = next_url
+    return signing.TimestampSigner(salt=SIGNED_LINK_SALT).sign_object(payload)
+
+
+def hash_token(token: str) -> str:
+    """Keyed SHA-256 digest of a token string, as stored in token_digest."""
+    return salted_hmac("stagedoor.token", token, algorithm="sha256").hexdigest()
+
+
+def token_duration(sms: bool) -> int:
+    """Seconds an approved token lasts on its channel."""
+    if sms:
+        duration = stagedoor_settings.SMS_TOKEN_DURATION
+    else:
+        duration = stagedoor_settings.EMAIL_TOKEN_DURATION
+    return stagedoor_settings.TOKEN_DURATION if duration is None else duration
+
+
 def generate_token_string(sms: bool = False) -> str:
     token_length = stagedoor_settings.EMAIL_TOKEN_LENGTH
     charset = "abcdefghijkmnopqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXYZ123456789"
@@ -92,45 +725,152 @@ def generate_token_string(sms: bool = False) -> str:
     return "".join([SystemRandom().choice(charset) for _ in range(token_length)])
 
 
+def needs_approval(contact: Email | PhoneNumber) -> bool:
+    """Whether a login for this contact must wait for an admin."""
+    return stagedoor_settings.REQUIRE_ADMIN_APPROVAL and not (
+        contact.user_id or contact.potential_user_id  # type: ignore[union-attr]
+    )
+
+
+def looked_up_without_contact(token: AuthToken) -> bool:
+    """Whether logins find the token by its string alone.
+
+    Email links always are. SMS codes are too, unless
+    STAGEDOOR_SMS_CODE_REQUIRES_CONTACT has them entered with their number.
+    """
+    return (
+        token.phone_number_id is None  # type: ignore[attr-defined]
+        or not stagedoor_settings.SMS_CODE_REQUIRES_CONTACT
+    )
+
+
+def digest_in_use(digest: str) -> bool:
+    """Whether a token that hasn't expired, for any contact, has this digest."""
+    return (
+        AuthToken.objects.filter(token_digest=digest)
+        .filter(models.Q(expires_at__isnull=True) | models.Q(expires_at__gt=now()))
+        .exists()
+    )
+
+
+def save_new_token(token: AuthToken, attempts: int = 3) -> None:
+    """Insert a new token, drawing a fresh string if its digest is taken.
+
+    The constraints only keep a digest unique for its contact. A token that
+    is looked up by its string alone also gets a fresh string while another
+    contact's unexpired token has the digest, so a lookup matches one token.
+    """
+    sms = token.phone_number_id is not None  # type: ignore[attr-defined]
+    if token.expires_at is None:
+        token.set_expiry(token.timestamp)
+    check_other_contacts = looked_up_without_contact(token)
+    connection = connections[router.db_for_write(AuthToken)]
+    returning = supports_returning(connection)
+    for _ in range(attempts):
+        if not (check_other_contacts and digest_in_use(token.token_digest)):  # type: ignore[arg-type]
+            if returning:
+                if token._insert_unless_taken(connection):
+                    return
+            else:
+                try:
+                    with transaction.atomic(using=connection.alias):
+                        token.save()
+                    return
+                except IntegrityError:
+                    pass
+        metrics.increment(
+            "stagedoor_token_collisions_total", channel="sms" if sms else "email"
+        )
+        token.set_token(generate_token_string(sms=sms))
+    raise IntegrityError("Could not find an unused token string.")
+
+
+def resolve_contact(
+    model: type[Email] | type[PhoneNumber],
+    field_name: str,
+    value: str,
+    authenticated: bool,
+) -> tuple[Email | PhoneNumber, bool]:
+    """The contact for value, and whether it was just created.
+
+    Only a logged-in user's request needs to know if the contact is new, so
+    anonymous requests use the single-statement upsert_contact() and report
+    False.
+    """
+    if authenticated:
+        return model.objects.get_or_create(**{field_name: value})  # type: ignore[arg-type]
+    return upsert_contact(model, field_name, value), False
+
+
 def generate_token(
     email: str | None = None,
     phone_number: str | None = None,
     next_url: str | None = None,
     user: AbstractBaseUser | AnonymousUser | None = None,
 ) -> AuthToken | None:
+    """Create and store a login token for an email address or phone number.
+
+    The contact is resolved and the token stored in one transaction. A
+    logged-in user asking for a token for an existing contact becomes its
+    potential_user, unless it belongs to someone else, in which case None is
+    returned.
+    """
+    if not email and not phone_number:
+        logger.error("Tried to generate a token for neither email nor sms")
+        return None
+
+    channel = "sms" if phone_number else "email"
+    with metrics.timer("stagedoor_token_issue_seconds", channel=channel) as timing:
+        token = _generate_token(email, phone_number, next_url, user)
+    if token is not None:
+        metrics.increment("stagedoor_tokens_issued_total", channel=channel)
+        signals.token_issued.send(
+            sender=AuthToken, token=token, channel=channel, elapsed=timing.elapsed
+        )
+    return token
+
+
+def _generate_token(
+    email: str | None,
+    phone_number: str | None,
+    next_url: str | None,
+    user: AbstractBaseUser | AnonymousUser | None,
+) -> AuthToken | None:
+    authenticated = bool(user and user.is_authenticated)
     created = False
-    object: Email | PhoneNumber | None = None
     email_object: Email | None = None
     phone_number_object: PhoneNumber | None = None
-    token_string = ""
-    if email:
-        token_string = generate_token_string()
-        email_object, created = Email.objects.get_or_create(email=email)
-        object = email_object
-    if phone_number:
-        token_string = generate_token_string(sms=True)
-        phone_number_object, created = PhoneNumber.objects.get_or_create(
-            phone_number=phone_number,
-        )
-        object = phone_number_object
-    if not object:
-        logger.error("Tried to generate a token for neither email nor sms")
-        return None
+    with transaction.atomic(savepoint=False):
+        if email:
+            email_object, created = resolve_contact(  # type: ignore[assignment]
+                Email, "email", email, authenticated
+            )
+        if phone_number:
+            phone_number_object, created = resolve_contact(  # type: ignore[assignment]
+                PhoneNumber, "phone_number", phone_number, authenticated
+            )
+        contact: Email | PhoneNumber = phone_number_object or email_object  # type: ignore[assignment]
 
-    token = AuthToken(
-        token=token_string,
-        email=email_object,
-        phone_number=phone_number_object,
-        next_url=next_url or "",
-    )
+        if authenticated and not created:
+            if contact.user_id and contact.user_id != user.pk:  # type: ignore[union-attr]
+                return None
+            if isinstance(user, AbstractBaseUser):
+                contact.potential_user = user
+                contact.save(update_fields=["potential_user"])
 
-    if (not user or not user.is_authenticated) or created:
-        token.save()
-        return token
-    if object.user and object.user != user:
-        return None
-    else:
-        if isinstance(user, AbstractBaseUser):
-            object.potential_user = user
-            object.save()
+        token = AuthToken(
+            email=email_object,
+            phone_number=phone_number_object,
+            next_url=next_url or "",
+            approved=not needs_approval(contact),
+        )
+        token.set_expiry()
+        token.set_token(generate_token_string(sms=bool(phone_number_object)))
+        if email_object and stagedoor_settings.SIGNED_LINKS and token.approved:
+            # Signed links are not stored at all.
+            token.set_token(sign_login_token(email_object, next_url or ""))
+            return token
+        from .stores import get_token_store
+
+        get_token_store().save(token)
         return token
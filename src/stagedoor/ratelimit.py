@@ -0,0 +1,257 @@
+"""
+Rate limits and lockouts kept in Django's cache framework.
+
+Each rate limit is a (requests, seconds) pair. Counts are kept in fixed windows
+of that many seconds, and the previous window's count is weighted by how much
+of it still overlaps the sliding window, which needs two cache keys per limit
+instead of a timestamp per request.
+
+Lockouts count failed token attempts instead, and lock the client or contact
+out for a period that doubles each time the limit is reached again.
+
+The ``a``-prefixed functions do the same through the cache's async methods,
+for the async views.
+"""
+
+import hashlib
+import time
+
+from django.core.cache import caches
+from django.http import HttpRequest
+from phonenumber_field.phonenumber import to_python
+
+from . import settings as stagedoor_settings
+
+Rate = tuple[int, int]
+
+
+def _cache_key(scope: str, value: str, suffix: object) -> str:
+    # Hash the value so contacts stay out of the cache and keys stay short.
+    digest = hashlib.sha256(value.encode()).hexdigest()
+    return f"stagedoor:rate:{scope}:{digest}:{suffix}"
+
+
+def normalize_contact(contact: str) -> str:
+    """The form of an email address or phone number that limits are keyed by.
+
+    Email addresses are lowercased and phone numbers written as E.164, so
+    that every spelling of a contact counts against the same limit. Numbers
+    that don't parse, and so can't match a token either, only lose their
+    whitespace.
+    """
+    contact = contact.strip()
+    if "@" in contact:
+        return contact.lower()
+    parsed = to_python(contact)
+    if parsed and parsed.is_valid():
+        return parsed.as_e164
+    return "".join(contact.split())
+
+
+def _window(scope: str, value: str, period: int) -> tuple[str, str, float]:
+    # The current and previous windows' keys, and the share of the previous
+    # window that still overlaps the sliding one.
+    now = time.time()
+    window = int(now // period)
+    return (
+        _cache_key(scope, value, window),
+        _cache_key(scope, value, window - 1),
+        1 - (now % period) / period,
+    )
+
+
+def hit(scope: str, value: str, rate: Rate | None) -> bool:
+    """Count a request against a limit, returning False if it is over it.
+
+    Requests that are turned away are not counted, so a client that keeps
+    retrying is let back in once its earlier requests slide out of the window.
+    """
+    if not rate:
+        return True
+    limit, period = rate
+    cache = caches[stagedoor_settings.RATE_LIMIT_CACHE]
+    current_key, previous_key, overlap = _window(scope, value, period)
+
+    counts = cache.get_many([current_key, previous_key])
+    estimate = counts.get(previous_key, 0) * overlap + counts.get(current_key, 0)
+    if estimate >= limit:
+        return False
+
+    if not cache.add(current_key, 1, timeout=2 * period):
+        try:
+            cache.incr(current_key)
+        except ValueError:
+            # The key expired between add() and incr().
+            cache.set(current_key, 1, timeout=2 * period)
+    return True
+
+
+async def ahit(scope: str, value: str, rate: Rate | None) -> bool:
+    """Async version of hit(), using the cache's async methods."""
+    if not rate:
+        return True
+    limit, period = rate
+    cache = caches[stagedoor_settings.RATE_LIMIT_CACHE]
+    current_key, previous_key, overlap = _window(scope, value, period)
+
+    counts = await cache.aget_many([current_key, previous_key])
+    estimate = counts.get(previous_key, 0) * overlap + counts.get(current_key, 0)
+    if estimate >= limit:
+        return False
+
+    if not await cache.aadd(current_key, 1, timeout=2 * period):
+        try:
+            await cache.aincr(current_key)
+        except ValueError:
+            await cache.aset(current_key, 1, timeout=2 * period)
+    return True
+
+
+def client_ip(request: HttpRequest) -> str:
+    """The client address from STAGEDOOR_CLIENT_IP_HEADER.
+
+    For a forwarded header holding a list of addresses, the last one (added
+    by the nearest proxy) is used, since the others can be set by the client.
+    """
+    value = request.META.get(stagedoor_settings.CLIENT_IP_HEADER, "")
+    return value.rsplit(",", 1)[-1].strip()
+
+
+def login_allowed(request: HttpRequest, contact: str) -> bool:
+    """Check and count a login request against the per-IP and per-contact limits."""
+    if not hit("login-ip", client_ip(request), stagedoor_settings.LOGIN_RATE_PER_IP):
+        return False
+    return hit(
+        "login-contact",
+        normalize_contact(contact),
+        stagedoor_settings.LOGIN_RATE_PER_CONTACT,
+    )
+
+
+async def alogin_allowed(request: HttpRequest, contact: str) -> bool:
+    """Async version of login_allowed()."""
+    if not await ahit(
+        "login-ip", client_ip(request), stagedoor_settings.LOGIN_RATE_PER_IP
+    ):
+        return False
+    return await ahit(
+        "login-contact",
+        normalize_contact(contact),
+        stagedoor_settings.LOGIN_RATE_PER_CONTACT,
+    )
+
+
+def _token_lockouts(
+    request: HttpRequest, contact: str | None
+) -> list[tuple[str, str, int]]:
+    lockouts = []
+    if limit := stagedoor_settings.TOKEN_FAILURES_PER_IP:
+        lockouts.append(("token-ip", client_ip(request), limit))
+    if contact and (limit := stagedoor_settings.TOKEN_FAILURES_PER_CONTACT):
+        lockouts.append(("token-contact", normalize_contact(contact), limit))
+    return lockouts
+
+
+def _lockout(failures: int, limit: int) -> int:
+    lockout = stagedoor_settings.TOKEN_LOCKOUT * 2 ** (failures // limit - 1)
+    return min(lockout, stagedoor_settings.TOKEN_LOCKOUT_MAX)
+
+
+def token_attempt_allowed(request: HttpRequest, contact: str | None = None) -> bool:
+    """Whether the client, or the contact the code was sent to, is locked out.
+
+    This is a single cache read, so it can run before any token query.
+    """
+    lockouts = _token_lockouts(request, contact)
+    if not lockouts:
+        return True
+    cache = caches[stagedoor_settings.RATE_LIMIT_CACHE]
+    return not cache.get_many(
+        [_cache_key(scope, value, "locked") for scope, value, _ in lockouts]
+    )
+
+
+async def atoken_attempt_allowed(
+    request: HttpRequest, contact: str | None = None
+) -> bool:
+    """Async version of token_attempt_allowed()."""
+    lockouts = _token_lockouts(request, contact)
+    if not lockouts:
+        return True
+    cache = caches[stagedoor_settings.RATE_LIMIT_CACHE]
+    return not await cache.aget_many(
+        [_cache_key(scope, value, "locked") for scope, value, _ in lockouts]
+    )
+
+
+def token_attempt_failed(request: HttpRequest, contact: str | None = None) -> None:
+    """Count a wrong token, locking out whoever reached their limit.
+
+    The first lockout lasts STAGEDOOR_TOKEN_LOCKOUT seconds and each one after
+    it twice as long as the last, up to STAGEDOOR_TOKEN_LOCKOUT_MAX. Failures
+    are remembered for STAGEDOOR_TOKEN_LOCKOUT_MAX seconds.
+    """
+    cache = caches[stagedoor_settings.RATE_LIMIT_CACHE]
+    longest = stagedoor_settings.TOKEN_LOCKOUT_MAX
+    for scope, value, limit in _token_lockouts(request, contact):
+        key = _cache_key(scope, value, "failures")
+        if cache.add(key, 1, timeout=longest):
+            failures = 1
+        else:
+            try:
+                failures = cache.incr(key)
+            except ValueError:
+                cache.set(key, 1, timeout=longest)
+                failures = 1
+        if failures % limit == 0:
+            cache.set(
+                _cache_key(scope, value, "locked"),
+                True,
+                timeout=_lockout(failures, limit),
+            )
+
+
+async def atoken_attempt_failed(
+    request: HttpRequest, contact: str | None = None
+) -> None:
+    """Async version of token_attempt_failed()."""
+    cache = caches[stagedoor_settings.RATE_LIMIT_CACHE]
+    longest = stagedoor_settings.TOKEN_LOCKOUT_MAX
+    for scope, value, limit in _token_lockouts(request, contact):
+        key = _cache_key(scope, value, "failures")
+        if await cache.aadd(key, 1, timeout=longest):
+            failures = 1
+        else:
+            try:
+                failures = await cache.aincr(key)
+            except ValueError:
+                await cache.aset(key, 1, timeout=longest)
+                failures = 1
+        if failures % limit == 0:
+            await cache.aset(
+                _cache_key(scope, value, "locked"),
+                True,
+                timeout=_lockout(failures, limit),
+            )
+
+
+def token_attempt_succeeded(request: HttpRequest, contact: str | None = None) -> None:
+    """Forget the failed attempts against the contact after a successful login.
+
+    Failures from the client's address are kept, so logging in to an account
+    of one's own doesn't reset the count for guesses at other accounts.
+    """
+    if contact and stagedoor_settings.TOKEN_FAILURES_PER_CONTACT:
+        caches[stagedoor_settings.RATE_LIMIT_CACHE].delete(
+            _cache_key("token-contact", normalize_contact(contact), "failures")
+        )
+
+
+async def atoken_attempt_succeeded(
+    request: HttpRequest, contact: str | None = None
+) -> None:
+    """Async version of token_attempt_succeeded()."""
+    if contact and stagedoor_settings.TOKEN_FAILURES_PER_CONTACT:
+        await caches[stagedoor_settings.RATE_LIMIT_CACHE].adelete(
+            _cache_key("token-contact", normalize_contact(contact), "failures")
+        )
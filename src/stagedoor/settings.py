@@ -2,6 +2,17 @@ from django.conf import settings
 
 TOKEN_DURATION = getattr(settings, "STAGEDOOR_TOKEN_DURATION", 30 * 60)
 
+# Per-channel lifetimes of new tokens; None uses STAGEDOOR_TOKEN_DURATION.
+EMAIL_TOKEN_DURATION = getattr(settings, "STAGEDOOR_EMAIL_TOKEN_DURATION", None)
+
+SMS_TOKEN_DURATION = getattr(settings, "STAGEDOOR_SMS_TOKEN_DURATION", None)
+
+PURGE_ON_LOOKUP = getattr(settings, "STAGEDOOR_PURGE_ON_LOOKUP", True)
+
+PURGE_BATCH_SIZE = getattr(settings, "STAGEDOOR_PURGE_BATCH_SIZE", 1000)
+
+HASH_TOKENS = getattr(settings, "STAGEDOOR_HASH_TOKENS", False)
+
 EMAIL_TOKEN_LENGTH = getattr(settings, "STAGEDOOR_EMAIL_TOKEN_LENGTH", 8)
 
 SMS_TOKEN_LENGTH = getattr(settings, "STAGEDOOR_SMS_TOKEN_LENGTH", 6)
@@ -25,8 +36,51 @@ SUPPORT_EMAIL = getattr(
     settings, "STAGEDOOR_SUPPORT_EMAIL", settings.DEFAULT_FROM_EMAIL
 )
 
+SMS_CODE_REQUIRES_CONTACT = getattr(
+    settings, "STAGEDOOR_SMS_CODE_REQUIRES_CONTACT", False
+)
+
 SINGLE_USE_LINK = getattr(settings, "STAGEDOOR_SINGLE_USE_LINK", False)
 
+ASYNC_DELIVERY = getattr(settings, "STAGEDOOR_ASYNC_DELIVERY", False)
+
+DELIVERY_BATCH_SIZE = getattr(settings, "STAGEDOOR_DELIVERY_BATCH_SIZE", 100)
+
+DELIVERY_MAX_ATTEMPTS = getattr(settings, "STAGEDOOR_DELIVERY_MAX_ATTEMPTS", 5)
+
+# Seconds a worker has to send the messages it claimed before others may retry.
+DELIVERY_LEASE = getattr(settings, "STAGEDOOR_DELIVERY_LEASE", 300)
+
+EMAIL_BATCH_SIZE = getattr(settings, "STAGEDOOR_EMAIL_BATCH_SIZE", 100)
+
+RATE_LIMIT_CACHE = getattr(settings, "STAGEDOOR_RATE_LIMIT_CACHE", "default")
+
+LOGIN_RATE_PER_IP = getattr(settings, "STAGEDOOR_LOGIN_RATE_PER_IP", None)
+
+LOGIN_RATE_PER_CONTACT = getattr(settings, "STAGEDOOR_LOGIN_RATE_PER_CONTACT", None)
+
+TOKEN_FAILURES_PER_IP = getattr(settings, "STAGEDOOR_TOKEN_FAILURES_PER_IP", None)
+
+TOKEN_FAILURES_PER_CONTACT = getattr(
+    settings, "STAGEDOOR_TOKEN_FAILURES_PER_CONTACT", None
+)
+
+TOKEN_LOCKOUT = getattr(settings, "STAGEDOOR_TOKEN_LOCKOUT", 60)
+
+TOKEN_LOCKOUT_MAX = getattr(settings, "STAGEDOOR_TOKEN_LOCKOUT_MAX", 24 * 60 * 60)
+
+CLIENT_IP_HEADER = getattr(settings, "STAGEDOOR_CLIENT_IP_HEADER", "REMOTE_ADDR")
+
+TOKEN_STORE = getattr(
+    settings, "STAGEDOOR_TOKEN_STORE", "stagedoor.stores.DatabaseTokenStore"
+)
+
+TOKEN_CACHE = getattr(settings, "STAGEDOOR_TOKEN_CACHE", "default")
+
+SIGNED_LINKS = getattr(settings, "STAGEDOOR_SIGNED_LINKS", False)
+
+SIGNED_LINK_CACHE = getattr(settings, "STAGEDOOR_SIGNED_LINK_CACHE", "default")
+
 EMAIL_HTML_TEMPLATE = getattr(
     settings, "STAGEDOOR_EMAIL_HTML_TEMPLATE", "stagedoor_email.html"
 )
@@ -59,8 +113,24 @@ ENABLE_EMAIL = getattr(settings, "STAGEDOOR_ENABLE_EMAIL_OVERRIDE", False) or (
     and hasattr(settings, "EMAIL_HOST_PASSWORD")
 )
 
+SMS_TRANSPORT = getattr(
+    settings, "STAGEDOOR_SMS_TRANSPORT", "stagedoor.sms.TwilioTransport"
+)
+
+SMS_HTTP_URL = getattr(settings, "STAGEDOOR_SMS_HTTP_URL", "http://localhost:8025/sms")
+
+SMS_HTTP_TIMEOUT = getattr(settings, "STAGEDOOR_SMS_HTTP_TIMEOUT", 10)
+
 SITE_NAME = getattr(settings, "STAGEDOOR_SITE_NAME", "Django")
 
 DISABLE_USER_CREATION = getattr(settings, "STAGEDOOR_DISABLE_USER_CREATION", False)
 
 REQUIRE_ADMIN_APPROVAL = getattr(settings, "STAGEDOOR_REQUIRE_ADMIN_APPROVAL", False)
+
+PENDING_TOKEN_DURATION = getattr(settings, "STAGEDOOR_PENDING_TOKEN_DURATION", None)
+
+METRICS_SINK = getattr(settings, "STAGEDOOR_METRICS_SINK", None)
+
+STATSD_HOST = getattr(settings, "STAGEDOOR_STATSD_HOST", "127.0.0.1")
+
+STATSD_PORT = getattr(settings, "STAGEDOOR_STATSD_PORT", 8125)
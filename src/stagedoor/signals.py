@@ -0,0 +1,67 @@
+"""Signals sent through a login token's life.
+
+Every signal but user_created_via_stagedoor is sent with the AuthToken class as
+sender. Each carries elapsed, the seconds the step took by time.perf_counter(),
+so receivers can aggregate latency without wrapping stagedoor's internals.
+channel is "email" or "sms", or "any" for rejections by a backend that accepts
+both.
+
+token_issued(token, channel, elapsed)
+    generate_token() stored a new token, or signed a link. token.approved is
+    False while it waits for an admin.
+
+token_delivered(token, channel, elapsed)
+    A login email or SMS was handed to the mail backend or SMS transport.
+
+token_delivery_failed(token, channel, error, elapsed)
+    Sending a login email or SMS raised error. Emails sent in chunks report
+    every token of a failed chunk, with error None if the mail backend only
+    reported fewer messages sent.
+
+token_consumed(token, user, channel, elapsed)
+    TokenBackend logged user in with token. elapsed covers the token lookup
+    and the login.
+
+token_rejected(channel, reason, elapsed)
+    TokenBackend refused a token, for one of REJECTION_REASONS. The reason
+    comes from the rows the login fetched anyway, so rejecting a token costs
+    no extra queries. A token that a backend can't find is left to any token
+    backend listed after it in AUTHENTICATION_BACKENDS, so a login is
+    rejected once at most.
+
+user_created_via_stagedoor(user, token, elapsed)
+    A login created user, with elapsed covering the user's creation. The
+    sender is the user model. TokenBackend sends it inside the login's
+    transaction, so use transaction.on_commit() for side effects.
+
+Receivers run synchronously in the request, so keep them quick.
+"""
+
+from django.dispatch import Signal
+
+REJECTED_UNKNOWN = "unknown"
+REJECTED_EXPIRED = "expired"
+REJECTED_UNAPPROVED = "unapproved"
+REJECTED_MISMATCH = "mismatch"
+
+# unknown: no stored token matched; it was never issued, was already used or
+# purged, or is for another channel or phone number. Single-use tokens and
+# signed links that can't be used are always unknown.
+# expired: the token was found, but has expired.
+# unapproved: the token was found, but is waiting for an admin.
+# mismatch: the token is live but can't log anyone in, because its contact
+# belongs to another user or has no user while STAGEDOOR_DISABLE_USER_CREATION
+# is set.
+REJECTION_REASONS = (
+    REJECTED_UNKNOWN,
+    REJECTED_EXPIRED,
+    REJECTED_UNAPPROVED,
+    REJECTED_MISMATCH,
+)
+
+token_issued = Signal()
+token_delivered = Signal()
+token_delivery_failed = Signal()
+token_consumed = Signal()
+token_rejected = Signal()
+user_created_via_stagedoor = Signal()
@@ -0,0 +1,138 @@
+"""Pluggable SMS transports.
+
+STAGEDOOR_SMS_TRANSPORT names the transport class to use. The transport is
+shared by stagedoor.loading.shared_instance().
+"""
+
+import json
+import sys
+import threading
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from urllib.parse import SplitResult, urlsplit, urlunsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import settings as stagedoor_settings
+from .loading import shared_instance
+
+# Messages sent through LocmemTransport, for tests.
+outbox: list[dict[str, str]] = []
+
+
+class SMSError(Exception):
+    pass
+
+
+class BaseSMSTransport:
+    def send(self, to: str, body: str) -> None:
+        raise NotImplementedError
+
+    async def asend(self, to: str, body: str) -> None:
+        """Send from async code.
+
+        By default send() runs in a worker thread of its own rather than the
+        shared sync thread, so slow providers don't hold up other sync code.
+        Transports with a native async client can override this.
+        """
+        await sync_to_async(self.send, thread_sensitive=False)(to, body)
+
+
+class TwilioTransport(BaseSMSTransport):
+    """Send through Twilio, reusing one keep-alive HTTP client per thread.
+
+    Does nothing unless TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN and
+    TWILIO_NUMBER are all set.
+    """
+
+    def __init__(self) -> None:
+        self._local = threading.local()
+
+    def get_client(self):
+        credentials = (settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+        if getattr(self._local, "credentials", None) != credentials:
+            from twilio.http.http_client import TwilioHttpClient
+            from twilio.rest import Client
+
+            self._local.client = Client(
+                *credentials, http_client=TwilioHttpClient(pool_connections=True)
+            )
+            self._local.credentials = credentials
+        return self._local.client
+
+    def send(self, to: str, body: str) -> None:
+        if (
+            getattr(settings, "TWILIO_ACCOUNT_SID", None) is None
+            or getattr(settings, "TWILIO_AUTH_TOKEN", None) is None
+            or getattr(settings, "TWILIO_NUMBER", None) is None
+        ):
+            return
+        self.get_client().messages.create(
+            body=body, from_=settings.TWILIO_NUMBER, to=to
+        )
+
+
+class HTTPTransport(BaseSMSTransport):
+    """POST each message as JSON to STAGEDOOR_SMS_HTTP_URL, e.g. a local stub.
+
+    Each thread keeps its own keep-alive connection to the endpoint.
+    """
+
+    def __init__(self) -> None:
+        self._local = threading.local()
+
+    def get_connection(self, url: SplitResult) -> HTTPConnection:
+        if getattr(self._local, "netloc", None) != (url.scheme, url.netloc):
+            connection_class = (
+                HTTPSConnection if url.scheme == "https" else HTTPConnection
+            )
+            self._local.connection = connection_class(
+                url.netloc, timeout=stagedoor_settings.SMS_HTTP_TIMEOUT
+            )
+            self._local.netloc = (url.scheme, url.netloc)
+        return self._local.connection
+
+    def send(self, to: str, body: str) -> None:
+        url = urlsplit(stagedoor_settings.SMS_HTTP_URL)
+        path = urlunsplit(("", "", url.path or "/", url.query, ""))
+        payload = json.dumps({"to": to, "body": body})
+        for attempt in range(2):
+            connection = self.get_connection(url)
+            try:
+                connection.request(
+                    "POST", path, payload, {"Content-Type": "application/json"}
+                )
+                response = connection.getresponse()
+                response.read()
+                break
+            except (HTTPException, OSError):
+                # The server may have closed an idle connection; retry once.
+                connection.close()
+                self._local.netloc = None
+                if attempt:
+                    raise
+        if response.status >= 400:
+            raise SMSError(f"SMS endpoint returned HTTP {response.status}")
+
+
+class ConsoleTransport(BaseSMSTransport):
+    """Write messages to stdout instead of sending them."""
+
+    _lock = threading.Lock()
+
+    def send(self, to: str, body: str) -> None:
+        with self._lock:
+            sys.stdout.write(f"SMS to {to}:\n{body}\n{'-' * 79}\n")
+            sys.stdout.flush()
+
+
+class LocmemTransport(BaseSMSTransport):
+    """Keep messages in stagedoor.sms.outbox instead of sending them."""
+
+    def send(self, to: str, body: str) -> None:
+        outbox.append({"to": to, "body": body})
+
+
+def get_sms_transport() -> BaseSMSTransport:
+    """The configured transport."""
+    return shared_instance(stagedoor_settings.SMS_TRANSPORT)
@@ -0,0 +1,337 @@
+"""Pluggable token stores.
+
+STAGEDOOR_TOKEN_STORE names the store class that keeps login tokens.
+DatabaseTokenStore keeps every token as an AuthToken row. CacheTokenStore keeps
+tokens in the STAGEDOOR_TOKEN_CACHE cache instead, so they expire without a
+purge, and only tokens waiting for admin approval are stored as rows. The
+store is shared by stagedoor.loading.shared_instance().
+"""
+
+from datetime import datetime, timedelta, timezone
+from typing import Any
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.db.models import Case, Value, When
+from django.utils.timezone import now
+
+from . import metrics
+from . import settings as stagedoor_settings
+from .loading import shared_instance
+from .models import (
+    AuthToken,
+    generate_token_string,
+    hash_token,
+    save_new_token,
+    token_duration,
+)
+
+
+class BaseTokenStore:
+    def save(self, token: AuthToken) -> None:
+        """Store a new token, drawing a fresh string if its own is taken."""
+        raise NotImplementedError
+
+    def lookup(
+        self,
+        token: str | int,
+        channel: str | None = None,
+        phone_number: str | None = None,
+    ) -> AuthToken | None:
+        """Find the live token matching a token string.
+
+        Takes the same arguments as AuthToken.lookup().
+        """
+        raise NotImplementedError
+
+    def find(
+        self,
+        token: str | int,
+        channel: str | None = None,
+        phone_number: str | None = None,
+    ) -> list[AuthToken]:
+        """Every stored token matching a token string, live or not.
+
+        See AuthToken.find(). Stores that can't see tokens once they expire
+        only return a live one.
+        """
+        token_object = self.lookup(token, channel, phone_number)
+        return [token_object] if token_object else []
+
+    def consume(
+        self,
+        token: str | int,
+        channel: str | None = None,
+        phone_number: str | None = None,
+    ) -> AuthToken | None:
+        """Find the live token matching a token string and remove it.
+
+        Of any number of concurrent calls for the same token, only one gets it.
+        """
+        raise NotImplementedError
+
+    def approve(self, tokens: list[AuthToken]) -> None:
+        """Approve tokens that were waiting for an admin.
+
+        Each token's lifetime on its channel starts again from the approval.
+        Tokens whose string was only stored as a digest are given a new one,
+        so there is something to send.
+        """
+        raise NotImplementedError
+
+    def purge(self, max_batches: int | None = None) -> int:
+        """Remove expired tokens, returning how many were removed.
+
+        With max_batches, stop after that many STAGEDOOR_PURGE_BATCH_SIZE
+        chunks, so a purge from a request does a bounded amount of work.
+        """
+        raise NotImplementedError
+
+    async def alookup(
+        self,
+        token: str | int,
+        channel: str | None = None,
+        phone_number: str | None = None,
+    ) -> AuthToken | None:
+        """Async version of lookup()."""
+        return await sync_to_async(self.lookup)(token, channel, phone_number)
+
+    async def afind(
+        self,
+        token: str | int,
+        channel: str | None = None,
+        phone_number: str | None = None,
+    ) -> list[AuthToken]:
+        """Async version of find()."""
+        token_object = await self.alookup(token, channel, phone_number)
+        return [token_object] if token_object else []
+
+    async def aconsume(
+        self,
+        token: str | int,
+        channel: str | None = None,
+        phone_number: str | None = None,
+    ) -> AuthToken | None:
+        """Async version of consume()."""
+        return await sync_to_async(self.consume)(token, channel, phone_number)
+
+    async def apurge(self, max_batches: int | None = None) -> int:
+        """Async version of purge()."""
+        return await sync_to_async(self.purge)(max_batches)
+
+    @staticmethod
+    def reissue(tokens: list[AuthToken]) -> list[AuthToken]:
+        """Give the tokens that have no plaintext a fresh string, returning them."""
+        reissued = [token for token in tokens if not token.login_token]
+        for token in reissued:
+            token.set_token(generate_token_string(sms=bool(token.phone_number_id)))  # type: ignore[attr-defined]
+        return reissued
+
+
+class DatabaseTokenStore(BaseTokenStore):
+    """Keep every token as an AuthToken row."""
+
+    def save(self, token: AuthToken) -> None:
+        save_new_token(token)
+
+    def lookup(self, token, channel=None, phone_number=None):
+        return AuthToken.lookup(token, channel, phone_number)
+
+    def find(self, token, channel=None, phone_number=None):
+        return AuthToken.find(token, channel, phone_number)
+
+    def consume(self, token, channel=None, phone_number=None):
+        return AuthToken.consume(token, channel, phone_number)
+
+    def approve(self, tokens: list[AuthToken]) -> None:
+        AuthToken.objects.bulk_update(self.reissue(tokens), ["token", "token_digest"])
+        approved_at = now()
+        AuthToken.objects.filter(pk__in=[token.pk for token in tokens]).update(
+            approved=True,
+            timestamp=approved_at,
+            expires_at=Case(
+                When(
+                    phone_number__isnull=False,
+                    then=Value(approved_at + timedelta(seconds=token_duration(True))),
+                ),
+                default=Value(approved_at + timedelta(seconds=token_duration(False))),
+            ),
+        )
+        for token in tokens:
+            token.approved = True
+            token.timestamp = approved_at
+            token.set_expiry(approved_at)
+
+    def purge(self, max_batches: int | None = None) -> int:
+        return AuthToken.purge_stale(max_batches=max_batches)
+
+    async def alookup(self, token, channel=None, phone_number=None):
+        return await AuthToken.alookup(token, channel, phone_number)
+
+    async def afind(self, token, channel=None, phone_number=None):
+        return await AuthToken.afind(token, channel, phone_number)
+
+    async def aconsume(self, token, channel=None, phone_number=None):
+        return await AuthToken.aconsume(token, channel, phone_number)
+
+    async def apurge(self, max_batches: int | None = None) -> int:
+        return await AuthToken.apurge_stale(max_batches=max_batches)
+
+
+class CacheTokenStore(BaseTokenStore):
+    """Keep approved tokens in the STAGEDOOR_TOKEN_CACHE cache.
+
+    Each token is one key, named after its digest, that expires when the token
+    does. Tokens waiting for admin approval are kept as AuthToken rows until
+    they are approved, when they move to the cache. A cache that evicts keys
+    before they expire, or isn't shared between processes, will lose tokens, so
+    use Redis or Memcached rather than the local-memory cache in production.
+
+    Removing a token relies on the cache's delete() reporting whether the key
+    existed, which Django's Redis and Memcached backends do atomically.
+    """
+
+    attempts = 3
+
+    @property
+    def cache(self):
+        return caches[stagedoor_settings.TOKEN_CACHE]
+
+    @staticmethod
+    def key(digest: str) -> str:
+        return f"stagedoor:token:{digest}"
+
+    def save(self, token: AuthToken) -> None:
+        if not token.approved:
+            save_new_token(token)
+            return
+        token.timestamp = token.timestamp or now()
+        if token.expires_at is None:
+            token.set_expiry(token.timestamp)
+        sms = token.phone_number_id is not None  # type: ignore[attr-defined]
+        for _ in range(self.attempts):
+            timeout = self._timeout(token)
+            # A token that has already expired is not stored at all.
+            if timeout <= 0 or self.cache.add(
+                self.key(token.token_digest), self._entry(token), timeout=timeout
+            ):
+                return
+            metrics.increment(
+                "stagedoor_token_collisions_total", channel="sms" if sms else "email"
+            )
+            token.set_token(generate_token_string(sms=sms))
+        raise IntegrityError("Could not find an unused token string.")
+
+    def lookup(self, token, channel=None, phone_number=None):
+        key = self.key(hash_token(str(token)))
+        entry = self.cache.get(key)
+        if not self._matches(entry, channel, phone_number):
+            return None
+        token_object = self._token(str(token), entry)
+        token_object._load_contacts()
+        return token_object
+
+    def consume(self, token, channel=None, phone_number=None):
+        key = self.key(hash_token(str(token)))
+        entry = self.cache.get(key)
+        if not self._matches(entry, channel, phone_number) or not self.cache.delete(
+            key
+        ):
+            return None
+        token_object = self._token(str(token), entry)
+        token_object._load_contacts()
+        return token_object
+
+    def approve(self, tokens: list[AuthToken]) -> None:
+        self.reissue(tokens)
+        with transaction.atomic():
+            AuthToken.objects.filter(pk__in=[token.pk for token in tokens]).delete()
+            for token in tokens:
+                if not token.token_digest:
+                    # Stored before digests were, so it has its plaintext.
+                    token.set_token(token.login_token)
+                token.pk = None
+                token.approved = True
+                token.timestamp = now()
+                token.set_expiry(token.timestamp)
+                self.save(token)
+
+    def purge(self, max_batches: int | None = None) -> int:
+        # The cache expires tokens by itself. Stale tokens that were never
+        # approved are left to the stagedoor_purge command.
+        return 0
+
+    async def alookup(self, token, channel=None, phone_number=None):
+        key = self.key(hash_token(str(token)))
+        entry = await self.cache.aget(key)
+        if not self._matches(entry, channel, phone_number):
+            return None
+        token_object = self._token(str(token), entry)
+        await token_object._aload_contacts()
+        return token_object
+
+    async def aconsume(self, token, channel=None, phone_number=None):
+        key = self.key(hash_token(str(token)))
+        entry = await self.cache.aget(key)
+        if not self._matches(entry, channel, phone_number) or not (
+            await self.cache.adelete(key)
+        ):
+            return None
+        token_object = self._token(str(token), entry)
+        await token_object._aload_contacts()
+        return token_object
+
+    async def apurge(self, max_batches: int | None = None) -> int:
+        return 0
+
+    @staticmethod
+    def _timeout(token: AuthToken) -> int:
+        """Seconds until the token expires."""
+        return int((token.expires_at - now()).total_seconds())  # type: ignore[operator]
+
+    @staticmethod
+    def _entry(token: AuthToken) -> dict[str, Any]:
+        return {
+            "email": token.email_id,  # type: ignore[attr-defined]
+            "phone_number": token.phone_number_id,  # type: ignore[attr-defined]
+            "number": token.phone_number.phone_number.as_e164  # type: ignore[union-attr]
+            if token.phone_number
+            else None,
+            "next_url": token.next_url,
+            "timestamp": token.timestamp.timestamp(),
+            "expires_at": token.expires_at.timestamp(),  # type: ignore[union-attr]
+        }
+
+    @staticmethod
+    def _matches(
+        entry: dict[str, Any] | None, channel: str | None, phone_number: str | None
+    ) -> bool:
+        """Whether a cache entry is one AuthToken.token_filter() would match."""
+        if entry is None:
+            return False
+        if phone_number:
+            return entry["number"] == phone_number
+        if channel == "email":
+            return entry["email"] is not None
+        if channel == "sms":
+            return entry["phone_number"] is not None
+        return True
+
+    @staticmethod
+    def _token(token: str, entry: dict[str, Any]) -> AuthToken:
+        """Rebuild an unsaved token from its cache entry."""
+        token_object = AuthToken(
+            email_id=entry["email"],
+            phone_number_id=entry["phone_number"],
+            next_url=entry["next_url"],
+            timestamp=datetime.fromtimestamp(entry["timestamp"], tz=timezone.utc),
+            expires_at=datetime.fromtimestamp(entry["expires_at"], tz=timezone.utc),
+        )
+        token_object.set_token(token)
+        return token_object
+
+
+def get_token_store() -> BaseTokenStore:
+    """The configured store."""
+    return shared_instance(stagedoor_settings.TOKEN_STORE)
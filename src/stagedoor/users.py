@@ -0,0 +1,48 @@
+from dataclasses import dataclass
+from functools import cache
+
+from django.apps import apps
+from django.conf import settings
+from django.db.models import Model
+
+
+@dataclass(frozen=True)
+class UserModelFields:
+    """Which of the fields stagedoor fills in exist on the user model."""
+
+    model: type[Model]
+    field_names: frozenset[str]
+
+    @property
+    def has_username(self) -> bool:
+        return "username" in self.field_names
+
+    @property
+    def has_email(self) -> bool:
+        return "email" in self.field_names
+
+    @property
+    def has_phone_number(self) -> bool:
+        return "phone_number" in self.field_names
+
+
+@cache
+def _describe(user_model: str) -> UserModelFields:
+    model = apps.get_model(user_model, require_ready=False)
+    return UserModelFields(
+        model=model,
+        field_names=frozenset(
+            field.name for field in model._meta.get_fields(include_hidden=True)
+        ),
+    )
+
+
+def user_model_fields() -> UserModelFields:
+    """Describe the active user model, computing it once per model."""
+    return _describe(settings.AUTH_USER_MODEL)
+
+
+def clear_user_model_fields(*, setting: str, **kwargs) -> None:
+    """setting_changed receiver that forgets the cached description."""
+    if setting == "AUTH_USER_MODEL":
+        _describe.cache_clear()
@@ -1,3 +1,4 @@
+from typing import Any
 from urllib.parse import parse_qs, urlparse
 
 from django import forms
@@ -8,7 +9,8 @@ from django.contrib.auth import logout as django_logout
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import ValidationError
 from django.core.validators import validate_email
-from django.http import HttpRequest, HttpResponse
+from django.db import transaction
+from django.http import Http404, HttpRequest, HttpResponse
 from django.shortcuts import redirect, render
 from django.urls import reverse
 from django.utils.translation import gettext_lazy as _
@@ -17,8 +19,22 @@ from phonenumber_field.formfields import PhoneNumberField
 from phonenumber_field.validators import validate_international_phonenumber
 
 from . import settings as stagedoor_settings
-from .helpers import email_admin_approval, email_login_link, sms_login_link
-from .models import generate_token
+from .helpers import (
+    email_admin_approval,
+    email_login_link,
+    queue_login_link,
+    sms_login_link,
+)
+from .metrics import RegistrySink, get_metrics_sink
+from .models import AuthToken, generate_token
+from .ratelimit import (
+    login_allowed,
+    token_attempt_allowed,
+    token_attempt_failed,
+    token_attempt_succeeded,
+)
+
+PHONE_NUMBER_SESSION_KEY = "stagedoor_phone_number"
 
 
 class LoginForm(forms.Form):
@@ -74,6 +90,24 @@ class LoginForm(forms.Form):
         return self.cleaned_data
 
 
+def issue_token(request: HttpRequest, **kwargs: Any) -> tuple[AuthToken | None, bool]:
+    """Create a login token for the contact in kwargs.
+
+    Returns the token, or None, and whether it is waiting for admin approval.
+    With STAGEDOOR_ASYNC_DELIVERY the login message is queued in the same
+    transaction as the token.
+    """
+    with transaction.atomic():
+        token = generate_token(user=request.user, **kwargs)
+        if not token:
+            return None, False
+        if not token.approved:
+            return token, True
+        if stagedoor_settings.ASYNC_DELIVERY:
+            queue_login_link(request, token)
+        return token, False
+
+
 @require_http_methods(["POST"])
 def login_post(request: HttpRequest) -> HttpResponse:
     """Process the submission of the form with the user's email and mail them a link."""
@@ -88,22 +122,28 @@ def login_post(request: HttpRequest) -> HttpResponse:
     email = form.cleaned_data["email"]
     phone_number = form.cleaned_data["phone_number"]
 
+    if not login_allowed(request, str(email or phone_number)):
+        messages.error(
+            request,
+            _("Too many login attempts. Please wait a few minutes and try again."),
+        )
+        return redirect(stagedoor_settings.LOGIN_URL)
+
     next_url: str | None = ""
     if parsed_next_url := parse_qs(urlparse(request.get_full_path()).query).get("next"):
         next_url = parsed_next_url[0]
 
     if email:
-        if token := generate_token(email=email, next_url=next_url, user=request.user):
-            # breakpoint()
-            if stagedoor_settings.REQUIRE_ADMIN_APPROVAL and not (
-                token.email.user or token.email.potential_user
-            ):
-                token.approved = False
-                token.save()
+        token, pending = issue_token(request, email=email, next_url=next_url)
+        if token:
+            if pending:
                 email_admin_approval(request=request, token=token)
                 return redirect(reverse("stagedoor:approval-needed"))
             else:
-                email_login_link(request=request, token=token)
+                if not stagedoor_settings.ASYNC_DELIVERY:
+                    email_login_link(request=request, token=token)
+                if stagedoor_settings.SMS_CODE_REQUIRES_CONTACT:
+                    request.session.pop(PHONE_NUMBER_SESSION_KEY, None)
                 messages.success(
                     request,
                     _("Check your email to log in!"),
@@ -116,18 +156,19 @@ def login_post(request: HttpRequest) -> HttpResponse:
             return redirect(stagedoor_settings.LOGIN_URL)
 
     elif phone_number:
-        if token := generate_token(
-            phone_number=phone_number, next_url=next_url, user=request.user
-        ):
-            if stagedoor_settings.REQUIRE_ADMIN_APPROVAL and not (
-                token.phone_number.user or token.phone_number.potential_user
-            ):
-                token.approved = False
-                token.save()
+        token, pending = issue_token(
+            request, phone_number=phone_number, next_url=next_url
+        )
+        if token:
+            if pending:
                 email_admin_approval(request=request, token=token)
                 return redirect(reverse("stagedoor:approval-needed"))
             else:
-                sms_login_link(request=request, token=token)
+                if not stagedoor_settings.ASYNC_DELIVERY:
+                    sms_login_link(request=request, token=token)
+                if stagedoor_settings.SMS_CODE_REQUIRES_CONTACT:
+                    # Prefill the number on the code entry page.
+                    request.session[PHONE_NUMBER_SESSION_KEY] = str(phone_number)
                 messages.success(
                     request,
                     _("Check your text messages to log in!"),
@@ -140,9 +181,22 @@ def login_post(request: HttpRequest) -> HttpResponse:
     return redirect(stagedoor_settings.LOGIN_URL)
 
 
-def process_token(request: HttpRequest, token: str | None) -> HttpResponse:
-    user = authenticate(request, token=token)
+def process_token(
+    request: HttpRequest, token: str | None, phone_number: str | None = None
+) -> HttpResponse:
+    if not token_attempt_allowed(request, phone_number):
+        messages.error(
+            request,
+            _("Too many failed login attempts. Please wait a while and try again."),
+        )
+        return redirect(stagedoor_settings.LOGIN_URL)
+
+    credentials = {"token": token}
+    if phone_number:
+        credentials["phone_number"] = phone_number
+    user = authenticate(request, **credentials)
     if user is None:
+        token_attempt_failed(request, phone_number)
         messages.error(
             request,
             _(
@@ -152,6 +206,7 @@ def process_token(request: HttpRequest, token: str | None) -> HttpResponse:
         )
         return redirect(stagedoor_settings.LOGIN_URL)
 
+    token_attempt_succeeded(request, phone_number)
     if hasattr(user, "_stagedoor_next_url"):
         next_url = user._stagedoor_next_url  # type: ignore
 
@@ -167,10 +222,20 @@ def process_token(request: HttpRequest, token: str | None) -> HttpResponse:
 
 
 def token_post(request: HttpRequest) -> HttpResponse:
+    phone_number = request.POST.get("phone_number")
+    if not phone_number and stagedoor_settings.SMS_CODE_REQUIRES_CONTACT:
+        phone_number = request.session.get(PHONE_NUMBER_SESSION_KEY)
     if request.POST:
         token = request.POST.get("token")
-        return process_token(request, token)
-    return render(request, template_name="stagedoor_token_input.html")
+        return process_token(request, token, phone_number=phone_number)
+    return render(
+        request,
+        template_name="stagedoor_token_input.html",
+        context={
+            "require_phone_number": stagedoor_settings.SMS_CODE_REQUIRES_CONTACT,
+            "phone_number": phone_number or "",
+        },
+    )
 
 
 @require_http_methods(["GET"])
@@ -188,3 +253,19 @@ def logout(request: HttpRequest) -> HttpResponse:
 
 def approval_needed(request: HttpRequest) -> HttpResponse:
     return render(request, template_name="stagedoor_approval_needed.html")
+
+
+@require_http_methods(["GET"])
+def prometheus_metrics(request: HttpRequest) -> HttpResponse:
+    """Serve the metrics of a RegistrySink in the Prometheus text format.
+
+    stagedoor.urls doesn't include this view; route it yourself, behind
+    whatever protects your other internal endpoints. Without
+    STAGEDOOR_METRICS_SINK set to RegistrySink it answers 404.
+    """
+    sink = get_metrics_sink()
+    if not isinstance(sink, RegistrySink):
+        raise Http404("Metrics are not kept in this process.")
+    return HttpResponse(
+        sink.exposition(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -2,17 +2,38 @@
 Tests for django-stagedoor admin functionality.
 """
 
+import re
+from datetime import timedelta
+from smtplib import SMTPException
+from typing import TYPE_CHECKING
 from unittest.mock import patch
 
 import pytest
 from django.contrib import admin
 from django.contrib.admin.sites import AdminSite
+from django.contrib.auth import get_user_model
 from django.contrib.messages.storage.fallback import FallbackStorage
+from django.core import mail
+from django.core.mail import get_connection
+from django.core.mail.backends import locmem
+from django.db import connection
 from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils.timezone import now
 
-from stagedoor.admin import AuthTokenAdmin, EmailAdmin, PhoneNumberAdmin
-from stagedoor.models import AuthToken, Email, PhoneNumber
+from stagedoor.admin import (
+    AuthTokenAdmin,
+    EmailAdmin,
+    EstimatedCountPaginator,
+    PhoneNumberAdmin,
+)
+from stagedoor.models import AuthToken, Delivery, Email, PhoneNumber
+
+if TYPE_CHECKING:
+    from django.contrib.auth.models import User
+else:
+    User = get_user_model()
 
 
 @pytest.mark.django_db
@@ -145,7 +166,14 @@ class TestAuthTokenAdmin:
 
     def test_list_display(self):
         """Test that list_display is properly configured."""
-        expected = ["email", "phone_number", "approved", "timestamp", "next_url"]
+        expected = [
+            "email",
+            "phone_number",
+            "approved",
+            "timestamp",
+            "expires_at",
+            "next_url",
+        ]
         assert self.admin.list_display == expected
 
     def test_ordering(self):
@@ -237,18 +265,18 @@ class TestAuthTokenAdmin:
 
         queryset = AuthToken.objects.filter(pk=token.pk)
 
-        # Mock external dependencies - patch both the direct call and the import
-        with patch("stagedoor.admin.email_login_link") as mock_email:
-            with patch("stagedoor.admin.sms_login_link") as mock_sms:
-                with patch("stagedoor.settings.REQUIRE_ADMIN_APPROVAL", False):
-                    self.admin.approve_tokens(request, queryset)
+        with patch("stagedoor.helpers.sms_login_link") as mock_sms:
+            with patch("stagedoor.settings.REQUIRE_ADMIN_APPROVAL", False):
+                self.admin.approve_tokens(request, queryset)
 
         # Check that the token was approved
         token.refresh_from_db()
         assert token.approved
 
-        # Check that email function was called
-        mock_email.assert_called_once()
+        # Check that the login email was sent
+        assert len(mail.outbox) == 1
+        assert mail.outbox[0].to == ["test@example.com"]
+        assert "/auth/login/test-token" in mail.outbox[0].body
         mock_sms.assert_not_called()
 
         # Check message was added
@@ -256,6 +284,27 @@ class TestAuthTokenAdmin:
         assert len(msgs) == 1
         assert "Successfully approved and sent 1 searches" in str(msgs[0])
 
+    @patch("stagedoor.settings.HASH_TOKENS", True)
+    def test_approve_hashed_token_issues_new_token(self, admin_user):
+        """Test approving a digest-only token sends a freshly issued token."""
+        email = Email.objects.create(email="test@example.com")
+        token = AuthToken(email=email, approved=False)
+        token.set_token("pending-token")
+        token.save()
+
+        request = self.factory.post("/")
+        request.user = admin_user
+        request.session = {}  # type: ignore[assignment]
+        request._messages = FallbackStorage(request)  # type: ignore[attr-defined]
+
+        queryset = AuthToken.objects.filter(pk=token.pk)
+        self.admin.approve_tokens(request, queryset)
+
+        match = re.search(r"/auth/login/(\S+)", str(mail.outbox[0].body))
+        assert match
+        assert match.group(1) != "pending-token"
+        assert AuthToken.lookup(match.group(1)) == token
+
     def test_admin_action_through_interface(self, admin_client):
         """Test the admin action through the web interface."""
         email = Email.objects.create(email="test@example.com")
@@ -264,16 +313,15 @@ class TestAuthTokenAdmin:
         )
 
         # Mock external dependencies
-        with patch("stagedoor.admin.email_login_link"):
-            with patch("stagedoor.admin.sms_login_link"):
-                with patch("stagedoor.settings.REQUIRE_ADMIN_APPROVAL", False):
-                    # Submit the action through admin
-                    url = reverse("admin:stagedoor_authtoken_changelist")
-                    data = {
-                        "action": "approve_tokens",
-                        "_selected_action": [str(token.pk)],
-                    }
-                    response = admin_client.post(url, data, follow=True)
+        with patch("stagedoor.helpers.sms_login_link"):
+            with patch("stagedoor.settings.REQUIRE_ADMIN_APPROVAL", False):
+                # Submit the action through admin
+                url = reverse("admin:stagedoor_authtoken_changelist")
+                data = {
+                    "action": "approve_tokens",
+                    "_selected_action": [str(token.pk)],
+                }
+                response = admin_client.post(url, data, follow=True)
 
         assert response.status_code == 200
 
@@ -294,16 +342,15 @@ class TestAuthTokenAdmin:
         )
 
         # Mock external dependencies
-        with patch("stagedoor.admin.email_login_link") as mock_email:
-            with patch("stagedoor.admin.sms_login_link") as mock_sms:
-                with patch("stagedoor.settings.REQUIRE_ADMIN_APPROVAL", False):
-                    # Submit the action through admin
-                    url = reverse("admin:stagedoor_authtoken_changelist")
-                    data = {
-                        "action": "approve_tokens",
-                        "_selected_action": [str(token.pk)],
-                    }
-                    response = admin_client.post(url, data, follow=True)
+        with patch("stagedoor.helpers.sms_login_link") as mock_sms:
+            with patch("stagedoor.settings.REQUIRE_ADMIN_APPROVAL", False):
+                # Submit the action through admin
+                url = reverse("admin:stagedoor_authtoken_changelist")
+                data = {
+                    "action": "approve_tokens",
+                    "_selected_action": [str(token.pk)],
+                }
+                response = admin_client.post(url, data, follow=True)
 
         assert response.status_code == 200
 
@@ -313,7 +360,7 @@ class TestAuthTokenAdmin:
 
         # Check that SMS function was called
         mock_sms.assert_called_once()
-        mock_email.assert_not_called()
+        assert not mail.outbox
 
     def test_admin_action_multiple_tokens(self, admin_client):
         """Test approving multiple tokens at once."""
@@ -324,16 +371,15 @@ class TestAuthTokenAdmin:
         token2 = AuthToken.objects.create(email=email2, approved=False, token="token2")
 
         # Mock external dependencies
-        with patch("stagedoor.admin.email_login_link") as mock_email:
-            with patch("stagedoor.admin.sms_login_link") as mock_sms:
-                with patch("stagedoor.settings.REQUIRE_ADMIN_APPROVAL", False):
-                    # Submit the action through admin
-                    url = reverse("admin:stagedoor_authtoken_changelist")
-                    data = {
-                        "action": "approve_tokens",
-                        "_selected_action": [str(token1.pk), str(token2.pk)],
-                    }
-                    response = admin_client.post(url, data, follow=True)
+        with patch("stagedoor.helpers.sms_login_link") as mock_sms:
+            with patch("stagedoor.settings.REQUIRE_ADMIN_APPROVAL", False):
+                # Submit the action through admin
+                url = reverse("admin:stagedoor_authtoken_changelist")
+                data = {
+                    "action": "approve_tokens",
+                    "_selected_action": [str(token1.pk), str(token2.pk)],
+                }
+                response = admin_client.post(url, data, follow=True)
 
         assert response.status_code == 200
 
@@ -343,8 +389,11 @@ class TestAuthTokenAdmin:
         assert token1.approved
         assert token2.approved
 
-        # Check that email function was called for each token
-        assert mock_email.call_count == 2
+        # Check that an email was sent for each token
+        assert sorted(message.to[0] for message in mail.outbox) == [
+            "test1@example.com",
+            "test2@example.com",
+        ]
         mock_sms.assert_not_called()
 
         # Check for success message
@@ -352,6 +401,96 @@ class TestAuthTokenAdmin:
         assert len(messages) == 1
         assert "Successfully approved and sent 2 searches" in str(messages[0])
 
+    def make_request(self, admin_user):
+        """Build an admin request that can hold messages."""
+        request = self.factory.post("/")
+        request.user = admin_user
+        request.session = {}  # type: ignore[assignment]
+        request._messages = FallbackStorage(request)  # type: ignore[attr-defined]
+        return request
+
+    @patch("stagedoor.settings.EMAIL_BATCH_SIZE", 2)
+    def test_approve_sends_in_chunks(self, admin_user, django_assert_num_queries):
+        """Test that approval is one UPDATE and emails share one connection."""
+        for i in range(5):
+            email = Email.objects.create(email=f"test{i}@example.com")
+            AuthToken.objects.create(email=email, approved=False, token=f"token{i}")
+        request = self.make_request(admin_user)
+
+        with patch(
+            "stagedoor.helpers.get_connection", wraps=get_connection
+        ) as mock_connection:
+            with patch.object(
+                locmem.EmailBackend, "send_messages", autospec=True, return_value=2
+            ) as mock_send:
+                # Select, site lookup, and one UPDATE inside a savepoint pair.
+                with django_assert_num_queries(5):
+                    self.admin.approve_tokens(request, AuthToken.objects.all())
+
+        mock_connection.assert_called_once()
+        assert [len(call.args[1]) for call in mock_send.call_args_list] == [2, 2, 1]
+        assert not AuthToken.objects.filter(approved=False).exists()
+
+    @patch("stagedoor.settings.EMAIL_BATCH_SIZE", 1)
+    def test_approve_reports_failed_chunks(self, admin_user):
+        """Test that a failed chunk is reported and the others still send."""
+        for i in range(3):
+            email = Email.objects.create(email=f"test{i}@example.com")
+            AuthToken.objects.create(email=email, approved=False, token=f"token{i}")
+        request = self.make_request(admin_user)
+
+        with patch.object(
+            locmem.EmailBackend,
+            "send_messages",
+            side_effect=[1, SMTPException("down"), 1],
+        ):
+            self.admin.approve_tokens(request, AuthToken.objects.order_by("pk"))
+
+        msgs = [str(message) for message in request._messages]  # type: ignore[attr-defined]
+        assert msgs == [
+            "Could not send login emails 2-2 of 3: down",
+            "Successfully approved and sent 2 searches.",
+        ]
+        assert not AuthToken.objects.filter(approved=False).exists()
+
+    def test_approve_reports_failed_sms(self, admin_user):
+        """Test that a failed SMS is reported without stopping the action."""
+        phone = PhoneNumber.objects.create(phone_number="+14155551234")
+        AuthToken.objects.create(phone_number=phone, approved=False, token="123456")
+        request = self.make_request(admin_user)
+
+        with patch("stagedoor.helpers.sms_login_link", side_effect=OSError("down")):
+            self.admin.approve_tokens(request, AuthToken.objects.all())
+
+        msgs = [str(message) for message in request._messages]  # type: ignore[attr-defined]
+        assert msgs == [
+            "Could not send login SMS to +14155551234: down",
+            "Successfully approved and sent 0 searches.",
+        ]
+
+    @patch("stagedoor.settings.ASYNC_DELIVERY", True)
+    def test_approve_queues_deliveries(self, admin_user):
+        """Test that approval queues messages when delivery is asynchronous."""
+        email = Email.objects.create(email="test@example.com")
+        phone = PhoneNumber.objects.create(phone_number="+14155551234")
+        AuthToken.objects.create(email=email, approved=False, token="token1")
+        AuthToken.objects.create(phone_number=phone, approved=False, token="123456")
+        request = self.make_request(admin_user)
+
+        self.admin.approve_tokens(request, AuthToken.objects.all())
+
+        assert not mail.outbox
+        assert sorted(
+            Delivery.objects.values_list("recipient", "auth_token__token")
+        ) == [
+            ("+14155551234", "123456"),
+            ("test@example.com", "token1"),
+        ]
+        msgs = [str(message) for message in request._messages]  # type: ignore[attr-defined]
+        assert msgs == [
+            "Successfully approved 2 searches and queued their login messages."
+        ]
+
     def test_admin_filters_and_search(self, admin_client):
         """Test that admin page loads without errors."""
         # Create a token so there's something to display
@@ -419,3 +558,118 @@ class TestAuthTokenAdmin:
         response = admin_client.post(url, data)
         assert response.status_code == 302
         assert AuthToken.objects.filter(token="new-token").exists()
+
+
+@pytest.mark.django_db
+class TestLargeTableAdmin:
+    """Test that the changelists stay cheap on large tables."""
+
+    def changelist_queries(self, admin_client, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = admin_client.get(url)
+        assert response.status_code == 200
+        return len(queries)
+
+    def add_tokens(self, count, offset=0):
+        for i in range(offset, offset + count):
+            user = User.objects.create_user(username=f"user{i}")
+            email = Email.objects.create(email=f"user{i}@example.com", user=user)
+            phone = PhoneNumber.objects.create(
+                phone_number=f"+1415555{i:04d}", potential_user=user
+            )
+            AuthToken.objects.create(email=email, token=f"email{i}")
+            AuthToken.objects.create(phone_number=phone, token=f"sms{i}")
+
+    @pytest.mark.parametrize(
+        "url_name",
+        [
+            "admin:stagedoor_authtoken_changelist",
+            "admin:stagedoor_email_changelist",
+            "admin:stagedoor_phonenumber_changelist",
+        ],
+    )
+    def test_changelist_queries_do_not_grow(self, admin_client, url_name):
+        """Test that a changelist runs the same queries for 2 rows or 20."""
+        url = reverse(url_name)
+        self.add_tokens(1)
+        few = self.changelist_queries(admin_client, url)
+        self.add_tokens(9, offset=1)
+        assert self.changelist_queries(admin_client, url) == few
+
+    def test_change_forms_use_raw_id_widgets(self, admin_client, regular_user):
+        """Test that user and contact fields aren't rendered as selects."""
+        email = Email.objects.create(email="test@example.com", user=regular_user)
+        token = AuthToken.objects.create(email=email, token="test-token")
+
+        for url in (
+            reverse("admin:stagedoor_email_change", args=[email.pk]),
+            reverse("admin:stagedoor_authtoken_change", args=[token.pk]),
+        ):
+            content = admin_client.get(url).content.decode()
+            assert "vForeignKeyRawIdAdminField" in content
+            assert not re.search(r'<select name="(user|potential_user|email)"', content)
+
+    def test_search_by_prefix(self, admin_client):
+        """Test searching tokens and contacts by the start of the contact."""
+        self.add_tokens(2)
+
+        response = admin_client.get(
+            reverse("admin:stagedoor_authtoken_changelist"), {"q": "user1@"}
+        )
+        assert list(response.context["cl"].result_list) == [
+            AuthToken.objects.get(token="email1")
+        ]
+        response = admin_client.get(
+            reverse("admin:stagedoor_phonenumber_changelist"), {"q": "+14155550001"}
+        )
+        assert response.context["cl"].result_count == 1
+
+    def test_filter_pending(self, admin_client):
+        """Test that the changelist can show only tokens waiting for approval."""
+        self.add_tokens(2)
+        AuthToken.objects.filter(token="sms1").update(approved=False)
+
+        response = admin_client.get(
+            reverse("admin:stagedoor_authtoken_changelist"), {"approved__exact": "0"}
+        )
+        assert list(response.context["cl"].result_list) == [
+            AuthToken.objects.get(token="sms1")
+        ]
+
+    def test_filter_expiry(self, admin_client):
+        """Test that the changelist can split tokens on expires_at."""
+        self.add_tokens(1)
+        AuthToken.objects.filter(token="sms0").update(
+            expires_at=now() - timedelta(seconds=1)
+        )
+        url = reverse("admin:stagedoor_authtoken_changelist")
+
+        response = admin_client.get(url, {"expiry": "expired"})
+        assert [token.token for token in response.context["cl"].result_list] == ["sms0"]
+        response = admin_client.get(url, {"expiry": "live"})
+        assert [token.token for token in response.context["cl"].result_list] == [
+            "email0"
+        ]
+
+    def test_estimated_count(self):
+        """Test that large unfiltered tables use the estimate."""
+        self.add_tokens(2)
+        paginator = EstimatedCountPaginator(AuthToken.objects.order_by("pk"), 10)
+        assert paginator.estimated_count() is None
+        assert paginator.count == 4
+
+        with patch.object(
+            EstimatedCountPaginator, "estimated_count", return_value=5_000_000
+        ):
+            assert EstimatedCountPaginator(
+                AuthToken.objects.order_by("pk"), 10
+            ).count == (5_000_000)
+        with patch.object(EstimatedCountPaginator, "estimated_count", return_value=3):
+            assert (
+                EstimatedCountPaginator(AuthToken.objects.order_by("pk"), 10).count == 4
+            )
+
+        filtered = AuthToken.objects.filter(approved=True).order_by("pk")
+        with patch.object(connection, "vendor", "postgresql"):
+            assert EstimatedCountPaginator(filtered, 10).estimated_count() is None
+        assert EstimatedCountPaginator([1, 2], 10).estimated_count() is None
@@ -0,0 +1,365 @@
+"""
+Tests for django-stagedoor JSON API.
+"""
+
+from typing import TYPE_CHECKING
+from unittest.mock import patch
+
+import pytest
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.models import Session
+from django.core import mail
+from django.core.cache import caches
+from django.test import Client
+from django.urls import reverse
+
+from stagedoor import settings as stagedoor_settings
+from stagedoor import sms
+from stagedoor.models import AuthToken, Delivery, Email, PhoneNumber
+
+if TYPE_CHECKING:
+    from django.contrib.auth.models import User as UserType
+
+    User = UserType
+else:
+    User = get_user_model()
+
+
+@pytest.mark.django_db
+@patch("stagedoor.settings.SMS_TRANSPORT", "stagedoor.sms.LocmemTransport")
+class TestRequestCode:
+    """Test asking for a login code."""
+
+    def setup_method(self):
+        """Set up test fixtures."""
+        sms.outbox.clear()
+        caches["default"].clear()
+        self.url = reverse("stagedoor-api:login")
+
+    def test_email(self, client):
+        """Test that an email login is sent without touching the session."""
+        response = client.post(
+            self.url,
+            {"contact": "test@example.com", "next": "/next"},
+            content_type="application/json",
+        )
+
+        assert response.status_code == 202
+        assert response.content == b'{"status":"sent","channel":"email"}'
+        token = AuthToken.objects.get()
+        assert token.next_url == "/next"
+        assert len(mail.outbox) == 1
+        assert not Session.objects.exists()
+        assert "sessionid" not in response.cookies
+
+    def test_phone_number(self, client):
+        """Test that an SMS code is sent."""
+        response = client.post(
+            self.url,
+            {"phone_number": "+14155551234"},
+            content_type="application/json",
+        )
+
+        assert response.status_code == 202
+        assert response.json() == {"status": "sent", "channel": "sms"}
+        assert sms.outbox[0]["to"] == "+14155551234"
+
+    @patch("stagedoor.settings.ASYNC_DELIVERY", True)
+    def test_async_delivery(self, client):
+        """Test that the message is queued instead of sent."""
+        response = client.post(
+            self.url, {"email": "test@example.com"}, content_type="application/json"
+        )
+
+        assert response.status_code == 202
+        assert not mail.outbox
+        assert Delivery.objects.count() == 1
+
+    @patch("stagedoor.settings.REQUIRE_ADMIN_APPROVAL", True)
+    def test_needs_approval(self, client):
+        """Test that a login waiting for approval says so."""
+        response = client.post(
+            self.url, {"email": "test@example.com"}, content_type="application/json"
+        )
+
+        assert response.status_code == 202
+        assert response.json() == {"status": "approval_needed"}
+        assert mail.outbox[0].to == [stagedoor_settings.SUPPORT_EMAIL]
+
+    @pytest.mark.parametrize(
+        "body",
+        ['{"contact": "nope"}', "{}"],
+    )
+    def test_invalid_contact(self, client, body):
+        """Test that a missing or invalid contact is rejected."""
+        response = client.post(self.url, body, content_type="application/json")
+
+        assert response.status_code == 400
+        assert response.json() == {"error": "invalid_contact"}
+
+    @pytest.mark.parametrize(
+        ("body", "content_type"),
+        [
+            ("{not json", "application/json"),
+            ('["test@example.com"]', "application/json"),
+            ("contact=test%40example.com", "application/x-www-form-urlencoded"),
+        ],
+    )
+    def test_invalid_json(self, client, body, content_type):
+        """Test that only JSON objects are accepted."""
+        response = client.post(self.url, body, content_type=content_type)
+
+        assert response.status_code == 400
+        assert response.json() == {"error": "invalid_json"}
+        assert not AuthToken.objects.exists()
+
+    def test_get_not_allowed(self, client):
+        """Test that only POST is allowed."""
+        assert client.get(self.url).status_code == 405
+
+    @patch("stagedoor.views.generate_token", return_value=None)
+    def test_contact_taken(self, mock_generate_token, client):
+        """Test that a refused token is reported."""
+        response = client.post(
+            self.url, {"email": "test@example.com"}, content_type="application/json"
+        )
+
+        assert response.status_code == 409
+        assert response.json() == {"error": "contact_taken"}
+
+    @patch("stagedoor.settings.LOGIN_RATE_PER_CONTACT", (1, 60))
+    def test_rate_limited(self, client):
+        """Test that requests over the rate limit are refused."""
+        data = {"email": "test@example.com"}
+        client.post(self.url, data, content_type="application/json")
+        response = client.post(self.url, data, content_type="application/json")
+
+        assert response.status_code == 429
+        assert response.json() == {"error": "rate_limited"}
+        assert AuthToken.objects.count() == 1
+
+
+@pytest.mark.django_db
+class TestVerifyCode:
+    """Test logging in with a code."""
+
+    def setup_method(self):
+        """Set up test fixtures."""
+        caches["default"].clear()
+        self.url = reverse("stagedoor-api:token")
+        self.user = User.objects.create_user(username="testuser")
+        email = Email.objects.create(email="test@example.com", user=self.user)
+        AuthToken.objects.create(email=email, token="test-token", next_url="/next")
+
+    def test_success(self, client):
+        """Test that a good code logs the session in."""
+        response = client.post(
+            self.url, {"token": "test-token"}, content_type="application/json"
+        )
+
+        assert response.status_code == 200
+        assert response.json() == {
+            "status": "ok",
+            "user": self.user.pk,
+            "next": "/next",
+        }
+        assert client.session["_auth_user_id"] == str(self.user.pk)
+
+        response = client.get(reverse("stagedoor-api:status"))
+        assert response.json() == {"authenticated": True, "user": self.user.pk}
+
+    def test_default_next_url(self, client):
+        """Test that the login redirect is returned without a next URL."""
+        AuthToken.objects.update(next_url="")
+        client.force_login(self.user)
+        response = client.post(
+            self.url, {"token": "test-token"}, content_type="application/json"
+        )
+
+        assert response.json()["next"] == stagedoor_settings.LOGIN_REDIRECT
+
+    def test_phone_number(self, client):
+        """Test that an SMS code is checked with its phone number."""
+        phone = PhoneNumber.objects.create(phone_number="+14155551234", user=self.user)
+        AuthToken.objects.create(phone_number=phone, token="123456")
+
+        response = client.post(
+            self.url,
+            {"token": "123456", "phone_number": "+14155550000"},
+            content_type="application/json",
+        )
+        assert response.status_code == 401
+
+        response = client.post(
+            self.url,
+            {"token": "123456", "phone_number": "+14155551234"},
+            content_type="application/json",
+        )
+        assert response.status_code == 200
+
+    def test_bad_token(self, client):
+        """Test that a wrong code is refused without touching the session."""
+        response = client.post(
+            self.url, {"token": "wrong"}, content_type="application/json"
+        )
+
+        assert response.status_code == 401
+        assert response.json() == {"error": "invalid_token"}
+        assert not Session.objects.exists()
+
+    @pytest.mark.parametrize(
+        ("body", "error"),
+        [
+            ("{not json", "invalid_json"),
+            ("{}", "invalid_token"),
+            ('{"token": 123456}', "invalid_token"),
+            ('{"token": "123456", "phone_number": 1}', "invalid_contact"),
+        ],
+    )
+    def test_invalid_body(self, client, body, error):
+        """Test that malformed bodies are refused."""
+        response = client.post(self.url, body, content_type="application/json")
+
+        assert response.status_code == 400
+        assert response.json() == {"error": error}
+
+    @patch("stagedoor.settings.TOKEN_FAILURES_PER_IP", 1)
+    def test_locked_out(self, client):
+        """Test that a locked out client is refused."""
+        client.post(self.url, {"token": "wrong"}, content_type="application/json")
+        response = client.post(
+            self.url, {"token": "test-token"}, content_type="application/json"
+        )
+
+        assert response.status_code == 429
+        assert response.json() == {"error": "locked_out"}
+
+
+@pytest.mark.django_db
+def test_status_anonymous(client):
+    """Test that an anonymous session reports no user."""
+    response = client.get(reverse("stagedoor-api:status"))
+
+    assert response.status_code == 200
+    assert response.content == b'{"authenticated":false,"user":null}'
+
+
+@pytest.mark.django_db
+class TestPendingApproval:
+    """Test the staff endpoints for tokens waiting for approval."""
+
+    def setup_method(self):
+        """Set up test fixtures."""
+        self.list_url = reverse("stagedoor-api:pending")
+        self.approve_url = reverse("stagedoor-api:approve-pending")
+
+    def add_pending(self, count):
+        tokens = []
+        for i in range(count):
+            email = Email.objects.create(email=f"user{i}@example.com")
+            tokens.append(
+                AuthToken.objects.create(
+                    email=email, token=f"pending{i}", approved=False
+                )
+            )
+        return tokens
+
+    def test_list_pages(self, client, admin_user):
+        """Test that pending tokens are listed a page at a time."""
+        tokens = self.add_pending(3)
+        email = Email.objects.create(email="approved@example.com")
+        AuthToken.objects.create(email=email, token="approved")
+        client.force_login(admin_user)
+
+        response = client.get(self.list_url, {"limit": 2})
+        assert response.status_code == 200
+        data = response.json()
+        assert [result["id"] for result in data["results"]] == [
+            tokens[0].pk,
+            tokens[1].pk,
+        ]
+        assert data["results"][0]["email"] == "user0@example.com"
+        assert data["results"][0]["phone_number"] is None
+        assert data["next"] == tokens[1].pk
+
+        data = client.get(self.list_url, {"limit": 2, "after": data["next"]}).json()
+        assert [result["id"] for result in data["results"]] == [tokens[2].pk]
+        assert data["next"] is None
+
+    @pytest.mark.parametrize(
+        "params", [{"limit": "0"}, {"limit": "1000"}, {"after": "last"}]
+    )
+    def test_list_invalid_page(self, client, admin_user, params):
+        """Test that a bad cursor or limit is rejected."""
+        client.force_login(admin_user)
+        response = client.get(self.list_url, params)
+        assert response.status_code == 400
+        assert response.json() == {"error": "invalid_page"}
+
+    def test_forbidden(self, client, regular_user):
+        """Test that only staff with the permission may list or approve."""
+        assert client.get(self.list_url).status_code == 403
+        regular_user.is_staff = True
+        regular_user.save()
+        client.force_login(regular_user)
+
+        assert client.get(self.list_url).status_code == 403
+        response = client.post(
+            self.approve_url, {"ids": []}, content_type="application/json"
+        )
+        assert response.status_code == 403
+        assert response.json() == {"error": "forbidden"}
+
+    def test_approve(self, client, admin_user):
+        """Test that approving sends the login emails of pending tokens only."""
+        tokens = self.add_pending(2)
+        client.force_login(admin_user)
+
+        response = client.post(
+            self.approve_url,
+            {"ids": [tokens[0].pk, 999]},
+            content_type="application/json",
+        )
+
+        assert response.status_code == 200
+        assert response.json() == {"approved": 1, "sent": 1, "errors": []}
+        assert list(AuthToken.objects.pending()) == [tokens[1]]
+        assert len(mail.outbox) == 1
+        assert mail.outbox[0].to == ["user0@example.com"]
+
+    def test_approve_needs_csrf_token(self, admin_user):
+        """Test that approving checks the CSRF token, unlike the login endpoints."""
+        tokens = self.add_pending(1)
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(admin_user)
+        body = {"ids": [tokens[0].pk]}
+
+        response = client.post(self.approve_url, body, content_type="application/json")
+        assert response.status_code == 403
+        assert list(AuthToken.objects.pending()) == tokens
+
+        client.cookies[settings.CSRF_COOKIE_NAME] = "a" * 32
+        response = client.post(
+            self.approve_url,
+            body,
+            content_type="application/json",
+            headers={"X-CSRFToken": "a" * 32},
+        )
+        assert response.status_code == 200
+        assert not AuthToken.objects.pending().exists()
+
+        response = client.post(
+            reverse("stagedoor-api:login"),
+            {"contact": "new@example.com"},
+            content_type="application/json",
+        )
+        assert response.status_code == 202
+
+    @pytest.mark.parametrize("body", [{}, {"ids": "1"}, {"ids": [True]}])
+    def test_approve_invalid_ids(self, client, admin_user, body):
+        """Test that ids must be a list of integers."""
+        client.force_login(admin_user)
+        response = client.post(self.approve_url, body, content_type="application/json")
+        assert response.status_code == 400
+        assert response.json() == {"error": "invalid_ids"}
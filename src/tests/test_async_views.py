@@ -0,0 +1,173 @@
+"""
+Tests for django-stagedoor async views.
+"""
+
+from typing import TYPE_CHECKING
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from stagedoor import settings as stagedoor_settings
+from stagedoor import sms
+from stagedoor.models import AuthToken, Delivery, Email, PhoneNumber
+
+if TYPE_CHECKING:
+    from django.contrib.auth.models import User as UserType
+
+    User = UserType
+else:
+    User = get_user_model()
+
+TEST_EMAIL = "hello@hellocaller.app"
+TEST_PHONE_NUMBER = "+14158675309"
+
+
+@override_settings(ROOT_URLCONF="tests.async_urls")
+@patch("stagedoor.settings.SMS_TRANSPORT", "stagedoor.sms.LocmemTransport")
+class AsyncLoginPostTests(TestCase):
+    def setUp(self):
+        sms.outbox.clear()
+        caches["default"].clear()
+
+    async def test_email(self):
+        response = await self.async_client.post(
+            reverse("stagedoor:login") + "?next=/next", {"email": TEST_EMAIL}
+        )
+        self.assertRedirects(
+            response, reverse("stagedoor:token-post"), fetch_redirect_response=False
+        )
+        token = await AuthToken.objects.select_related("email").aget()
+        self.assertEqual(TEST_EMAIL, token.email.email)  # type: ignore[union-attr]
+        self.assertEqual("/next", token.next_url)
+        self.assertEqual(1, len(mail.outbox))
+        self.assertIn(f"/auth/login/{token.token}", str(mail.outbox[0].body))
+
+    @patch("stagedoor.settings.SMS_CODE_REQUIRES_CONTACT", True)
+    async def test_phone_number(self):
+        response = await self.async_client.post(
+            reverse("stagedoor:login"), {"phone_number": TEST_PHONE_NUMBER}
+        )
+        self.assertEqual(reverse("stagedoor:token-post"), response.url)  # type: ignore[attr-defined]
+        token = await AuthToken.objects.aget()
+        self.assertEqual(TEST_PHONE_NUMBER, sms.outbox[0]["to"])
+        self.assertIn(f"code is {token.token}", sms.outbox[0]["body"])
+
+        # The number is remembered for the code entry page.
+        response = await self.async_client.get(reverse("stagedoor:token-post"))
+        self.assertContains(response, TEST_PHONE_NUMBER)
+
+        # And forgotten after asking for an email login.
+        await self.async_client.post(reverse("stagedoor:login"), {"email": TEST_EMAIL})
+        response = await self.async_client.get(reverse("stagedoor:token-post"))
+        self.assertNotContains(response, TEST_PHONE_NUMBER)
+
+    @patch("stagedoor.settings.ASYNC_DELIVERY", True)
+    async def test_async_delivery(self):
+        await self.async_client.post(reverse("stagedoor:login"), {"email": TEST_EMAIL})
+        self.assertEqual(0, len(mail.outbox))
+        self.assertEqual(1, await Delivery.objects.acount())
+
+    async def test_invalid_form(self):
+        response = await self.async_client.post(
+            reverse("stagedoor:login"), {"email": "nope"}
+        )
+        self.assertEqual(stagedoor_settings.LOGIN_URL, response.url)  # type: ignore[attr-defined]
+        self.assertFalse(await AuthToken.objects.aexists())
+
+    @patch("stagedoor.settings.REQUIRE_ADMIN_APPROVAL", True)
+    async def test_needs_approval(self):
+        response = await self.async_client.post(
+            reverse("stagedoor:login"), {"email": TEST_EMAIL}
+        )
+        self.assertEqual(reverse("stagedoor:approval-needed"), response.url)  # type: ignore[attr-defined]
+        self.assertIn("New account created", mail.outbox[0].subject)
+        response = await self.async_client.get(reverse("stagedoor:approval-needed"))
+        self.assertContains(response, "Your account will be reviewed shortly")
+
+    @patch("stagedoor.views.generate_token", return_value=None)
+    async def test_no_token(self, mock_generate_token):
+        for data in ({"email": TEST_EMAIL}, {"phone_number": TEST_PHONE_NUMBER}):
+            response = await self.async_client.post(reverse("stagedoor:login"), data)
+            self.assertEqual(stagedoor_settings.LOGIN_URL, response.url)  # type: ignore[attr-defined]
+        self.assertEqual(0, len(mail.outbox))
+
+    @patch("stagedoor.settings.LOGIN_RATE_PER_CONTACT", (1, 60))
+    async def test_rate_limited(self):
+        await self.async_client.post(reverse("stagedoor:login"), {"email": TEST_EMAIL})
+        response = await self.async_client.post(
+            reverse("stagedoor:login"), {"email": TEST_EMAIL}
+        )
+        self.assertEqual(stagedoor_settings.LOGIN_URL, response.url)  # type: ignore[attr-defined]
+        self.assertEqual(1, await AuthToken.objects.acount())
+
+
+@override_settings(ROOT_URLCONF="tests.async_urls")
+class AsyncTokenTests(TestCase):
+    def setUp(self):
+        caches["default"].clear()
+        self.user = User.objects.create_user(username="testuser")
+        email = Email.objects.create(email=TEST_EMAIL, user=self.user)
+        AuthToken.objects.create(email=email, token="test-token", next_url="/next")
+
+    async def test_token_login(self):
+        response = await self.async_client.get(
+            reverse("stagedoor:token-login", args=["test-token"])
+        )
+        self.assertEqual("/next", response.url)  # type: ignore[attr-defined]
+        self.assertEqual(
+            str(self.user.pk), await self.async_client.session.aget("_auth_user_id")
+        )
+
+        response = await self.async_client.get(reverse("stagedoor:logout"))
+        self.assertEqual(stagedoor_settings.LOGOUT_REDIRECT, response.url)  # type: ignore[attr-defined]
+        self.assertIsNone(await self.async_client.session.aget("_auth_user_id"))
+
+    async def test_token_post(self):
+        response = await self.async_client.get(reverse("stagedoor:token-post"))
+        self.assertEqual(200, response.status_code)
+
+        response = await self.async_client.post(
+            reverse("stagedoor:token-post"), {"token": "test-token"}
+        )
+        self.assertEqual("/next", response.url)  # type: ignore[attr-defined]
+
+    async def test_already_logged_in(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.post(
+            reverse("stagedoor:token-post"), {"token": "test-token"}
+        )
+        self.assertEqual("/next", response.url)  # type: ignore[attr-defined]
+
+    async def test_bad_token(self):
+        response = await self.async_client.post(
+            reverse("stagedoor:token-post"), {"token": "wrong"}
+        )
+        self.assertEqual(stagedoor_settings.LOGIN_URL, response.url)  # type: ignore[attr-defined]
+
+    async def test_next_url_default(self):
+        await AuthToken.objects.filter(token="test-token").aupdate(next_url="")
+        response = await self.async_client.get(
+            reverse("stagedoor:token-login", args=["test-token"])
+        )
+        self.assertEqual(stagedoor_settings.LOGIN_REDIRECT, response.url)  # type: ignore[attr-defined]
+
+    @patch("stagedoor.settings.TOKEN_FAILURES_PER_CONTACT", 1)
+    async def test_locked_out(self):
+        phone = await PhoneNumber.objects.acreate(phone_number=TEST_PHONE_NUMBER)
+        await AuthToken.objects.acreate(phone_number=phone, token="123456")
+        data = {"token": "000000", "phone_number": TEST_PHONE_NUMBER}
+        await self.async_client.post(reverse("stagedoor:token-post"), data)
+
+        data["token"] = "123456"
+        response = await self.async_client.post(reverse("stagedoor:token-post"), data)
+        self.assertEqual(stagedoor_settings.LOGIN_URL, response.url)  # type: ignore[attr-defined]
+        self.assertTrue(await AuthToken.objects.filter(token="123456").aexists())
+
+    async def test_logout_requires_login(self):
+        response = await self.async_client.get(reverse("stagedoor:logout"))
+        self.assertEqual(302, response.status_code)
+        self.assertIn("?next=", response.url)  # type: ignore[attr-defined]
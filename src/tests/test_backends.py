@@ -2,15 +2,27 @@
 Tests for django-stagedoor authentication backends.
 """
 
+from datetime import timedelta
 from typing import TYPE_CHECKING
 from unittest.mock import patch
 
 import pytest
-from django.contrib.auth import get_user_model
+from asgiref.sync import async_to_sync
+from django.contrib.auth import aauthenticate, authenticate, get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.db import connection
 from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
 
-from stagedoor.backends import EmailTokenBackend, SMSTokenBackend, StageDoorBackend
-from stagedoor.models import AuthToken, Email, PhoneNumber
+from stagedoor.backends import (
+    EmailTokenBackend,
+    SMSTokenBackend,
+    StageDoorBackend,
+    TokenBackend,
+)
+from stagedoor.models import AuthToken, Email, PhoneNumber, generate_token
 
 if TYPE_CHECKING:
     from django.contrib.auth.models import User as UserType
@@ -154,6 +166,45 @@ class TestStageDoorBackend:
         assert hasattr(result, "_stagedoor_next_url")
         assert result._stagedoor_next_url == "/dashboard"  # type: ignore
 
+    @patch("stagedoor.settings.PURGE_ON_LOOKUP", False)
+    def test_authenticate_ignores_expired_token_without_purge(self):
+        """Test that expired tokens are rejected even when nothing purges them."""
+        user = User.objects.create_user(username="testuser", email="test@example.com")
+        email = Email.objects.create(email="test@example.com", user=user)
+        token = AuthToken.objects.create(email=email, token="test-token")
+        AuthToken.objects.filter(pk=token.pk).update(
+            expires_at=now() - timedelta(seconds=3700)
+        )
+
+        request = self.factory.get("/")
+        assert self.backend.get_token_object("test-token") is None
+        assert self.backend.authenticate(request, token="test-token") is None
+        # The expired row is left for the purge command to clean up
+        assert AuthToken.objects.filter(pk=token.pk).exists()
+
+    @patch("stagedoor.settings.PURGE_ON_LOOKUP", True)
+    @patch("stagedoor.settings.PURGE_BATCH_SIZE", 2)
+    def test_inline_purge_deletes_one_batch(self):
+        """Test that a lookup purges one batch of stale tokens, not the backlog."""
+        email = Email.objects.create(email="test@example.com")
+        for i in range(5):
+            AuthToken.objects.create(email=email, token=f"old{i}")
+        AuthToken.objects.update(expires_at=now() - timedelta(days=1))
+
+        assert self.backend.authenticate(None, token="old0") is None
+        assert AuthToken.objects.count() == 3
+        assert self.backend.authenticate(None, token="old0") is None
+        assert AuthToken.objects.count() == 1
+
+    @patch("stagedoor.settings.DISABLE_USER_CREATION", True)
+    def test_authenticate_no_user_creation_with_next_url(self):
+        """Test that a next URL doesn't break the no-user-creation path."""
+        email = Email.objects.create(email="new@example.com")
+        AuthToken.objects.create(email=email, token="test-token", next_url="/next")
+
+        request = self.factory.get("/")
+        assert self.backend.authenticate(request, token="test-token") is None
+
     @patch("stagedoor.settings.DISABLE_USER_CREATION", False)
     def test_authenticate_get_or_create_user(self):
         """Test that get_or_create is used for user creation."""
@@ -176,6 +227,140 @@ class TestStageDoorBackend:
         assert user1 == user2
 
 
+@pytest.mark.django_db
+@patch("stagedoor.settings.SINGLE_USE_LINK", True)
+class TestSingleUseAcrossBackends:
+    """Test single-use tokens with both stagedoor backends installed."""
+
+    def test_sms_token_survives_email_backend(self):
+        """Test that the email backend does not consume an SMS token."""
+        phone = PhoneNumber.objects.create(phone_number="+14155551234")
+        token = AuthToken.objects.create(phone_number=phone, token="123456")
+
+        request = RequestFactory().get("/")
+        assert EmailTokenBackend().authenticate(request, token="123456") is None
+        assert AuthToken.objects.filter(pk=token.pk).exists()
+
+        user = authenticate(request, token="123456")
+
+        assert user is not None
+        assert not AuthToken.objects.filter(pk=token.pk).exists()
+        assert authenticate(request, token="123456") is None
+
+
+@pytest.mark.django_db
+class TestTokenBackend:
+    """Test the unified TokenBackend."""
+
+    def setup_method(self):
+        """Set up test fixtures."""
+        self.backend = TokenBackend()
+        self.factory = RequestFactory()
+
+    def test_authenticate_email_token(self):
+        """Test that an email token is finished as an email login."""
+        email = Email.objects.create(email="test@example.com")
+        AuthToken.objects.create(email=email, token="test-token")
+
+        result = self.backend.authenticate(self.factory.get("/"), token="test-token")
+
+        assert result is not None
+        email.refresh_from_db()
+        assert email.user == result
+
+    def test_authenticate_sms_token(self):
+        """Test that an SMS token is finished as an SMS login."""
+        phone = PhoneNumber.objects.create(phone_number="+14155551234")
+        AuthToken.objects.create(phone_number=phone, token="123456")
+
+        result = self.backend.authenticate(self.factory.get("/"), token="123456")
+
+        assert result is not None
+        phone.refresh_from_db()
+        assert phone.user == result
+
+    def test_authenticate_token_without_contact(self):
+        """Test that a token with no contact is rejected."""
+        AuthToken.objects.create(token="test-token")
+
+        result = self.backend.authenticate(self.factory.get("/"), token="test-token")
+        assert result is None
+
+    @patch("stagedoor.settings.PURGE_ON_LOOKUP", False)
+    def test_failed_login_is_one_query(self):
+        """Test that an unknown token costs a single query."""
+        with CaptureQueriesContext(connection) as queries:
+            result = self.backend.authenticate(self.factory.get("/"), token="123456")
+
+        assert result is None
+        assert len(queries) == 1
+
+    @patch("stagedoor.settings.PURGE_ON_LOOKUP", False)
+    def test_token_fetch_joins_contact_and_user(self):
+        """Test that the contact and its user come back with the token."""
+        user = User.objects.create_user(username="testuser", email="test@example.com")
+        phone = PhoneNumber.objects.create(phone_number="+14155551234", user=user)
+        AuthToken.objects.create(phone_number=phone, token="123456")
+
+        with CaptureQueriesContext(connection) as queries:
+            token_object = self.backend.get_token_object("123456")
+            assert token_object is not None
+            assert token_object.phone_number.user == user  # type: ignore[union-attr]
+
+        assert len(queries) == 1
+
+
+@pytest.mark.django_db
+class TestPhoneScopedCodes:
+    """Test SMS codes checked together with their phone number."""
+
+    def setup_method(self):
+        """Set up test fixtures."""
+        self.backend = TokenBackend()
+        self.factory = RequestFactory()
+        self.phone = PhoneNumber.objects.create(phone_number="+14155551234")
+        self.other_phone = PhoneNumber.objects.create(phone_number="+14155550000")
+        AuthToken.objects.create(phone_number=self.other_phone, token="123456")
+        AuthToken.objects.create(phone_number=self.phone, token="123456")
+
+    def test_code_matches_only_its_phone_number(self):
+        """Test that colliding codes resolve to the number they were sent to."""
+        token_object = self.backend.get_token_object("123456", "+1 415 555 1234")
+
+        assert token_object is not None
+        assert token_object.phone_number == self.phone
+
+    @patch("stagedoor.settings.SINGLE_USE_LINK", True)
+    def test_consume_scoped_code(self):
+        """Test that a scoped single-use code only removes the matching row."""
+        result = self.backend.authenticate(
+            self.factory.get("/"), token="123456", phone_number="+14155551234"
+        )
+
+        assert result is not None
+        assert not AuthToken.objects.filter(phone_number=self.phone).exists()
+        assert AuthToken.objects.filter(phone_number=self.other_phone).exists()
+
+    def test_invalid_phone_number(self):
+        """Test that an unparseable phone number matches nothing."""
+        assert self.backend.get_token_object("123456", "not a number") is None
+
+    def test_email_backend_ignores_phone_number(self):
+        """Test that the email backend never matches a scoped SMS code."""
+        backend = EmailTokenBackend()
+        assert backend.get_token_object("123456", "+14155551234") is None
+
+    @patch("stagedoor.settings.SMS_CODE_REQUIRES_CONTACT", True)
+    def test_unscoped_sms_code_rejected(self):
+        """Test that SMS codes need a phone number when the setting is on."""
+        email = Email.objects.create(email="test@example.com")
+        AuthToken.objects.create(email=email, token="email-token")
+
+        assert self.backend.get_token_object("123456") is None
+        assert SMSTokenBackend().get_token_object("123456") is None
+        assert self.backend.get_token_object("email-token") is not None
+
+
 @pytest.mark.django_db
 class TestEmailTokenBackend:
     """Test EmailTokenBackend functionality."""
@@ -184,6 +369,8 @@ class TestEmailTokenBackend:
         """Set up test fixtures."""
         self.backend = EmailTokenBackend()
         self.factory = RequestFactory()
+        # Used single-use links are remembered in the cache.
+        caches["default"].clear()
 
     def test_authenticate_no_token(self):
         """Test authentication with no token."""
@@ -221,6 +408,25 @@ class TestEmailTokenBackend:
         assert email.user == result
         assert email.potential_user is None
 
+    def test_authenticate_potential_user_other_requester(self):
+        """Test that a link asked for by another user's session is refused."""
+        attacker = User.objects.create_user(username="attacker")
+        victim = User.objects.create_user(username="victim")
+        email = Email.objects.create(email="test@example.com", potential_user=attacker)
+        AuthToken.objects.create(email=email, token="test-token")
+
+        for requester in (AnonymousUser(), victim):
+            request = self.factory.get("/")
+            request.user = requester
+            assert self.backend.authenticate(request, token="test-token") is None
+
+        request = self.factory.get("/")
+        request.user = attacker
+        assert self.backend.authenticate(request, token="test-token") == attacker
+        email.refresh_from_db()
+        assert email.user == attacker
+        assert User.objects.count() == 2
+
     def test_authenticate_potential_user_mismatch(self):
         """Test authentication fails when potential user doesn't match."""
         user1 = User.objects.create_user(username="user1", email="user1@example.com")
@@ -340,3 +546,266 @@ class TestSMSTokenBackend:
             assert result == user
             phone.refresh_from_db()
             assert phone.user == user
+
+
+@pytest.mark.django_db
+@patch("stagedoor.settings.SIGNED_LINKS", True)
+class TestSignedLinks:
+    """Test stateless signed email login links."""
+
+    def setup_method(self):
+        """Set up test fixtures."""
+        self.backend = EmailTokenBackend()
+        self.factory = RequestFactory()
+
+    def test_signed_link_is_not_stored(self):
+        """Test that generating a signed link writes no token row."""
+        token = generate_token(email="test@example.com", next_url="/dashboard")
+
+        assert token is not None
+        assert token.pk is None
+        assert AuthToken.objects.count() == 0
+
+    def test_signed_link_authenticates(self):
+        """Test that a signed link logs the user in and keeps next_url."""
+        token = generate_token(email="test@example.com", next_url="/dashboard")
+        assert token is not None
+
+        request = self.factory.get("/")
+        result = self.backend.authenticate(request, token=token.login_token)
+
+        assert result is not None
+        assert result.email == "test@example.com"  # type: ignore[attr-defined]
+        assert result._stagedoor_next_url == "/dashboard"  # type: ignore
+        assert Email.objects.get(email="test@example.com").user == result
+
+    def test_tampered_signed_link(self):
+        """Test that a modified signed link is rejected."""
+        token = generate_token(email="test@example.com")
+        assert token is not None
+
+        request = self.factory.get("/")
+        result = self.backend.authenticate(request, token=token.login_token + "x")
+        assert result is None
+
+    @patch("stagedoor.settings.TOKEN_DURATION", -1)
+    def test_expired_signed_link(self):
+        """Test that a signed link older than TOKEN_DURATION is rejected."""
+        token = generate_token(email="test@example.com")
+        assert token is not None
+
+        request = self.factory.get("/")
+        assert self.backend.authenticate(request, token=token.login_token) is None
+
+    @patch("stagedoor.settings.SINGLE_USE_LINK", True)
+    def test_single_use_signed_link_replay(self):
+        """Test that a single-use signed link only works once."""
+        token = generate_token(email="replay@example.com")
+        assert token is not None
+
+        request = self.factory.get("/")
+        assert self.backend.authenticate(request, token=token.login_token)
+        assert self.backend.authenticate(request, token=token.login_token) is None
+
+    def test_signed_link_for_deleted_email(self):
+        """Test that a signed link for a removed address is rejected."""
+        token = generate_token(email="test@example.com")
+        assert token is not None
+        Email.objects.all().delete()
+
+        request = self.factory.get("/")
+        assert self.backend.authenticate(request, token=token.login_token) is None
+
+    @patch("stagedoor.settings.REQUIRE_ADMIN_APPROVAL", True)
+    def test_approval_pending_tokens_are_stored(self):
+        """Test that tokens waiting for approval still go to the database."""
+        token = generate_token(email="new@example.com")
+
+        assert token is not None
+        assert token.pk is not None
+        assert ":" not in token.login_token
+
+
+@pytest.mark.django_db
+class TestAsyncBackends:
+    """Test the async versions of the backend methods."""
+
+    def setup_method(self):
+        """Set up test fixtures."""
+        self.backend = TokenBackend()
+        self.request = RequestFactory().get("/")
+        caches["default"].clear()
+
+    def authenticate(self, backend=None, **credentials):
+        """Run aauthenticate from sync test code."""
+        backend = backend or self.backend
+        return async_to_sync(backend.aauthenticate)(self.request, **credentials)
+
+    def test_aget_user(self):
+        """Test getting a user, or None, by primary key."""
+        user = User.objects.create_user(username="testuser")
+        assert async_to_sync(self.backend.aget_user)(user.pk) == user
+        assert async_to_sync(self.backend.aget_user)(99999) is None
+
+    def test_no_token(self):
+        """Test that a missing or unknown token is rejected."""
+        assert self.authenticate() is None
+        assert self.authenticate(token="nope") is None
+
+    def test_returning_user(self):
+        """Test that a returning user is logged in without writes."""
+        user = User.objects.create_user(username="testuser", email="test@example.com")
+        email = Email.objects.create(email="test@example.com", user=user)
+        AuthToken.objects.create(email=email, token="test-token", next_url="/next")
+
+        with CaptureQueriesContext(connection) as queries:
+            result = self.authenticate(token="test-token")
+
+        assert result == user
+        assert result._stagedoor_next_url == "/next"  # type: ignore
+        assert not [q for q in queries if not q["sql"].startswith("SELECT")]
+
+    @patch("stagedoor.settings.DISABLE_USER_CREATION", False)
+    def test_new_user(self):
+        """Test that a new user is created and attached to the phone number."""
+        phone = PhoneNumber.objects.create(phone_number="+14155551234")
+        AuthToken.objects.create(phone_number=phone, token="123456")
+
+        result = self.authenticate(token="123456", phone_number="+1 415 555 1234")
+
+        assert result is not None
+        phone.refresh_from_db()
+        assert phone.user == result
+
+    @patch("stagedoor.settings.DISABLE_USER_CREATION", True)
+    def test_user_creation_disabled(self):
+        """Test that no user is created when creation is disabled."""
+        email = Email.objects.create(email="test@example.com")
+        AuthToken.objects.create(email=email, token="test-token")
+
+        assert self.authenticate(token="test-token") is None
+        assert not User.objects.exists()
+
+    def test_potential_user(self):
+        """Test that a potential user becomes the contact's user."""
+        user = User.objects.create_user(username="testuser")
+        email = Email.objects.create(email="test@example.com", potential_user=user)
+        AuthToken.objects.create(email=email, token="test-token")
+
+        async def auser():
+            return user
+
+        self.request.auser = auser  # type: ignore[attr-defined]
+        assert self.authenticate(token="test-token") == user
+        email.refresh_from_db()
+        assert email.user == user
+        assert email.potential_user is None
+        user.refresh_from_db()
+        assert user.email == "test@example.com"
+
+    def test_potential_user_other_requester(self):
+        """Test that a link asked for by another user's session is refused."""
+        attacker = User.objects.create_user(username="attacker")
+        email = Email.objects.create(email="test@example.com", potential_user=attacker)
+        AuthToken.objects.create(email=email, token="test-token")
+
+        assert self.authenticate(token="test-token") is None
+        email.refresh_from_db()
+        assert email.user is None
+        assert list(User.objects.all()) == [attacker]
+
+    def test_potential_user_mismatch(self):
+        """Test that a contact promised to another user is refused."""
+        user1 = User.objects.create_user(username="user1")
+        user2 = User.objects.create_user(username="user2")
+        email = Email.objects.create(email="test@example.com", potential_user=user1)
+        AuthToken.objects.create(email=email, token="test-token")
+
+        with patch.object(StageDoorBackend, "aauthenticate", return_value=user2):
+            assert self.authenticate(token="test-token") is None
+
+    def test_invalid_phone_number(self):
+        """Test that an unparseable phone number matches nothing."""
+        assert self.authenticate(token="123456", phone_number="nope") is None
+
+    @patch("stagedoor.settings.SMS_CODE_REQUIRES_CONTACT", True)
+    def test_unscoped_sms_code(self):
+        """Test that SMS backends need the phone number when it is required."""
+        phone = PhoneNumber.objects.create(phone_number="+14155551234")
+        AuthToken.objects.create(phone_number=phone, token="123456")
+
+        assert self.authenticate(SMSTokenBackend(), token="123456") is None
+        assert self.authenticate(EmailTokenBackend(), token="123456") is None
+
+    @patch("stagedoor.settings.HASH_TOKENS", True)
+    def test_hashed_token(self):
+        """Test that hashed tokens are found by digest."""
+        user = User.objects.create_user(username="testuser")
+        email = Email.objects.create(email="test@example.com", user=user)
+        token = AuthToken(email=email)
+        token.set_token("test-token")
+        token.save()
+
+        assert self.authenticate(token="test-token") == user
+        assert self.authenticate(token="other-token") is None
+
+    @patch("stagedoor.settings.SINGLE_USE_LINK", True)
+    def test_single_use(self):
+        """Test that a single-use token is consumed."""
+        user = User.objects.create_user(username="testuser")
+        email = Email.objects.create(email="test@example.com", user=user)
+        AuthToken.objects.create(email=email, token="test-token")
+
+        assert self.authenticate(token="test-token") == user
+        assert self.authenticate(token="test-token") is None
+        assert not AuthToken.objects.exists()
+
+    @patch("stagedoor.settings.PURGE_ON_LOOKUP", True)
+    @patch("stagedoor.settings.PURGE_BATCH_SIZE", 1)
+    def test_purges_stale_tokens(self):
+        """Test that one batch of expired tokens is purged before the lookup."""
+        email = Email.objects.create(email="test@example.com")
+        for token in ("old1", "old2"):
+            AuthToken.objects.create(email=email, token=token)
+        AuthToken.objects.update(expires_at=now() - timedelta(days=1))
+
+        assert self.authenticate(token="old1") is None
+        assert AuthToken.objects.count() == 1
+        assert async_to_sync(AuthToken.adelete_stale)() == 1
+
+    @patch("stagedoor.settings.SIGNED_LINKS", True)
+    @patch("stagedoor.settings.SINGLE_USE_LINK", True)
+    def test_signed_link(self):
+        """Test that a signed link logs in once, and not on the SMS backend."""
+        token = generate_token(email="test@example.com")
+        assert token is not None
+
+        assert self.authenticate(SMSTokenBackend(), token=token.login_token) is None
+        result = self.authenticate(token=token.login_token)
+        assert result is not None
+        assert Email.objects.get(email="test@example.com").user == result
+        assert self.authenticate(token=token.login_token) is None
+        assert self.authenticate(token=token.login_token + "x") is None
+
+    @patch("stagedoor.settings.SIGNED_LINKS", True)
+    def test_signed_link_for_deleted_email(self):
+        """Test that a signed link for a deleted email is rejected."""
+        token = generate_token(email="test@example.com")
+        assert token is not None
+        Email.objects.all().delete()
+
+        assert self.authenticate(token=token.login_token) is None
+
+    def test_aauthenticate_through_django(self):
+        """Test that django.contrib.auth.aauthenticate uses the async backends."""
+        user = User.objects.create_user(username="testuser")
+        email = Email.objects.create(email="test@example.com", user=user)
+        AuthToken.objects.create(email=email, token="test-token")
+
+        with patch.object(
+            TokenBackend, "authenticate", side_effect=AssertionError
+        ) as mock_sync:
+            result = async_to_sync(aauthenticate)(self.request, token="test-token")
+
+        assert result == user
+        mock_sync.assert_not_called()
@@ -0,0 +1,54 @@
+"""
+Tests for django-stagedoor benchmark suite.
+"""
+
+import pytest
+from django.contrib.auth import get_user_model
+
+from benchmarks.run import run, seed, summarize
+from stagedoor.management.commands.stagedoor_seed import SMS_CHARSET
+from stagedoor.models import AuthToken, Email, PhoneNumber
+
+
+def test_summarize():
+    """Test the throughput and percentile summary."""
+    summary = summarize([0.001 * n for n in range(1, 101)])
+
+    assert summary["iterations"] == 100
+    assert summary["min_ms"] == 1
+    assert summary["p50_ms"] == 50.5
+    assert summary["p99_ms"] == 99.01
+    assert summary["max_ms"] == 100
+    assert summarize([0.002])["p90_ms"] == 2
+
+
+@pytest.mark.django_db
+def test_seed_and_run():
+    """Test that a small benchmark run seeds the table and logs users in."""
+    seed(20)
+    assert Email.objects.count() == 10
+    assert PhoneNumber.objects.count() == 10
+    assert AuthToken.objects.count() == 20
+    assert not AuthToken.objects.filter(token_digest=None).exists()
+    assert AuthToken.objects.live().count() == 20
+    codes = AuthToken.objects.filter(phone_number__isnull=False)
+    assert all(
+        set(code) <= set(SMS_CHARSET) for code in codes.values_list("token", flat=True)
+    )
+
+    results = run(20, 3)
+
+    assert set(results) == {
+        "generate_token_email",
+        "generate_token_sms",
+        "login_post_email",
+        "login_post_sms",
+        "token_login_email",
+        "token_post_sms",
+        "token_login_invalid",
+        "delete_stale_100",
+        "approve_tokens_50",
+    }
+    assert results["token_login_email"]["iterations"] == 3
+    assert get_user_model().objects.count() == 6
+    assert not AuthToken.objects.filter(approved=False).exists()
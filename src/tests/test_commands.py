@@ -0,0 +1,218 @@
+"""
+Tests for django-stagedoor management commands.
+"""
+
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+
+import pytest
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.management import CommandError, call_command
+from django.utils.timezone import now
+
+from stagedoor.models import AuthToken, Delivery, Email, PhoneNumber, hash_token
+
+
+@pytest.mark.django_db
+class TestPurgeCommand:
+    """Test the stagedoor_purge management command."""
+
+    def test_purge_deletes_stale_tokens(self):
+        """Test that the command removes stale tokens and keeps live ones."""
+        email = Email.objects.create(email="test@example.com")
+        fresh_token = AuthToken.objects.create(email=email, token="fresh-token")
+        for i in range(3):
+            AuthToken.objects.create(email=email, token=f"stale-{i}")
+        AuthToken.objects.exclude(pk=fresh_token.pk).update(
+            expires_at=now() - timedelta(seconds=3700)
+        )
+
+        out = StringIO()
+        call_command("stagedoor_purge", "--batch-size", "2", stdout=out)
+
+        assert "Deleted 3 stale tokens." in out.getvalue()
+        assert list(AuthToken.objects.all()) == [fresh_token]
+
+    def test_purge_deletes_dead_deliveries(self):
+        """Test that the command removes messages that can't be sent any more."""
+        fields = {"channel": Delivery.EMAIL, "recipient": "test@example.com"}
+        live = Delivery.objects.create(
+            expires_at=now() + timedelta(minutes=5), **fields
+        )
+        Delivery.objects.create(expires_at=now() - timedelta(seconds=1), **fields)
+        Delivery.objects.create(
+            expires_at=now() + timedelta(minutes=5), attempts=5, **fields
+        )
+
+        out = StringIO()
+        call_command("stagedoor_purge", stdout=out)
+
+        assert "Deleted 2 undeliverable messages." in out.getvalue()
+        assert list(Delivery.objects.all()) == [live]
+
+
+@pytest.mark.django_db
+class TestHashTokensCommand:
+    """Test the stagedoor_hash_tokens management command."""
+
+    def test_backfill_stores_digests(self):
+        """Test that the command fills in missing token digests."""
+        email = Email.objects.create(email="test@example.com")
+        token = AuthToken.objects.create(email=email, token="old-token")
+
+        out = StringIO()
+        call_command("stagedoor_hash_tokens", stdout=out)
+
+        assert "Stored digests for 1 tokens." in out.getvalue()
+        token.refresh_from_db()
+        assert token.token_digest == hash_token("old-token")
+
+
+@pytest.mark.django_db
+class TestDeliverCommand:
+    """Test the stagedoor_deliver management command."""
+
+    def test_deliver_sends_queued_messages(self):
+        """Test that the command sends and clears the queue."""
+        email = Email.objects.create(email="test@example.com")
+        Delivery.objects.create(
+            channel=Delivery.EMAIL,
+            recipient="test@example.com",
+            auth_token=AuthToken.objects.create(email=email, token="abc"),
+            domain="example.com",
+            expires_at=now() + timedelta(minutes=5),
+        )
+
+        out = StringIO()
+        call_command("stagedoor_deliver", stdout=out)
+
+        assert "Sent 1 messages, 0 failed." in out.getvalue()
+        assert len(mail.outbox) == 1
+        assert not Delivery.objects.exists()
+
+
+@pytest.mark.django_db
+class TestSeedCommand:
+    """Test the stagedoor_seed management command."""
+
+    def seed(self, *args):
+        out = StringIO()
+        call_command("stagedoor_seed", *args, stdout=out)
+        return out.getvalue()
+
+    def clear(self):
+        Email.objects.all().delete()
+        PhoneNumber.objects.all().delete()
+        get_user_model().objects.all().delete()
+
+    def snapshot(self):
+        return sorted(
+            AuthToken.objects.values_list(
+                "token",
+                "email__email",
+                "email__user__username",
+                "phone_number__phone_number",
+                "approved",
+            )
+        )
+
+    def test_seed_counts(self):
+        """Test that the command creates the rows asked for, in batches."""
+        output = self.seed(
+            "--emails", "7", "--phone-numbers", "5", "--tokens", "30",
+            "--user-ratio", "1", "--batch-size", "4",
+        )  # fmt: skip
+
+        assert "Seeded 7 emails, 5 phone numbers, 12 users and 30 tokens." in output
+        assert Email.objects.filter(user__isnull=False).count() == 7
+        assert PhoneNumber.objects.filter(user__isnull=False).count() == 5
+        assert AuthToken.objects.count() == 30
+        assert not AuthToken.objects.filter(token_digest__isnull=True).exists()
+        assert (
+            AuthToken.objects.filter(email__isnull=False).count()
+            + AuthToken.objects.filter(phone_number__isnull=False).count()
+            == 30
+        )
+        assert all(
+            token.token_digest == hash_token(token.token)
+            for token in AuthToken.objects.all()
+        )
+
+    def test_seed_is_deterministic(self):
+        """Test that the same seed produces the same rows."""
+        args = ["--emails", "20", "--phone-numbers", "20", "--tokens", "50"]
+        self.seed(*args, "--seed", "3", "--approval-ratio", "0.5")
+        first = self.snapshot()
+        self.clear()
+
+        self.seed(*args, "--seed", "3", "--approval-ratio", "0.5")
+        assert self.snapshot() == first
+        assert len({token for token, *_ in first}) == 50
+
+        self.clear()
+        self.seed(*args, "--seed", "4", "--approval-ratio", "0.5")
+        assert self.snapshot() != first
+
+    def test_seed_ages_and_approval(self):
+        """Test the stale and approved ratios and the age limit."""
+        started = now()
+        self.seed(
+            "--tokens", "100", "--stale-ratio", "1", "--approval-ratio", "0",
+            "--max-age", "7200", "--age-distribution", "uniform",
+        )  # fmt: skip
+
+        assert (
+            AuthToken.objects.filter(
+                timestamp__lt=started - timedelta(seconds=30 * 60)
+            ).count()
+            == 100
+        )
+        assert not AuthToken.objects.filter(approved=True).exists()
+        assert not AuthToken.objects.filter(expires_at__isnull=False).exists()
+        assert not AuthToken.objects.filter(
+            timestamp__lt=started - timedelta(seconds=7200)
+        ).exists()
+
+        self.clear()
+        with patch("stagedoor.settings.SMS_TOKEN_DURATION", 120):
+            self.seed("--emails", "0", "--tokens", "100", "--stale-ratio", "0")
+        assert AuthToken.objects.live().count() == 100
+        assert AuthToken.objects.filter(approved=True).count() == 100
+        assert not AuthToken.objects.filter(
+            timestamp__lt=now() - timedelta(seconds=120)
+        ).exists()
+
+        self.clear()
+        self.seed("--phone-numbers", "0", "--tokens", "100", "--stale-ratio", "1")
+        assert AuthToken.objects.stale().count() == 100
+
+    @patch("stagedoor.settings.SMS_TOKEN_LENGTH", 1)
+    def test_seed_repeated_sms_codes(self):
+        """Test that codes past the end of the code space repeat across numbers."""
+        self.seed("--emails", "0", "--phone-numbers", "3", "--tokens", "12")
+
+        assert not AuthToken.objects.filter(token_digest__isnull=True).exists()
+        digests = AuthToken.objects.values_list("phone_number", "token_digest")
+        assert len(set(digests)) == 12
+        assert len({digest for _, digest in digests}) == 9
+
+        self.clear()
+        with pytest.raises(CommandError):
+            self.seed("--emails", "0", "--phone-numbers", "1", "--tokens", "10")
+
+    @pytest.mark.parametrize(
+        "args",
+        [
+            ["--user-ratio", "1.5"],
+            ["--tokens", "-1"],
+            ["--batch-size", "0"],
+            ["--emails", "0", "--phone-numbers", "0"],
+            ["--max-age", "60"],
+        ],
+    )
+    def test_seed_rejects_bad_arguments(self, args):
+        """Test that impossible arguments are refused."""
+        with pytest.raises(CommandError):
+            self.seed(*args)
@@ -2,13 +2,30 @@
 Tests for django-stagedoor helper functions.
 """
 
+from datetime import timedelta
 from unittest.mock import Mock, patch
 
 import pytest
-from django.test import RequestFactory
-
-from stagedoor.helpers import email_admin_approval, email_login_link, sms_login_link
-from stagedoor.models import AuthToken, Email, PhoneNumber
+from django.contrib.sites.models import Site
+from django.core import mail
+from django.template.loader import get_template
+from django.test import RequestFactory, override_settings
+from django.utils import translation
+from django.utils.timezone import now
+
+from stagedoor.helpers import (
+    APPROVAL_EMAIL,
+    LOGIN_EMAIL,
+    claim_deliveries,
+    clear_email_templates,
+    deliver_pending,
+    email_admin_approval,
+    email_login_link,
+    queue_login_link,
+    sms_login_link,
+)
+from stagedoor.models import AuthToken, Delivery, Email, PhoneNumber, generate_token
+from stagedoor.stores import get_token_store
 
 
 @pytest.mark.django_db
@@ -20,22 +37,13 @@ class TestEmailHelpers:
         self.factory = RequestFactory()
 
     @patch("stagedoor.helpers.send_mail")
-    @patch("stagedoor.helpers.get_template")
-    @patch("stagedoor.helpers.render_to_string")
     @patch("stagedoor.helpers.get_current_site")
-    def test_email_login_link(
-        self, mock_get_site, mock_render, mock_get_template, mock_send_mail
-    ):
+    def test_email_login_link(self, mock_get_site, mock_send_mail):
         """Test sending login link via email."""
         # Setup mocks
         mock_site = Mock()
         mock_site.domain = "example.com"
         mock_get_site.return_value = mock_site
-        mock_render.return_value = "Plain text message"
-
-        mock_template = Mock()
-        mock_template.render.return_value = "<html>HTML message</html>"
-        mock_get_template.return_value = mock_template
 
         # Create test data
         email = Email.objects.create(email="test@example.com")
@@ -47,35 +55,28 @@ class TestEmailHelpers:
 
         # Verify mocks were called
         mock_get_site.assert_called_once_with(request)
-        mock_render.assert_called_once()
-        mock_get_template.assert_called_once()
         mock_send_mail.assert_called_once()
 
         # Check send_mail call arguments
         call_args = mock_send_mail.call_args
         assert call_args[1]["recipient_list"] == ["test@example.com"]
         assert "Here's your login to" in call_args[1]["subject"]
-        assert call_args[1]["message"] == "Plain text message"
-        assert call_args[1]["html_message"] == "<html>HTML message</html>"
+        assert "https://example.com/auth/login/test-token" in call_args[1]["message"]
+        assert "<h1>Hello!</h1>" in call_args[1]["html_message"]
+        assert (
+            "https://example.com/auth/login/test-token"
+            in (call_args[1]["html_message"])
+        )
         assert call_args[1]["fail_silently"] is False
 
     @patch("stagedoor.helpers.send_mail")
-    @patch("stagedoor.helpers.get_template")
-    @patch("stagedoor.helpers.render_to_string")
     @patch("stagedoor.helpers.get_current_site")
-    def test_email_admin_approval(
-        self, mock_get_site, mock_render, mock_get_template, mock_send_mail
-    ):
+    def test_email_admin_approval(self, mock_get_site, mock_send_mail):
         """Test sending admin approval email."""
         # Setup mocks
         mock_site = Mock()
         mock_site.domain = "example.com"
         mock_get_site.return_value = mock_site
-        mock_render.return_value = "Plain text approval message"
-
-        mock_template = Mock()
-        mock_template.render.return_value = "<html>HTML approval message</html>"
-        mock_get_template.return_value = mock_template
 
         # Create test data
         email = Email.objects.create(email="admin@example.com")
@@ -83,57 +84,45 @@ class TestEmailHelpers:
         request = self.factory.get("/")
 
         # Call function
-        email_admin_approval(request, token)
+        with patch.object(
+            APPROVAL_EMAIL, "render", wraps=APPROVAL_EMAIL.render
+        ) as mock_render:
+            email_admin_approval(request, token)
 
         # Verify mocks were called
         mock_get_site.assert_called_once_with(request)
         mock_render.assert_called_once()
-        mock_get_template.assert_called_once()
         mock_send_mail.assert_called_once()
 
         # Check send_mail call arguments
         call_args = mock_send_mail.call_args
         assert call_args[1]["recipient_list"] == ["webmaster@localhost"]
         assert "New account created on" in call_args[1]["subject"]
-        assert call_args[1]["message"] == "Plain text approval message"
-        assert call_args[1]["html_message"] == "<html>HTML approval message</html>"
+        assert (
+            "https://example.com/admin/stagedoor/authtoken/"
+            in (call_args[1]["message"])
+        )
+        assert "<h1>Hello!</h1>" in call_args[1]["html_message"]
 
         # Check that context includes contact info for email tokens
-        render_call_args = mock_render.call_args
-        context = render_call_args[0][1]  # Second argument is the context
+        context = mock_render.call_args[0][0]
         assert context["contact_info"] == "admin@example.com"
         assert context["contact_type"] == "email"
 
     @patch("stagedoor.helpers.send_mail")
-    @patch("stagedoor.helpers.get_template")
-    @patch("stagedoor.helpers.render_to_string")
-    @patch("stagedoor.helpers.get_current_site")
-    def test_email_admin_approval_phone(
-        self, mock_get_site, mock_render, mock_get_template, mock_send_mail
-    ):
+    def test_email_admin_approval_phone(self, mock_send_mail):
         """Test sending admin approval email for phone number."""
-        # Setup mocks
-        mock_site = Mock()
-        mock_site.domain = "example.com"
-        mock_get_site.return_value = mock_site
-        mock_render.return_value = "Plain text approval message"
-
-        mock_template = Mock()
-        mock_template.render.return_value = "<html>HTML approval message</html>"
-        mock_get_template.return_value = mock_template
-
         # Create test data with phone number
         phone = PhoneNumber.objects.create(phone_number="+14155551234")
         token = AuthToken.objects.create(phone_number=phone, token="approval-token")
         request = self.factory.get("/")
 
         # Call function
-        email_admin_approval(request, token)
+        with patch.object(
+            APPROVAL_EMAIL, "render", wraps=APPROVAL_EMAIL.render
+        ) as mock_render:
+            email_admin_approval(request, token)
 
-        # Verify mocks were called
-        mock_get_site.assert_called_once_with(request)
-        mock_render.assert_called_once()
-        mock_get_template.assert_called_once()
         mock_send_mail.assert_called_once()
 
         # Check send_mail call arguments
@@ -141,13 +130,11 @@ class TestEmailHelpers:
         assert call_args[1]["recipient_list"] == ["webmaster@localhost"]
 
         # Check that context includes contact info for phone tokens
-        render_call_args = mock_render.call_args
-        context = render_call_args[0][1]  # Second argument is the context
+        context = mock_render.call_args[0][0]
         assert context["contact_info"] == "+14155551234"
         assert context["contact_type"] == "phone number"
 
-    @patch("stagedoor.helpers.render_to_string")
-    def test_email_template_context(self, mock_render):
+    def test_email_template_context(self):
         """Test that email templates receive correct context variables."""
         # Create test data
         email = Email.objects.create(email="test@example.com")
@@ -156,7 +143,9 @@ class TestEmailHelpers:
 
         with (
             patch("stagedoor.helpers.send_mail"),
-            patch("stagedoor.helpers.get_template"),
+            patch.object(
+                LOGIN_EMAIL, "render", wraps=LOGIN_EMAIL.render
+            ) as mock_render,
             patch("stagedoor.helpers.get_current_site") as mock_get_site,
         ):
             mock_site = Mock()
@@ -165,10 +154,9 @@ class TestEmailHelpers:
 
             email_login_link(request, token)
 
-            # Check render_to_string was called with correct context
+            # Check the renderer was called with correct context
             mock_render.assert_called_once()
-            call_args = mock_render.call_args
-            context = call_args[0][1]  # Second argument is the context
+            context = mock_render.call_args[0][0]
 
             assert context["current_site"] == mock_site
             assert context["token"] == "context-token"
@@ -176,6 +164,58 @@ class TestEmailHelpers:
             assert "support_email" in context
 
 
+class TestEmailRenderer:
+    """Test the compiled email template cache."""
+
+    def setup_method(self):
+        """Start every test with an empty template cache."""
+        clear_email_templates(setting="TEMPLATES")
+
+    def render_contexts(self):
+        """Build contexts for two login emails."""
+        site = Site(domain="example.com", name="example.com")
+        return [
+            {"current_site": site, "token": token, "site_name": "Site"}
+            for token in ("one", "two")
+        ]
+
+    def test_render_many(self):
+        """Test that each context gets its own subject and bodies."""
+        rendered = LOGIN_EMAIL.render_many(self.render_contexts())
+
+        assert [subject for subject, _, _ in rendered] == [
+            "Here's your login to Site",
+            "Here's your login to Site",
+        ]
+        assert "https://example.com/auth/login/one" in rendered[0][1]
+        assert "https://example.com/auth/login/two" in rendered[1][1]
+        assert "https://example.com/auth/login/two" in rendered[1][2]
+
+    def test_templates_compiled_once(self):
+        """Test that templates are loaded once per name and language."""
+        with patch("stagedoor.helpers.get_template", wraps=get_template) as mock_get:
+            LOGIN_EMAIL.render_many(self.render_contexts())
+            LOGIN_EMAIL.render_many(self.render_contexts())
+            assert mock_get.call_count == 2
+
+            with translation.override("fr"):
+                LOGIN_EMAIL.render_many(self.render_contexts())
+            assert mock_get.call_count == 4
+
+            clear_email_templates(setting="TEMPLATES")
+            LOGIN_EMAIL.render_many(self.render_contexts())
+            assert mock_get.call_count == 6
+
+    @override_settings(DEBUG=True)
+    def test_debug_reloads_templates(self):
+        """Test that templates are looked up on every render with DEBUG on."""
+        with patch("stagedoor.helpers.get_template", wraps=get_template) as mock_get:
+            LOGIN_EMAIL.render_many(self.render_contexts())
+            LOGIN_EMAIL.render_many(self.render_contexts())
+
+        assert mock_get.call_count == 4
+
+
 @pytest.mark.django_db
 class TestSMSHelpers:
     """Test SMS helper functions."""
@@ -220,3 +260,160 @@ class TestSMSHelpers:
 
         # Should not raise an exception, just do nothing
         sms_login_link(request, token)
+
+
+@pytest.mark.django_db
+class TestDeliveryOutbox:
+    """Test the queued delivery of login messages."""
+
+    def setup_method(self):
+        """Set up test fixtures."""
+        self.factory = RequestFactory()
+
+    def test_queue_email(self):
+        """Test that an email token is queued without its token string."""
+        email = Email.objects.create(email="test@example.com")
+        token = AuthToken.objects.create(email=email, token="queued-token")
+
+        delivery = queue_login_link(self.factory.get("/"), token)
+
+        assert delivery.channel == Delivery.EMAIL
+        assert delivery.recipient == "test@example.com"
+        assert delivery.auth_token == token
+        assert delivery.expires_at == token.expires_at
+        assert delivery.domain == "example.com"
+        assert "queued-token" not in Delivery.objects.values_list().get()
+
+    def test_deliver_pending_sends_and_deletes(self):
+        """Test that queued messages are sent once, with fresh strings, and removed."""
+        email = Email.objects.create(email="test@example.com")
+        phone = PhoneNumber.objects.create(phone_number="+14155551234")
+        request = self.factory.get("/")
+        email_token = AuthToken.objects.create(email=email, token="abc")
+        sms_token = AuthToken.objects.create(phone_number=phone, token="123456")
+        queue_login_link(request, email_token)
+        queue_login_link(request, sms_token)
+
+        with patch("stagedoor.helpers.sms_login_link") as mock_sms:
+            assert deliver_pending() == (2, 0)
+
+        email_token.refresh_from_db()
+        assert email_token.token != "abc"
+        assert len(mail.outbox) == 1
+        assert mail.outbox[0].to == ["test@example.com"]
+        assert f"https://example.com/auth/login/{email_token.token}" in (
+            mail.outbox[0].body
+        )
+        sent_sms = mock_sms.call_args[0][1]
+        assert sent_sms.pk == sms_token.pk
+        assert AuthToken.lookup(sent_sms.login_token) == sms_token
+        assert str(sent_sms.phone_number.phone_number) == "+14155551234"
+        assert not Delivery.objects.exists()
+
+    @patch("stagedoor.settings.DELIVERY_MAX_ATTEMPTS", 2)
+    def test_deliver_pending_keeps_failures(self):
+        """Test that failed messages are kept and retried up to the limit."""
+        email = Email.objects.create(email="test@example.com")
+        token = AuthToken.objects.create(email=email, token="abc")
+        delivery = queue_login_link(self.factory.get("/"), token)
+
+        with patch("stagedoor.helpers.send_mail", side_effect=OSError("down")):
+            assert deliver_pending() == (0, 1)
+            assert deliver_pending() == (0, 1)
+            assert deliver_pending() == (0, 0)
+
+        delivery.refresh_from_db()
+        assert delivery.attempts == 2
+        assert delivery.last_error == "down"
+        assert delivery.claimed_until is None
+
+        with patch("stagedoor.settings.PURGE_BATCH_SIZE", 1):
+            assert Delivery.purge_dead() == 1
+        assert not Delivery.objects.exists()
+
+    def test_deliver_pending_deletes_each_sent_message(self):
+        """Test that a message is removed as soon as it is sent."""
+        request = self.factory.get("/")
+        for address in ("first@example.com", "second@example.com"):
+            email = Email.objects.create(email=address)
+            queue_login_link(
+                request, AuthToken.objects.create(email=email, token=address)
+            )
+        remaining = []
+
+        def send(delivery):
+            remaining.append(Delivery.objects.count())
+            if len(remaining) == 2:
+                raise OSError("down")
+
+        with patch("stagedoor.helpers.send_delivery", side_effect=send):
+            assert deliver_pending() == (1, 1)
+        assert remaining == [2, 1]
+        assert Delivery.objects.get().recipient == "second@example.com"
+
+    def test_consumed_token_message_dropped(self):
+        """Test that a message whose token was used meanwhile is dropped unsent."""
+        email = Email.objects.create(email="test@example.com")
+        token = AuthToken.objects.create(email=email, token="abc")
+        queue_login_link(self.factory.get("/"), token)
+
+        assert AuthToken.consume("abc") == token
+        assert Delivery.objects.count() == 1
+        assert deliver_pending() == (0, 0)
+        assert not mail.outbox
+        assert not Delivery.objects.exists()
+
+    def test_claimed_messages_are_leased(self):
+        """Test that messages are sent after their claim, which others skip."""
+        email = Email.objects.create(email="test@example.com")
+        queue_login_link(
+            self.factory.get("/"), AuthToken.objects.create(email=email, token="abc")
+        )
+        claimed_while_sending = []
+
+        def send(delivery):
+            claimed_while_sending.append(claim_deliveries())
+
+        with patch("stagedoor.helpers.send_delivery", side_effect=send):
+            assert deliver_pending() == (1, 0)
+        assert claimed_while_sending == [[]]
+
+    def test_expired_messages_are_skipped(self):
+        """Test that messages for expired tokens are not sent but purged."""
+        email = Email.objects.create(email="test@example.com")
+        token = AuthToken.objects.create(email=email, token="abc")
+        queue_login_link(self.factory.get("/"), token)
+        Delivery.objects.update(expires_at=now() - timedelta(seconds=1))
+
+        assert deliver_pending() == (0, 0)
+        assert not mail.outbox
+        assert Delivery.purge_dead() == 1
+
+    @patch("stagedoor.settings.TOKEN_STORE", "stagedoor.stores.CacheTokenStore")
+    def test_deliver_cached_token(self):
+        """Test that a token that isn't a row is issued again as it is sent."""
+        token = generate_token(phone_number="+14155551234")
+        assert token is not None and token.pk is None
+        queue_login_link(self.factory.get("/"), token)
+
+        with patch("stagedoor.helpers.sms_login_link") as mock_sms:
+            assert deliver_pending() == (1, 0)
+
+        sent = mock_sms.call_args[0][1]
+        assert sent.login_token != token.login_token
+        assert sent.expires_at == token.expires_at
+        assert not AuthToken.objects.exists()
+        assert get_token_store().lookup(sent.login_token) is not None
+
+    @patch("stagedoor.settings.SIGNED_LINKS", True)
+    def test_deliver_signed_link(self):
+        """Test that a signed link is signed again as it is sent."""
+        token = generate_token(email="test@example.com", next_url="/next")
+        assert token is not None and token.pk is None
+        queue_login_link(self.factory.get("/"), token)
+
+        assert deliver_pending() == (1, 0)
+
+        assert len(mail.outbox) == 1
+        assert "https://example.com/auth/login/" in mail.outbox[0].body
+        assert not AuthToken.objects.exists()
@@ -0,0 +1,260 @@
+"""
+Tests for django-stagedoor metrics.
+"""
+
+import logging
+import socket
+from datetime import timedelta
+from unittest.mock import patch
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.contrib.auth import authenticate
+from django.test import RequestFactory
+from django.urls import reverse
+from django.utils.timezone import now
+
+from stagedoor import metrics
+from stagedoor.backends import TokenBackend
+from stagedoor.helpers import email_login_link, sms_login_link
+from stagedoor.metrics import (
+    LoggingSink,
+    RegistrySink,
+    StatsDSink,
+    get_metrics_sink,
+)
+from stagedoor.models import AuthToken, Email, generate_token, save_new_token
+
+REGISTRY = "stagedoor.metrics.RegistrySink"
+
+
+class TestRegistrySink:
+    """Test the in-process registry and its exposition."""
+
+    def test_exposition(self):
+        """Test that counters and cumulative histograms are written out."""
+        sink = RegistrySink()
+        sink.increment("logins_total", {"channel": "sms", "result": "ok"})
+        sink.increment("logins_total", {"result": "ok", "channel": "sms"}, 2)
+        sink.increment("logins_total", {"channel": 'a"b\\'})
+        sink.observe("login_seconds", {"channel": "sms"}, 0.003)
+        sink.observe("login_seconds", {"channel": "sms"}, 0.2)
+        sink.observe("login_seconds", {"channel": "sms"}, 60)
+
+        lines = sink.exposition().splitlines()
+
+        assert lines[:3] == [
+            "# TYPE logins_total counter",
+            'logins_total{channel="a\\"b\\\\"} 1',
+            'logins_total{channel="sms",result="ok"} 3',
+        ]
+        assert "# TYPE login_seconds histogram" in lines
+        assert 'login_seconds_bucket{channel="sms",le="0.005"} 1' in lines
+        assert 'login_seconds_bucket{channel="sms",le="0.25"} 2' in lines
+        assert 'login_seconds_bucket{channel="sms",le="10.0"} 2' in lines
+        assert 'login_seconds_bucket{channel="sms",le="+Inf"} 3' in lines
+        assert 'login_seconds_sum{channel="sms"} 60.203' in lines
+        assert 'login_seconds_count{channel="sms"} 3' in lines
+
+        sink.clear()
+        assert sink.exposition() == ""
+
+
+def test_disabled_by_default():
+    """Test that nothing is recorded without a sink."""
+    assert get_metrics_sink() is None
+    metrics.increment("anything_total")
+    with metrics.timer("anything_seconds", "anything_total"):
+        pass
+
+
+def test_timer_counts_errors():
+    """Test that a block that raises is counted as an error."""
+    sink = RegistrySink()
+    with patch("stagedoor.metrics.get_metrics_sink", return_value=sink):
+        with pytest.raises(ValueError):
+            with metrics.timer("work_seconds", "work_total", channel="sms"):
+                raise ValueError
+    assert sink.counters == {
+        ("work_total", (("channel", "sms"), ("result", "error"))): 1
+    }
+    assert sum(sink.histograms[("work_seconds", (("channel", "sms"),))][0]) == 1
+
+
+def test_logging_sink(caplog):
+    """Test that the logging sink writes one line per metric."""
+    with caplog.at_level(logging.INFO, logger="stagedoor.metrics"):
+        LoggingSink().increment("logins_total", {"channel": "sms"})
+        LoggingSink().observe("login_seconds", {}, 0.5)
+    assert caplog.messages == [
+        'logins_total{channel="sms"} +1',
+        "login_seconds 0.500000",
+    ]
+
+
+def test_statsd_sink():
+    """Test that the StatsD sink sends counters and timings over UDP."""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.settimeout(5)
+    sink = StatsDSink()
+    try:
+        with patch("stagedoor.settings.STATSD_PORT", listener.getsockname()[1]):
+            sink.increment("logins_total", {"channel": "sms", "result": "ok"})
+            sink.observe("login_seconds", {"channel": "sms"}, 0.0125)
+        assert listener.recv(512) == b"logins_total.sms.ok:1|c"
+        assert listener.recv(512) == b"login_seconds.sms:12.500|ms"
+    finally:
+        listener.close()
+
+    with patch("stagedoor.settings.STATSD_HOST", "256.0.0.1"):
+        sink.increment("logins_total", {})
+
+
+@pytest.mark.django_db
+@patch("stagedoor.settings.METRICS_SINK", REGISTRY)
+class TestInstrumentation:
+    """Test the metrics recorded by the login flow."""
+
+    def setup_method(self):
+        """Set up test fixtures."""
+        with patch("stagedoor.settings.METRICS_SINK", REGISTRY):
+            sink = get_metrics_sink()
+        assert isinstance(sink, RegistrySink)
+        self.sink = sink
+        self.sink.clear()
+        self.request = RequestFactory().get("/")
+
+    def count(self, name, **labels):
+        return self.sink.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def observations(self, name, **labels):
+        counts, _ = self.sink.histograms[(name, tuple(sorted(labels.items())))]
+        return sum(counts)
+
+    def test_generate_token(self):
+        """Test that issued tokens are counted and timed by channel."""
+        generate_token(email="test@example.com")
+        generate_token(phone_number="+14155551234")
+
+        assert self.count("stagedoor_tokens_issued_total", channel="email") == 1
+        assert self.count("stagedoor_tokens_issued_total", channel="sms") == 1
+        assert self.observations("stagedoor_token_issue_seconds", channel="sms") == 1
+
+    def test_collisions(self):
+        """Test that token strings drawn again are counted."""
+        email = Email.objects.create(email="test@example.com")
+        existing = AuthToken(email=email)
+        existing.set_token("taken")
+        existing.save()
+        token = AuthToken(email=email)
+        token.set_token("taken")
+
+        save_new_token(token)
+
+        assert self.count("stagedoor_token_collisions_total", channel="email") == 1
+
+    @patch("stagedoor.settings.PURGE_ON_LOOKUP", False)
+    def test_login_results(self):
+        """Test that logins are counted by result and timed."""
+        token = generate_token(email="test@example.com")
+        assert token is not None
+        expired = generate_token(email="old@example.com")
+        assert expired is not None
+        AuthToken.objects.filter(pk=expired.pk).update(
+            expires_at=now() - timedelta(seconds=1)
+        )
+        backend = TokenBackend()
+
+        assert backend.authenticate(self.request, token=token.login_token)
+        assert backend.authenticate(self.request, token=expired.login_token) is None
+        assert backend.authenticate(self.request, token="missing") is None
+        with patch.object(TokenBackend, "finish_email_login", return_value=None):
+            assert backend.authenticate(self.request, token=token.login_token) is None
+
+        for result, count in (
+            ("ok", 1),
+            ("unknown", 1),
+            ("expired", 1),
+            ("mismatch", 1),
+        ):
+            assert (
+                self.count("stagedoor_logins_total", channel="any", result=result)
+                == count
+            )
+        assert self.observations("stagedoor_login_seconds", channel="any") == 4
+
+    @patch("stagedoor.settings.PURGE_ON_LOOKUP", False)
+    def test_async_login_results(self):
+        """Test that async logins are counted the same way."""
+        token = generate_token(phone_number="+14155551234")
+        assert token is not None
+        backend = TokenBackend()
+        backend.channel = "sms"
+        authenticate = async_to_sync(backend.aauthenticate)
+
+        assert authenticate(self.request, token=token.login_token)
+        assert authenticate(self.request, token="missing") is None
+        with patch.object(TokenBackend, "afinish_sms_login", return_value=None):
+            assert authenticate(self.request, token=token.login_token) is None
+
+        for result in ("ok", "unknown", "mismatch"):
+            assert (
+                self.count("stagedoor_logins_total", channel="sms", result=result) == 1
+            )
+
+    @patch("stagedoor.settings.PURGE_ON_LOOKUP", False)
+    def test_backend_pair(self):
+        """Test that an SMS login through the backend pair counts no rejection."""
+        token = generate_token(phone_number="+14155551234")
+        assert token is not None
+
+        assert authenticate(self.request, token=token.login_token)
+
+        assert self.count("stagedoor_logins_total", channel="sms", result="ok") == 1
+        assert not [
+            key for key in self.sink.counters if ("result", "unknown") in key[1]
+        ]
+
+    def test_purge(self):
+        """Test that purged tokens are counted."""
+        email = Email.objects.create(email="test@example.com")
+        AuthToken.objects.create(email=email, token="old")
+        AuthToken.objects.update(expires_at=now() - timedelta(seconds=1))
+
+        assert AuthToken.delete_stale() == 1
+        assert AuthToken.delete_stale() == 0
+        assert self.count("stagedoor_tokens_purged_total") == 1
+
+    @patch("stagedoor.settings.SMS_TRANSPORT", "stagedoor.sms.LocmemTransport")
+    def test_deliveries(self):
+        """Test that sent and failed login messages are counted and timed."""
+        email_token = generate_token(email="test@example.com")
+        sms_token = generate_token(phone_number="+14155551234")
+
+        email_login_link(self.request, email_token)  # type: ignore[arg-type]
+        with patch("stagedoor.sms.LocmemTransport.send", side_effect=OSError):
+            with pytest.raises(OSError):
+                sms_login_link(self.request, sms_token)  # type: ignore[arg-type]
+
+        assert (
+            self.count("stagedoor_deliveries_total", channel="email", result="ok") == 1
+        )
+        assert (
+            self.count("stagedoor_deliveries_total", channel="sms", result="error") == 1
+        )
+        assert self.observations("stagedoor_delivery_seconds", channel="email") == 1
+
+    def test_view(self, client):
+        """Test that the view serves the registry."""
+        generate_token(email="test@example.com")
+
+        response = client.get(reverse("metrics"))
+
+        assert response.status_code == 200
+        assert response["Content-Type"].startswith("text/plain; version=0.0.4")
+        assert 'stagedoor_tokens_issued_total{channel="email"} 1' in (
+            response.content.decode()
+        )
+        with patch("stagedoor.settings.METRICS_SINK", None):
+            assert client.get(reverse("metrics")).status_code == 404
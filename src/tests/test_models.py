@@ -7,14 +7,20 @@ from unittest.mock import patch
 
 import pytest
 from django.contrib.auth import get_user_model
+from django.db import IntegrityError, connection
+from django.test.utils import CaptureQueriesContext
 from django.utils.timezone import now
 
 from stagedoor.models import (
     AuthToken,
+    Delivery,
     Email,
     PhoneNumber,
     generate_token,
     generate_token_string,
+    hash_token,
+    save_new_token,
+    upsert_contact,
 )
 
 User = get_user_model()
@@ -179,12 +185,12 @@ class TestAuthTokenModel:
         # Create a fresh token
         fresh_token = AuthToken.objects.create(email=email, token="fresh-token")
 
-        # Create a stale token by mocking its timestamp
+        # Create a stale token by mocking its expiry
         stale_token = AuthToken.objects.create(email=email, token="stale-token")
 
-        # Manually set timestamp to be old
-        old_time = now() - timedelta(seconds=3700)  # Older than default 3600 seconds
-        AuthToken.objects.filter(pk=stale_token.pk).update(timestamp=old_time)
+        # Manually set it to have expired
+        old_time = now() - timedelta(seconds=3700)
+        AuthToken.objects.filter(pk=stale_token.pk).update(expires_at=old_time)
 
         # Delete stale tokens
         AuthToken.delete_stale()
@@ -198,12 +204,11 @@ class TestAuthTokenModel:
         """Test deletion of stale tokens with custom duration."""
         email = Email.objects.create(email="test@example.com")
 
-        # Create token
-        token = AuthToken.objects.create(email=email, token="custom-duration-token")
-
-        # Set timestamp to be older than custom duration
-        old_time = now() - timedelta(seconds=2000)  # Older than 1800 seconds
-        AuthToken.objects.filter(pk=token.pk).update(timestamp=old_time)
+        # Create token 2000 seconds ago, longer than the custom duration
+        token = AuthToken(email=email, token="custom-duration-token")
+        token.set_expiry(now() - timedelta(seconds=2000))
+        token.save()
+        assert token.expires_at < now()  # type: ignore[operator]
 
         # Delete stale tokens
         AuthToken.delete_stale()
@@ -211,6 +216,281 @@ class TestAuthTokenModel:
         # Token should be deleted
         assert not AuthToken.objects.filter(pk=token.pk).exists()
 
+    def test_purge_stale_in_batches(self):
+        """Test that purge_stale removes every stale token across batches."""
+        email = Email.objects.create(email="test@example.com")
+        fresh_token = AuthToken.objects.create(email=email, token="fresh-token")
+        for i in range(5):
+            AuthToken.objects.create(email=email, token=f"stale-{i}")
+        old_time = now() - timedelta(seconds=3700)
+        AuthToken.objects.exclude(pk=fresh_token.pk).update(expires_at=old_time)
+
+        assert AuthToken.purge_stale(batch_size=2, max_batches=2) == 4
+        assert AuthToken.objects.count() == 2
+        deleted = AuthToken.purge_stale(batch_size=2)
+
+        assert deleted == 1
+        assert list(AuthToken.objects.all()) == [fresh_token]
+
+    def test_live_and_stale_querysets(self):
+        """Test that live() and stale() split tokens on the expiry cutoff."""
+        email = Email.objects.create(email="test@example.com")
+        fresh_token = AuthToken.objects.create(email=email, token="fresh-token")
+        stale_token = AuthToken.objects.create(email=email, token="stale-token")
+        old_time = now() - timedelta(seconds=3700)
+        AuthToken.objects.filter(pk=stale_token.pk).update(expires_at=old_time)
+
+        assert list(AuthToken.objects.live()) == [fresh_token]
+        assert list(AuthToken.objects.stale()) == [stale_token]
+
+    def test_pending_tokens_wait_for_approval(self):
+        """Test that tokens waiting for approval are neither live nor purged."""
+        email = Email.objects.create(email="test@example.com")
+        live_token = AuthToken.objects.create(email=email, token="live-token")
+        kept = AuthToken.objects.create(email=email, token="kept", approved=False)
+        with patch("stagedoor.settings.PENDING_TOKEN_DURATION", 24 * 60 * 60):
+            expiring = AuthToken.objects.create(
+                email=email, token="expiring", approved=False
+            )
+        assert kept.expires_at is None
+        AuthToken.objects.filter(pk=expiring.pk).update(
+            expires_at=now() - timedelta(seconds=1)
+        )
+
+        assert list(AuthToken.objects.live()) == [live_token]
+        assert list(AuthToken.objects.pending()) == [kept, expiring]
+        assert list(AuthToken.objects.stale()) == [expiring]
+        assert AuthToken.delete_stale() == 1
+        assert list(AuthToken.objects.pending()) == [kept]
+
+    def test_pending_index_matches_queue_order(self):
+        """Test that the partial pending index is on the column the queue pages by."""
+        (index,) = [
+            index
+            for index in AuthToken._meta.indexes
+            if index.name == "stagedoor_auth_pending_idx"
+        ]
+        assert index.fields == [AuthToken._meta.pk.name]
+        assert AuthToken.objects.pending().query.order_by == ("pk",)
+
+    @patch("stagedoor.settings.PENDING_TOKEN_DURATION", 60)
+    @patch("stagedoor.settings.EMAIL_TOKEN_DURATION", 3600)
+    def test_approving_by_save_sets_expiry(self):
+        """Test that approving a token by saving it, as the admin does, sets expiry."""
+        email = Email.objects.create(email="test@example.com")
+        first = AuthToken.objects.create(email=email, token="first", approved=False)
+        second = AuthToken.objects.create(email=email, token="second", approved=False)
+
+        first = AuthToken.objects.get(pk=first.pk)
+        first.approved = True
+        first.save()
+        second = AuthToken.objects.get(pk=second.pk)
+        second.approved = True
+        second.save(update_fields=["approved"])
+
+        for token in (first, second):
+            token.refresh_from_db()
+            ttl = token.expires_at - now()  # type: ignore[operator]
+            assert abs(ttl - timedelta(hours=1)) < timedelta(seconds=5)
+        assert set(AuthToken.objects.live()) == {first, second}
+
+        # Saving an already approved token leaves its expiry alone.
+        expires_at = first.expires_at
+        first.next_url = "/elsewhere"
+        first.save()
+        first.refresh_from_db()
+        assert first.expires_at == expires_at
+
+    @patch("stagedoor.settings.EMAIL_TOKEN_DURATION", 3600)
+    @patch("stagedoor.settings.SMS_TOKEN_DURATION", 120)
+    def test_expiry_per_channel(self):
+        """Test that email links and SMS codes get their own lifetimes."""
+        email_token = generate_token(email="test@example.com")
+        sms_token = generate_token(phone_number="+14155551234")
+        assert email_token is not None and sms_token is not None
+
+        email_token.refresh_from_db()
+        sms_token.refresh_from_db()
+        email_ttl = email_token.expires_at - email_token.timestamp  # type: ignore[operator]
+        sms_ttl = sms_token.expires_at - sms_token.timestamp  # type: ignore[operator]
+        assert abs(email_ttl - timedelta(hours=1)) < timedelta(seconds=1)
+        assert abs(sms_ttl - timedelta(minutes=2)) < timedelta(seconds=1)
+        assert AuthToken.objects.live().count() == 2
+
+    @patch("stagedoor.settings.HASH_TOKENS", True)
+    def test_lookup_by_digest(self):
+        """Test that hashed tokens are stored and found by digest only."""
+        token = generate_token(email="test@example.com")
+
+        assert token is not None
+        stored = AuthToken.objects.get(pk=token.pk)
+        assert stored.token == ""
+        assert stored.token_digest == hash_token(token.login_token)
+        assert AuthToken.lookup(token.login_token) == stored
+        assert AuthToken.lookup("wrong-token") is None
+
+    def test_save_new_token_redraws_on_digest_collision(self):
+        """Test that a colliding digest gets a fresh token string."""
+        email = Email.objects.create(email="test@example.com")
+        existing = AuthToken(email=email)
+        existing.set_token("taken")
+        existing.save()
+
+        token = AuthToken(email=email)
+        token.set_token("taken")
+        save_new_token(token)
+
+        assert token.pk is not None
+        assert token.login_token != "taken"
+        assert AuthToken.lookup(token.login_token) == token
+
+    @patch("stagedoor.settings.HASH_TOKENS", True)
+    @patch("stagedoor.settings.SMS_CODE_REQUIRES_CONTACT", True)
+    def test_same_sms_code_for_different_numbers(self):
+        """Test that codes entered with their number are unique per number only."""
+        with patch("stagedoor.models.generate_token_string", return_value="123456"):
+            first = generate_token(phone_number="+14155551234")
+            second = generate_token(phone_number="+14155556789")
+
+        assert first is not None and second is not None
+        assert first.login_token == second.login_token == "123456"
+        assert first.token_digest == second.token_digest
+        assert AuthToken.lookup("123456", phone_number="+14155556789") == second
+
+        with patch("stagedoor.models.supports_returning", return_value=False):
+            third = AuthToken(
+                phone_number=PhoneNumber.objects.create(phone_number="+14155550100")
+            )
+            third.set_token("123456")
+            save_new_token(third)
+        assert third.login_token == "123456"
+
+    @pytest.mark.parametrize("returning", [True, False])
+    def test_codes_looked_up_alone_are_redrawn(self, returning):
+        """Test that a code entered without its number differs from live ones."""
+        codes = iter(["777777", "777777", "888888"])
+        with (
+            patch("stagedoor.models.supports_returning", return_value=returning),
+            patch(
+                "stagedoor.models.generate_token_string",
+                side_effect=lambda sms=False: next(codes),
+            ),
+        ):
+            first = generate_token(phone_number="+14155551234")
+            second = generate_token(phone_number="+14155556789")
+
+        assert first is not None and second is not None
+        assert first.login_token == "777777"
+        assert second.login_token == "888888"
+        assert AuthToken.lookup("777777") == first
+
+        # Once the first code has expired, it can be issued again.
+        AuthToken.objects.filter(pk=first.pk).update(
+            expires_at=now() - timedelta(seconds=1)
+        )
+        third = AuthToken(
+            phone_number=PhoneNumber.objects.create(phone_number="+14155550100")
+        )
+        third.set_token("777777")
+        save_new_token(third)
+        assert third.login_token == "777777"
+        assert AuthToken.lookup("777777") == third
+
+    def test_save_new_token_gives_up(self):
+        """Test that running out of attempts raises IntegrityError."""
+        email = Email.objects.create(email="test@example.com")
+        existing = AuthToken(email=email)
+        existing.set_token("taken")
+        existing.save()
+
+        token = AuthToken(email=email)
+        token.set_token("taken")
+        with patch("stagedoor.models.generate_token_string", return_value="taken"):
+            with pytest.raises(IntegrityError):
+                save_new_token(token)
+            with patch("stagedoor.models.supports_returning", return_value=False):
+                with pytest.raises(IntegrityError):
+                    save_new_token(token)
+
+    def test_backfill_digests(self):
+        """Test that backfill stores digests and skips ambiguous duplicates."""
+        email = Email.objects.create(email="test@example.com")
+        token = AuthToken.objects.create(email=email, token="old-token")
+        AuthToken.objects.create(email=email, token="dupe")
+        AuthToken.objects.create(email=email, token="dupe")
+
+        with patch("stagedoor.settings.HASH_TOKENS", True):
+            updated = AuthToken.backfill_digests(batch_size=2)
+            assert AuthToken.lookup("old-token") == token
+
+        assert updated == 2
+        token.refresh_from_db()
+        assert token.token == ""
+        assert AuthToken.objects.filter(token="dupe").count() == 1
+
+    def test_consume_returns_and_deletes_token(self):
+        """Test that consume hands a token out exactly once."""
+        email = Email.objects.create(email="test@example.com")
+        token = AuthToken.objects.create(email=email, token="once", next_url="/x")
+
+        with CaptureQueriesContext(connection) as queries:
+            consumed = AuthToken.consume("once")
+
+        # The DELETE ... RETURNING, then the joined fetch of the email
+        assert len(queries) == 2
+        assert consumed is not None
+        assert consumed.pk == token.pk
+        assert consumed.email_id == email.pk  # type: ignore[attr-defined]
+        assert consumed.next_url == "/x"
+        assert consumed.timestamp == token.timestamp
+        assert not AuthToken.objects.filter(pk=token.pk).exists()
+        assert AuthToken.consume("once") is None
+
+    def test_consume_token_with_queued_message(self):
+        """Test that a token with a queued message can be consumed."""
+        email = Email.objects.create(email="test@example.com")
+        token = AuthToken.objects.create(email=email, token="queued")
+        Delivery.objects.create(
+            channel=Delivery.EMAIL,
+            recipient="test@example.com",
+            auth_token=token,
+            domain="example.com",
+            expires_at=token.expires_at,
+        )
+
+        assert AuthToken.consume("queued") == token
+        with patch.object(connection.features, "can_return_columns_from_insert", False):
+            token.pk = None
+            token.save()
+            Delivery.objects.update(auth_token=token)
+            assert AuthToken.consume("queued") == token
+        assert Delivery.objects.count() == 1
+
+    def test_consume_skips_expired_and_other_channel(self):
+        """Test that consume ignores expired tokens and tokens for another channel."""
+        email = Email.objects.create(email="test@example.com")
+        AuthToken.objects.create(email=email, token="email-token")
+        stale = AuthToken.objects.create(email=email, token="stale-token")
+        AuthToken.objects.filter(pk=stale.pk).update(
+            expires_at=now() - timedelta(seconds=3700)
+        )
+
+        assert AuthToken.consume("stale-token") is None
+        assert AuthToken.consume("email-token", channel="sms") is None
+        assert AuthToken.consume("email-token", channel="email") is not None
+
+    def test_consume_select_for_update_fallback(self):
+        """Test the locking fallback used by databases without DELETE RETURNING."""
+        email = Email.objects.create(email="test@example.com")
+        token = AuthToken.objects.create(email=email, token="once")
+
+        with patch.object(connection.features, "can_return_columns_from_insert", False):
+            consumed = AuthToken.consume("once", channel="email")
+            assert AuthToken.consume("once", channel="email") is None
+
+        assert consumed == token
+        assert not AuthToken.objects.filter(pk=token.pk).exists()
+
     def test_auth_token_cascade_delete_email(self):
         """Test that deleting email cascades to auth token."""
         email = Email.objects.create(email="test@example.com")
@@ -392,6 +672,51 @@ class TestGenerateToken:
         assert token is not None
         assert token.email == email
         assert token.email.potential_user == user  # type: ignore
+        assert AuthToken.objects.get() == token
+
+    @patch("stagedoor.settings.REQUIRE_ADMIN_APPROVAL", True)
+    def test_generate_token_potential_user_is_approved(self):
+        """Test that claiming an existing contact needs no approval."""
+        user = User.objects.create_user(username="testuser")  # type: ignore
+        Email.objects.create(email="claimed@example.com")
+
+        token = generate_token(email="claimed@example.com", user=user)
+
+        assert token is not None
+        assert token.approved
+        assert Email.objects.get().potential_user == user
+
+    def test_upsert_contact(self):
+        """Test that upserting a contact returns the same row each time."""
+        user = User.objects.create_user(username="testuser")  # type: ignore
+        first = upsert_contact(PhoneNumber, "phone_number", "+1 415 555 1234")
+        PhoneNumber.objects.filter(pk=first.pk).update(user=user)
+
+        second = upsert_contact(PhoneNumber, "phone_number", "+14155551234")
+
+        assert second.pk == first.pk
+        assert second.user_id == user.pk  # type: ignore[union-attr]
+        assert str(PhoneNumber.objects.get().phone_number) == "+14155551234"
+
+    @patch("stagedoor.models.supports_returning", return_value=False)
+    def test_generate_token_without_returning(self, mock_supports_returning):
+        """Test the get_or_create() and savepoint path for other databases."""
+        email = Email.objects.create(email="test@example.com")
+        taken = AuthToken(email=email)
+        taken.set_token("taken123")
+        taken.save()
+
+        with patch(
+            "stagedoor.models.generate_token_string",
+            side_effect=["fresh123", "taken123", "fresh456"],
+        ):
+            first = generate_token(email="new@example.com")
+            second = generate_token(email="test@example.com")
+
+        assert first is not None and second is not None
+        assert first.login_token == "fresh123"
+        assert second.login_token == "fresh456"
+        assert Email.objects.count() == 2
 
     @patch("stagedoor.models.logger")
     def test_generate_token_logs_error(self, mock_logger):
@@ -0,0 +1,158 @@
+"""
+Query budget tests for the django-stagedoor login path.
+
+These pin the number of queries TokenBackend runs per scenario, as documented
+on TokenBackend. Savepoint statements are counted too, since the tests run
+inside a transaction.
+"""
+
+from typing import TYPE_CHECKING
+from unittest.mock import patch
+
+import pytest
+from django.contrib.auth import get_user_model
+from django.test import RequestFactory
+
+from stagedoor.backends import TokenBackend
+from stagedoor.models import AuthToken, Email, PhoneNumber, generate_token
+
+if TYPE_CHECKING:
+    from django.contrib.auth.models import User as UserType
+
+    User = UserType
+else:
+    User = get_user_model()
+
+
+@pytest.mark.django_db
+@patch("stagedoor.settings.PURGE_ON_LOOKUP", False)
+class TestLoginQueryBudget:
+    """Test the number of queries per login scenario."""
+
+    def setup_method(self):
+        """Set up test fixtures."""
+        self.backend = TokenBackend()
+        self.request = RequestFactory().get("/")
+
+    def authenticate(self, token):
+        return self.backend.authenticate(self.request, token=token)
+
+    def test_unknown_token(self, django_assert_num_queries):
+        """Test that an unknown token costs one query."""
+        with django_assert_num_queries(1):
+            assert self.authenticate("nope") is None
+
+    def test_existing_user(self, django_assert_num_queries):
+        """Test that a returning user costs only the token fetch."""
+        user = User.objects.create_user(username="testuser", email="test@example.com")
+        email = Email.objects.create(email="test@example.com", user=user)
+        AuthToken.objects.create(email=email, token="test-token")
+
+        # token fetch, savepoint, release
+        with django_assert_num_queries(3):
+            assert self.authenticate("test-token") == user
+
+    def test_existing_sms_user(self, django_assert_num_queries):
+        """Test that a returning SMS user costs only the token fetch."""
+        user = User.objects.create_user(username="testuser")
+        phone = PhoneNumber.objects.create(phone_number="+14155551234", user=user)
+        AuthToken.objects.create(phone_number=phone, token="123456")
+
+        with django_assert_num_queries(3):
+            assert self.authenticate("123456") == user
+
+    def test_new_user(self, django_assert_num_queries):
+        """Test the queries for a first login that creates the user."""
+        email = Email.objects.create(email="new@example.com")
+        AuthToken.objects.create(email=email, token="test-token")
+
+        # token fetch, savepoint, user get_or_create (select, savepoint,
+        # insert, release), email update, release
+        with django_assert_num_queries(8):
+            user = self.authenticate("test-token")
+
+        assert user is not None
+        email.refresh_from_db()
+        assert email.user == user
+
+    def test_potential_user(self, django_assert_num_queries):
+        """Test that confirming a potential_user link is one UPDATE."""
+        user = User.objects.create_user(username="testuser", email="old@example.com")
+        email = Email.objects.create(email="new@example.com", potential_user=user)
+        AuthToken.objects.create(email=email, token="test-token")
+
+        self.request.user = user
+        # token fetch, savepoint, user email update, email update, release
+        with django_assert_num_queries(5):
+            assert self.authenticate("test-token") == user
+
+        email.refresh_from_db()
+        assert email.user == user
+        assert email.potential_user is None
+
+    @patch("stagedoor.settings.SINGLE_USE_LINK", True)
+    def test_single_use_existing_user(self, django_assert_num_queries):
+        """Test that a single-use token adds one contact fetch to the delete."""
+        user = User.objects.create_user(username="testuser", email="test@example.com")
+        email = Email.objects.create(email="test@example.com", user=user)
+        AuthToken.objects.create(email=email, token="test-token")
+
+        # delete returning, contact fetch, savepoint, release
+        with django_assert_num_queries(4):
+            assert self.authenticate("test-token") == user
+
+        assert not AuthToken.objects.exists()
+
+
+@pytest.mark.django_db
+class TestGenerateTokenQueryBudget:
+    """Test the number of queries generate_token() runs."""
+
+    def test_new_contact(self, django_assert_num_queries):
+        """Test that a new email costs the upsert, a digest probe and the insert."""
+        with django_assert_num_queries(3):
+            token = generate_token(email="test@example.com")
+
+        assert token is not None
+        assert AuthToken.objects.get().email == Email.objects.get()
+
+    def test_existing_contact(self, django_assert_num_queries):
+        """Test that an existing phone number costs the same three statements."""
+        user = User.objects.create_user(username="testuser")
+        phone = PhoneNumber.objects.create(phone_number="+14155551234", user=user)
+
+        with django_assert_num_queries(3):
+            token = generate_token(phone_number="+14155551234")
+
+        assert token is not None
+        assert token.phone_number.pk == phone.pk  # type: ignore[union-attr]
+        assert token.phone_number.user_id == user.pk  # type: ignore[union-attr]
+        assert PhoneNumber.objects.count() == 1
+
+    @patch("stagedoor.settings.SMS_CODE_REQUIRES_CONTACT", True)
+    def test_code_entered_with_number(self, django_assert_num_queries):
+        """Test that a code looked up with its number needs no digest probe."""
+        with django_assert_num_queries(2):
+            token = generate_token(phone_number="+14155551234")
+
+        assert token is not None
+
+    def test_taken_digest(self, django_assert_num_queries):
+        """Test that a digest collision is retried without a savepoint."""
+        email = Email.objects.create(email="test@example.com")
+        taken = AuthToken(email=email)
+        taken.set_token("taken123")
+        taken.save()
+
+        with patch(
+            "stagedoor.models.generate_token_string",
+            side_effect=["taken123", "fresh123"],
+        ):
+            # The upsert, then a probe that finds the digest taken, and a
+            # probe and insert for the fresh string.
+            with django_assert_num_queries(4):
+                token = generate_token(email="test@example.com")
+
+        assert token is not None
+        assert token.login_token == "fresh123"
+        assert AuthToken.objects.count() == 2
@@ -0,0 +1,246 @@
+"""
+Tests for django-stagedoor rate limits.
+"""
+
+from unittest.mock import patch
+
+from asgiref.sync import async_to_sync
+from django.core.cache import caches
+from django.test import RequestFactory
+
+from stagedoor.ratelimit import (
+    ahit,
+    alogin_allowed,
+    atoken_attempt_allowed,
+    atoken_attempt_failed,
+    atoken_attempt_succeeded,
+    client_ip,
+    hit,
+    login_allowed,
+    normalize_contact,
+    token_attempt_allowed,
+    token_attempt_failed,
+    token_attempt_succeeded,
+)
+
+
+class TestHit:
+    """Test the sliding-window counter."""
+
+    def setup_method(self):
+        """Start every test with an empty cache."""
+        caches["default"].clear()
+
+    def test_no_rate(self):
+        """Test that a missing rate never limits."""
+        assert all(hit("test", "key", None) for _ in range(100))
+
+    def test_limit_within_window(self):
+        """Test that requests over the limit are turned away."""
+        with patch("stagedoor.ratelimit.time.time", return_value=1000.0):
+            assert [hit("test", "key", (3, 60)) for _ in range(5)] == [
+                True,
+                True,
+                True,
+                False,
+                False,
+            ]
+            assert hit("test", "other", (3, 60))
+            assert hit("other", "key", (3, 60))
+
+    def test_previous_window_slides_out(self):
+        """Test that the previous window counts in proportion to its overlap."""
+        with patch("stagedoor.ratelimit.time.time", return_value=1200.0):
+            for _ in range(4):
+                assert hit("test", "key", (4, 60))
+
+        # A quarter into the next window, 3 of the 4 requests still count.
+        with patch("stagedoor.ratelimit.time.time", return_value=1275.0):
+            assert hit("test", "key", (4, 60))
+            assert not hit("test", "key", (4, 60))
+
+        # Three quarters in, only 1 of them does, beside 1 from this window.
+        with patch("stagedoor.ratelimit.time.time", return_value=1305.0):
+            assert hit("test", "key", (4, 60))
+            assert hit("test", "key", (4, 60))
+            assert not hit("test", "key", (4, 60))
+
+    def test_expired_between_add_and_incr(self):
+        """Test that a counter that vanished is started again."""
+        cache = caches["default"]
+        with (
+            patch.object(cache, "add", return_value=False),
+            patch.object(cache, "incr", side_effect=ValueError),
+            patch.object(cache, "set") as mock_set,
+        ):
+            assert hit("test", "key", (3, 60))
+        mock_set.assert_called_once()
+
+    def test_async(self):
+        """Test that ahit() counts against the same windows as hit()."""
+        with patch("stagedoor.ratelimit.time.time", return_value=1000.0):
+            assert hit("test", "key", (3, 60))
+            assert async_to_sync(ahit)("test", "key", (3, 60))
+            assert async_to_sync(ahit)("test", "key", (3, 60))
+            assert not async_to_sync(ahit)("test", "key", (3, 60))
+            assert not hit("test", "key", (3, 60))
+        assert async_to_sync(ahit)("test", "key", None)
+
+    def test_async_expired_between_add_and_incr(self):
+        """Test that ahit() starts a counter that vanished again."""
+        cache = caches["default"]
+        with (
+            patch.object(cache, "aadd", return_value=False),
+            patch.object(cache, "aincr", side_effect=ValueError),
+            patch.object(cache, "aset") as mock_aset,
+        ):
+            assert async_to_sync(ahit)("test", "key", (3, 60))
+        mock_aset.assert_called_once()
+
+    def test_keys_hide_value(self):
+        """Test that the limited value is not stored in the cache key."""
+        with patch.object(caches["default"], "add") as mock_add:
+            hit("test", "someone@example.com", (3, 60))
+        assert "someone@example.com" not in mock_add.call_args[0][0]
+
+
+class TestClientIP:
+    """Test finding the client address."""
+
+    def test_remote_addr(self):
+        """Test that REMOTE_ADDR is used by default."""
+        request = RequestFactory().get("/", REMOTE_ADDR="10.0.0.1")
+        assert client_ip(request) == "10.0.0.1"
+
+    @patch("stagedoor.settings.CLIENT_IP_HEADER", "HTTP_X_FORWARDED_FOR")
+    def test_forwarded_for(self):
+        """Test that the address added by the nearest proxy is used."""
+        request = RequestFactory().get(
+            "/", HTTP_X_FORWARDED_FOR="1.2.3.4, 10.0.0.1, 192.168.0.9"
+        )
+        assert client_ip(request) == "192.168.0.9"
+
+
+@patch("stagedoor.settings.TOKEN_FAILURES_PER_IP", 2)
+@patch("stagedoor.settings.TOKEN_FAILURES_PER_CONTACT", 3)
+class TestTokenLockout:
+    """Test locking out repeated wrong tokens."""
+
+    def setup_method(self):
+        """Start every test with an empty cache."""
+        caches["default"].clear()
+        self.factory = RequestFactory()
+
+    def test_lockout_doubles(self):
+        """Test that each lockout lasts twice as long as the one before."""
+        request = self.factory.post("/")
+        cache = caches["default"]
+        with patch.object(cache, "set", wraps=cache.set) as mock_set:
+            for _ in range(6):
+                token_attempt_failed(request)
+
+        assert [call.kwargs["timeout"] for call in mock_set.call_args_list] == [
+            60,
+            120,
+            240,
+        ]
+        assert not token_attempt_allowed(request)
+
+    @patch("stagedoor.settings.TOKEN_LOCKOUT_MAX", 90)
+    def test_lockout_capped(self):
+        """Test that lockouts are capped at STAGEDOOR_TOKEN_LOCKOUT_MAX."""
+        request = self.factory.post("/")
+        cache = caches["default"]
+        with patch.object(cache, "set", wraps=cache.set) as mock_set:
+            for _ in range(4):
+                token_attempt_failed(request)
+
+        assert [call.kwargs["timeout"] for call in mock_set.call_args_list] == [
+            60,
+            90,
+        ]
+
+    def test_contact_lockout(self):
+        """Test that a contact is locked out across client addresses."""
+        for i in range(3):
+            request = self.factory.post("/", REMOTE_ADDR=f"10.0.0.{i}")
+            assert token_attempt_allowed(request, "+1 415 555 1234")
+            token_attempt_failed(request, "+1 415 555 1234")
+
+        request = self.factory.post("/", REMOTE_ADDR="10.0.0.9")
+        assert not token_attempt_allowed(request, "+14155551234")
+        assert token_attempt_allowed(request, "+14155550000")
+        assert token_attempt_allowed(request)
+
+    def test_contact_spellings(self):
+        """Test that every spelling of a number counts against one lockout."""
+        request = self.factory.post("/", REMOTE_ADDR="10.0.0.1")
+        for spelling in ("+1 (415) 555-0100", "+14155550100", "+1-415-555-0100"):
+            token_attempt_failed(request, spelling)
+
+        request = self.factory.post("/", REMOTE_ADDR="10.0.0.9")
+        assert not token_attempt_allowed(request, "+1 415 555 0100")
+
+    def test_success_clears_contact(self):
+        """Test that logging in forgets the contact's failures but not the IP's."""
+        request = self.factory.post("/")
+        token_attempt_failed(request, "+14155551234")
+        token_attempt_succeeded(request, "+14155551234")
+        token_attempt_failed(request, "+14155551234")
+
+        assert not token_attempt_allowed(request)
+        assert token_attempt_allowed(self.factory.post("/", REMOTE_ADDR="10.0.0.2"))
+        assert token_attempt_allowed(
+            self.factory.post("/", REMOTE_ADDR="10.0.0.2"), "+14155551234"
+        )
+
+    @patch("stagedoor.settings.LOGIN_RATE_PER_IP", (2, 60))
+    def test_async(self):
+        """Test that the async checks share their counts with the sync ones."""
+        request = self.factory.post("/")
+        assert async_to_sync(alogin_allowed)(request, "test@example.com")
+        assert login_allowed(request, "test@example.com")
+        assert not async_to_sync(alogin_allowed)(request, "test@example.com")
+
+        async_to_sync(atoken_attempt_failed)(request, "+14155551234")
+        async_to_sync(atoken_attempt_succeeded)(request, "+14155551234")
+        for _ in range(2):
+            async_to_sync(atoken_attempt_failed)(request, "+14155551234")
+        assert not token_attempt_allowed(request)
+        assert not async_to_sync(atoken_attempt_allowed)(request)
+        other = self.factory.post("/", REMOTE_ADDR="10.0.0.2")
+        assert async_to_sync(atoken_attempt_allowed)(other, "+14155551234")
+
+        async_to_sync(atoken_attempt_failed)(other, "+14155551234")
+        assert not async_to_sync(atoken_attempt_allowed)(other, "+14155551234")
+
+    def test_counter_expired(self):
+        """Test that a failure counter that vanished is started again."""
+        cache = caches["default"]
+        with (
+            patch.object(cache, "add", return_value=False),
+            patch.object(cache, "incr", side_effect=ValueError),
+            patch.object(cache, "aadd", return_value=False),
+            patch.object(cache, "aincr", side_effect=ValueError),
+        ):
+            token_attempt_failed(self.factory.post("/"))
+            async_to_sync(atoken_attempt_failed)(self.factory.post("/"))
+        assert token_attempt_allowed(self.factory.post("/"))
+
+
+@patch("stagedoor.settings.TOKEN_FAILURES_PER_IP", None)
+def test_token_lockout_disabled():
+    """Test that nothing is counted without limits."""
+    request = RequestFactory().post("/")
+    with patch.object(caches["default"], "get_many") as mock_get_many:
+        for _ in range(10):
+            token_attempt_failed(request, "+14155551234")
+        assert token_attempt_allowed(request, "+14155551234")
+    mock_get_many.assert_not_called()
+
+
+def test_normalize_contact():
+    """Test that contacts are keyed by one spelling each."""
+    assert normalize_contact(" Test@Example.COM ") == "test@example.com"
+    assert normalize_contact("+1 (415) 555-0100") == "+14155550100"
+    assert normalize_contact("not a number") == "notanumber"
@@ -0,0 +1,263 @@
+"""
+Tests for django-stagedoor signals.
+"""
+
+from contextlib import contextmanager
+from datetime import timedelta
+from smtplib import SMTPException
+from typing import TYPE_CHECKING
+from unittest.mock import patch
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.contrib.auth import authenticate, get_user_model
+from django.core.mail.backends import locmem
+from django.test import RequestFactory
+from django.utils.timezone import now
+
+from stagedoor import signals
+from stagedoor.backends import SMSTokenBackend, TokenBackend
+from stagedoor.helpers import approve_and_send, email_login_link, sms_login_link
+from stagedoor.models import AuthToken, Email, generate_token
+
+if TYPE_CHECKING:
+    from django.contrib.auth.models import User
+else:
+    User = get_user_model()
+
+
+@contextmanager
+def received(signal):
+    """Collect the keyword arguments of every send of signal."""
+    calls = []
+
+    def receiver(sender, **kwargs):
+        calls.append({"sender": sender, **kwargs})
+
+    signal.connect(receiver, weak=False)
+    try:
+        yield calls
+    finally:
+        signal.disconnect(receiver)
+
+
+@pytest.mark.django_db
+@patch("stagedoor.settings.PURGE_ON_LOOKUP", False)
+class TestSignals:
+    """Test the signals sent through a token's life."""
+
+    def setup_method(self):
+        """Set up test fixtures."""
+        self.request = RequestFactory().get("/")
+
+    def test_token_issued(self):
+        """Test that each new token is announced with its channel and timing."""
+        with received(signals.token_issued) as calls:
+            token = generate_token(phone_number="+14155551234")
+
+        assert len(calls) == 1
+        assert calls[0]["sender"] is AuthToken
+        assert calls[0]["token"] is token
+        assert calls[0]["channel"] == "sms"
+        assert calls[0]["elapsed"] >= 0
+
+    @patch("stagedoor.settings.SMS_TRANSPORT", "stagedoor.sms.LocmemTransport")
+    def test_delivery(self):
+        """Test that sent and failed login messages are announced."""
+        email_token = generate_token(email="test@example.com")
+        sms_token = generate_token(phone_number="+14155551234")
+
+        with (
+            received(signals.token_delivered) as delivered,
+            received(signals.token_delivery_failed) as failed,
+        ):
+            email_login_link(self.request, email_token)  # type: ignore[arg-type]
+            error = OSError("no route")
+            with patch("stagedoor.sms.LocmemTransport.send", side_effect=error):
+                with pytest.raises(OSError):
+                    sms_login_link(self.request, sms_token)  # type: ignore[arg-type]
+
+        assert [(call["token"], call["channel"]) for call in delivered] == [
+            (email_token, "email")
+        ]
+        assert [(call["token"], call["error"]) for call in failed] == [
+            (sms_token, error)
+        ]
+        assert failed[0]["elapsed"] >= 0
+
+    def test_batched_delivery(self):
+        """Test that approving in chunks announces every token of each chunk."""
+        tokens = []
+        for i in range(3):
+            email = Email.objects.create(email=f"user{i}@example.com")
+            tokens.append(AuthToken.objects.create(email=email, token=f"token{i}"))
+        error = SMTPException("Server down")
+        original = locmem.EmailBackend.send_messages
+        failures = iter([None, error])
+
+        def send_messages(backend, messages):
+            failure = next(failures)
+            if failure is not None:
+                raise failure
+            return original(backend, messages)
+
+        with (
+            patch("stagedoor.settings.EMAIL_BATCH_SIZE", 2),
+            patch.object(locmem.EmailBackend, "send_messages", send_messages),
+            received(signals.token_delivered) as delivered,
+            received(signals.token_delivery_failed) as failed,
+        ):
+            approve_and_send(self.request, tokens)
+
+        assert [call["token"] for call in delivered] == tokens[:2]
+        assert [(call["token"], call["error"]) for call in failed] == [
+            (tokens[2], error)
+        ]
+
+    def test_consumed_and_user_created(self):
+        """Test that a login announces the token used and the new user."""
+        token = generate_token(email="test@example.com")
+        assert token is not None
+
+        with (
+            received(signals.token_consumed) as consumed,
+            received(signals.user_created_via_stagedoor) as created,
+        ):
+            user = TokenBackend().authenticate(self.request, token=token.login_token)
+
+        assert user is not None
+        assert len(consumed) == 1
+        assert consumed[0]["user"] == user
+        assert consumed[0]["token"].pk == token.pk
+        assert consumed[0]["channel"] == "email"
+        assert len(created) == 1
+        assert created[0]["sender"] is User
+        assert created[0]["user"] == user
+        assert created[0]["elapsed"] >= 0
+
+        with received(signals.user_created_via_stagedoor) as created:
+            TokenBackend().authenticate(self.request, token=token.login_token)
+        assert created == []
+
+    def test_rejection_reasons(self):
+        """Test that tokens found but refused are told apart from the rest."""
+        live = generate_token(email="live@example.com")
+        expired = generate_token(email="expired@example.com")
+        assert live is not None and expired is not None
+        AuthToken.objects.filter(pk=expired.pk).update(
+            expires_at=now() - timedelta(seconds=1)
+        )
+        pending = AuthToken.objects.create(
+            email=Email.objects.create(email="pending@example.com"),
+            token="pending",
+            approved=False,
+        )
+        owner = User.objects.create_user(username="owner")
+        taken = generate_token(email="taken@example.com")
+        assert taken is not None
+        Email.objects.filter(email="taken@example.com").update(potential_user=owner)
+        User.objects.create_user(username="other", email="taken@example.com")
+
+        with received(signals.token_rejected) as rejected:
+            for backend, token in [
+                (TokenBackend(), "missing"),
+                (TokenBackend(), expired.login_token),
+                (TokenBackend(), pending.token),
+                (SMSTokenBackend(), live.login_token),
+            ]:
+                assert backend.authenticate(self.request, token=token) is None
+            with patch(
+                "stagedoor.backends.TokenBackend._contact_user",
+                return_value=User.objects.get(username="other"),
+            ):
+                assert (
+                    TokenBackend().authenticate(self.request, token=taken.login_token)
+                    is None
+                )
+
+        assert [(call["channel"], call["reason"]) for call in rejected] == [
+            ("any", signals.REJECTED_UNKNOWN),
+            ("any", signals.REJECTED_EXPIRED),
+            ("any", signals.REJECTED_UNAPPROVED),
+            ("sms", signals.REJECTED_UNKNOWN),
+            ("any", signals.REJECTED_MISMATCH),
+        ]
+
+    @patch("stagedoor.settings.SINGLE_USE_LINK", True)
+    def test_single_use_rejections_are_unknown(self):
+        """Test that a token that can't be consumed is reported unknown."""
+        token = generate_token(email="test@example.com")
+        assert token is not None
+        AuthToken.objects.update(expires_at=now() - timedelta(seconds=1))
+
+        with received(signals.token_rejected) as rejected:
+            assert (
+                TokenBackend().authenticate(self.request, token=token.login_token)
+                is None
+            )
+
+        assert [call["reason"] for call in rejected] == [signals.REJECTED_UNKNOWN]
+
+    def test_backend_pair(self):
+        """Test that the email and SMS backend pair rejects a login only once."""
+        token = generate_token(phone_number="+14155551234")
+        assert token is not None
+
+        expired = generate_token(email="test@example.com")
+        assert expired is not None
+        AuthToken.objects.filter(pk=expired.pk).update(
+            expires_at=now() - timedelta(seconds=1)
+        )
+
+        with received(signals.token_rejected) as rejected:
+            assert authenticate(self.request, token=token.login_token)
+            assert authenticate(self.request, token="missing") is None
+            assert authenticate(self.request, token=expired.login_token) is None
+
+        assert [(call["channel"], call["reason"]) for call in rejected] == [
+            ("sms", signals.REJECTED_UNKNOWN),
+            ("email", signals.REJECTED_EXPIRED),
+        ]
+
+    def test_async_rejection(self):
+        """Test that async logins are announced the same way."""
+        token = generate_token(email="test@example.com")
+        assert token is not None
+        authenticate = async_to_sync(TokenBackend().aauthenticate)
+
+        with (
+            received(signals.token_consumed) as consumed,
+            received(signals.token_rejected) as rejected,
+        ):
+            assert authenticate(self.request, token=token.login_token)
+            assert authenticate(self.request, token="missing") is None
+
+        assert len(consumed) == 1
+        assert [call["reason"] for call in rejected] == [signals.REJECTED_UNKNOWN]
+
+    @patch("stagedoor.settings.METRICS_SINK", "stagedoor.metrics.RegistrySink")
+    @pytest.mark.parametrize(
+        "expires_in,approved,reason",
+        [
+            (None, False, signals.REJECTED_UNAPPROVED),
+            (-1, True, signals.REJECTED_EXPIRED),
+        ],
+    )
+    def test_rejection_costs_no_queries(
+        self, django_assert_num_queries, expires_in, approved, reason
+    ):
+        """Test that rejecting a token costs nothing beyond its lookup."""
+        email = Email.objects.create(email="test@example.com")
+        AuthToken.objects.create(email=email, token="found", approved=approved)
+        if expires_in is not None:
+            AuthToken.objects.update(expires_at=now() + timedelta(seconds=expires_in))
+
+        with received(signals.token_rejected) as rejected:
+            with django_assert_num_queries(1):
+                TokenBackend().authenticate(self.request, token="missing")
+            with django_assert_num_queries(1):
+                TokenBackend().authenticate(self.request, token="found")
+        assert [call["reason"] for call in rejected] == [
+            signals.REJECTED_UNKNOWN,
+            reason,
+        ]
@@ -0,0 +1,150 @@
+"""
+Tests for django-stagedoor SMS transports.
+"""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.test import RequestFactory, override_settings
+
+from stagedoor import sms
+from stagedoor.helpers import sms_login_link
+from stagedoor.models import AuthToken, PhoneNumber
+from stagedoor.sms import (
+    ConsoleTransport,
+    HTTPTransport,
+    LocmemTransport,
+    SMSError,
+    TwilioTransport,
+    get_sms_transport,
+)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    received: list[tuple[str, dict]] = []
+    ports: set[int] = set()
+    status = 204
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        StubHandler.received.append((self.path, json.loads(self.rfile.read(length))))
+        StubHandler.ports.add(self.client_address[1])
+        self.send_response(StubHandler.status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def sms_stub():
+    StubHandler.received = []
+    StubHandler.ports = set()
+    StubHandler.status = 204
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/sms?key=1"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.django_db
+@patch("stagedoor.settings.SMS_TRANSPORT", "stagedoor.sms.LocmemTransport")
+def test_sms_login_link_uses_configured_transport():
+    """Test that sms_login_link hands the message to the transport."""
+    sms.outbox.clear()
+    phone = PhoneNumber.objects.create(phone_number="+14155551234")
+    token = AuthToken.objects.create(phone_number=phone, token="123456")
+
+    sms_login_link(RequestFactory().get("/"), token)
+
+    assert sms.outbox[0]["to"] == "+14155551234"
+    assert "code is 123456" in sms.outbox[0]["body"]
+    assert "https://example.com/auth/token" in sms.outbox[0]["body"]
+
+
+def test_transport_is_shared():
+    """Test that a transport is created once per process."""
+    with patch("stagedoor.settings.SMS_TRANSPORT", "stagedoor.sms.LocmemTransport"):
+        transport = get_sms_transport()
+        assert isinstance(transport, LocmemTransport)
+        assert get_sms_transport() is transport
+
+
+class TestTwilioTransport:
+    """Test the Twilio transport."""
+
+    def test_not_configured_does_nothing(self):
+        """Test that missing Twilio settings skip sending."""
+        transport = TwilioTransport()
+        with patch.object(transport, "get_client") as mock_get_client:
+            transport.send("+14155551234", "hello")
+        mock_get_client.assert_not_called()
+
+    @override_settings(
+        TWILIO_ACCOUNT_SID="sid", TWILIO_AUTH_TOKEN="secret", TWILIO_NUMBER="+1555"
+    )
+    def test_client_is_reused(self):
+        """Test that one client is built and reused for every message."""
+        transport = TwilioTransport()
+        with patch("twilio.rest.Client") as mock_client:
+            transport.send("+14155551234", "one")
+            transport.send("+14155551234", "two")
+
+        mock_client.assert_called_once()
+        assert mock_client.call_args[0] == ("sid", "secret")
+        messages = mock_client.return_value.messages
+        assert messages.create.call_count == 2
+        messages.create.assert_called_with(body="two", from_="+1555", to="+14155551234")
+
+
+class TestHTTPTransport:
+    """Test the HTTP transport against a local stub server."""
+
+    def test_posts_json_over_one_connection(self, sms_stub):
+        """Test that messages are posted as JSON over a kept-alive connection."""
+        transport = HTTPTransport()
+        with patch("stagedoor.settings.SMS_HTTP_URL", sms_stub):
+            transport.send("+14155551234", "one")
+            transport.send("+14155551234", "two")
+
+        assert StubHandler.received == [
+            ("/sms?key=1", {"to": "+14155551234", "body": "one"}),
+            ("/sms?key=1", {"to": "+14155551234", "body": "two"}),
+        ]
+        assert len(StubHandler.ports) == 1
+
+    def test_error_status(self, sms_stub):
+        """Test that an error response raises SMSError."""
+        StubHandler.status = 500
+        transport = HTTPTransport()
+        with patch("stagedoor.settings.SMS_HTTP_URL", sms_stub):
+            with pytest.raises(SMSError):
+                transport.send("+14155551234", "one")
+
+    def test_unreachable(self):
+        """Test that a connection failure is raised after one retry."""
+        transport = HTTPTransport()
+        with patch("stagedoor.settings.SMS_HTTP_URL", "http://127.0.0.1:9/sms"):
+            with pytest.raises(OSError):
+                transport.send("+14155551234", "one")
+
+
+def test_console_transport(capsys):
+    """Test that the console transport prints the message."""
+    ConsoleTransport().send("+14155551234", "hello")
+    assert "SMS to +14155551234:\nhello" in capsys.readouterr().out
+
+
+def test_asend_runs_send():
+    """Test that the default asend() hands the message to send()."""
+    sms.outbox.clear()
+    async_to_sync(LocmemTransport().asend)("+14155551234", "hello")
+    assert sms.outbox == [{"to": "+14155551234", "body": "hello"}]
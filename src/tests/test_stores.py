@@ -0,0 +1,230 @@
+"""
+Tests for django-stagedoor token stores.
+"""
+
+from datetime import timedelta
+from typing import TYPE_CHECKING
+from unittest.mock import patch
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import IntegrityError
+from django.test import RequestFactory
+from django.utils.timezone import now
+
+from stagedoor.backends import TokenBackend
+from stagedoor.models import AuthToken, Email, PhoneNumber, generate_token
+from stagedoor.stores import (
+    CacheTokenStore,
+    DatabaseTokenStore,
+    get_token_store,
+)
+
+if TYPE_CHECKING:
+    from django.contrib.auth.models import User
+else:
+    User = get_user_model()
+
+CACHE_STORE = "stagedoor.stores.CacheTokenStore"
+
+
+def test_get_token_store_is_shared():
+    """Test that the configured store is created once."""
+    assert isinstance(get_token_store(), DatabaseTokenStore)
+    with patch("stagedoor.settings.TOKEN_STORE", CACHE_STORE):
+        store = get_token_store()
+        assert isinstance(store, CacheTokenStore)
+        assert get_token_store() is store
+
+
+@pytest.mark.django_db
+class TestDatabaseTokenStore:
+    """Test the store that keeps tokens as rows."""
+
+    def setup_method(self):
+        """Set up test fixtures."""
+        self.store = DatabaseTokenStore()
+
+    def test_save_and_lookup(self):
+        """Test that a saved token is found, and consumed once."""
+        email = Email.objects.create(email="test@example.com")
+        token = AuthToken(email=email)
+        token.set_token("abcdefgh")
+        self.store.save(token)
+
+        assert token.pk is not None
+        assert self.store.lookup("abcdefgh") == token
+        assert self.store.consume("abcdefgh", channel="email") == token
+        assert self.store.consume("abcdefgh") is None
+
+    @patch("stagedoor.settings.HASH_TOKENS", True)
+    def test_approve_reissues_hashed_tokens(self):
+        """Test that approval stores fresh strings for digest-only tokens."""
+        email = Email.objects.create(email="test@example.com")
+        token = AuthToken(email=email, approved=False)
+        token.set_token("abcdefgh")
+        token.save()
+        AuthToken.objects.update(expires_at=now() - timedelta(days=1))
+        token = AuthToken.objects.get()
+
+        self.store.approve([token])
+
+        assert token.approved
+        assert token.login_token and token.login_token != "abcdefgh"
+        stored = AuthToken.objects.get()
+        assert stored.approved
+        assert stored.token_digest == token.token_digest
+        assert stored in AuthToken.objects.live()
+
+    @patch("stagedoor.settings.SMS_TOKEN_DURATION", 120)
+    def test_approve_sets_expiry_by_channel(self):
+        """Test that approved tokens expire after their channel's duration."""
+        email = Email.objects.create(email="test@example.com")
+        phone_number = PhoneNumber.objects.create(phone_number="+14155552671")
+        AuthToken.objects.create(email=email, token="email", approved=False)
+        AuthToken.objects.create(phone_number=phone_number, token="sms", approved=False)
+
+        self.store.approve(list(AuthToken.objects.all()))
+
+        for token in AuthToken.objects.all():
+            ttl = 120 if token.phone_number_id else 30 * 60  # type: ignore[attr-defined]
+            assert token.expires_at == token.timestamp + timedelta(seconds=ttl)  # type: ignore[operator]
+
+    def test_purge(self):
+        """Test that purging deletes stale rows."""
+        email = Email.objects.create(email="test@example.com")
+        AuthToken.objects.create(email=email, token="old")
+        AuthToken.objects.update(expires_at=now() - timedelta(days=1))
+
+        assert self.store.purge() == 1
+        assert async_to_sync(self.store.apurge)() == 0
+
+
+@pytest.mark.django_db
+class TestCacheTokenStore:
+    """Test the store that keeps approved tokens in the cache."""
+
+    def setup_method(self):
+        """Set up test fixtures."""
+        self.store = CacheTokenStore()
+        caches["default"].clear()
+
+    def test_generate_token_writes_no_row(self):
+        """Test that new tokens go to the cache, not the table."""
+        with patch("stagedoor.settings.TOKEN_STORE", CACHE_STORE):
+            token = generate_token(email="test@example.com", next_url="/next")
+        assert token is not None
+
+        assert not AuthToken.objects.exists()
+        found = self.store.lookup(token.login_token, channel="email")
+        assert found is not None
+        assert found.pk is None
+        assert found.email.email == "test@example.com"  # type: ignore[union-attr]
+        assert found.next_url == "/next"
+        assert found.login_token == token.login_token
+
+    def test_lookup_respects_channel_and_number(self):
+        """Test that lookups match the way AuthToken.token_filter() does."""
+        phone_number = PhoneNumber.objects.create(phone_number="+14155552671")
+        token = AuthToken(phone_number=phone_number)
+        token.set_token("123456")
+        self.store.save(token)
+
+        assert self.store.lookup("123456", channel="email") is None
+        assert self.store.lookup("123456", phone_number="+14155550000") is None
+        assert self.store.lookup("654321") is None
+        found = self.store.lookup("123456", phone_number="+14155552671")
+        assert found is not None
+        assert found.phone_number == phone_number
+        assert self.store.lookup("123456", channel="sms") is not None
+
+    def test_consume_once(self):
+        """Test that a token can only be consumed once."""
+        email = Email.objects.create(email="test@example.com")
+        token = AuthToken(email=email)
+        token.set_token("abcdefgh")
+        self.store.save(token)
+
+        assert self.store.consume("abcdefgh", channel="sms") is None
+        assert self.store.consume("abcdefgh") is not None
+        assert self.store.consume("abcdefgh") is None
+        assert self.store.lookup("abcdefgh") is None
+
+    def test_expires_with_the_token(self):
+        """Test that keys expire when the token would go stale."""
+        email = Email.objects.create(email="test@example.com")
+        token = AuthToken(email=email, timestamp=now() - timedelta(seconds=100))
+        token.set_token("abcdefgh")
+
+        with patch.object(self.store.cache, "add", return_value=True) as mock_add:
+            self.store.save(token)
+        assert 1690 <= mock_add.call_args.kwargs["timeout"] <= 1700
+
+        expired = AuthToken(email=email, timestamp=now() - timedelta(hours=1))
+        expired.set_token("hgfedcba")
+        self.store.save(expired)
+        assert self.store.lookup("hgfedcba") is None
+
+    def test_save_redraws_taken_strings(self):
+        """Test that a token whose string is in use gets a new one."""
+        email = Email.objects.create(email="test@example.com")
+        first = AuthToken(email=email)
+        first.set_token("abcdefgh")
+        self.store.save(first)
+        second = AuthToken(email=email)
+        second.set_token("abcdefgh")
+        self.store.save(second)
+
+        assert second.login_token != "abcdefgh"
+        assert self.store.lookup(second.login_token) is not None
+
+        with patch.object(self.store.cache, "add", return_value=False):
+            with pytest.raises(IntegrityError):
+                self.store.save(second)
+
+    def test_pending_tokens_are_rows_until_approved(self):
+        """Test that approval moves waiting tokens into the cache."""
+        email = Email.objects.create(email="test@example.com")
+        token = AuthToken(email=email, approved=False)
+        token.set_token("abcdefgh")
+        self.store.save(token)
+        assert AuthToken.objects.filter(approved=False).count() == 1
+        assert self.store.lookup("abcdefgh") is None
+
+        self.store.approve(list(AuthToken.objects.select_related("email")))
+
+        assert not AuthToken.objects.exists()
+        assert self.store.lookup("abcdefgh") is not None
+        assert self.store.purge() == 0
+
+    def test_login_through_backend(self):
+        """Test a single-use login with the cache store configured."""
+        request = RequestFactory().get("/")
+        with (
+            patch("stagedoor.settings.TOKEN_STORE", CACHE_STORE),
+            patch("stagedoor.settings.SINGLE_USE_LINK", True),
+        ):
+            token = generate_token(email="test@example.com")
+            assert token is not None
+            user = TokenBackend().authenticate(request, token=token.login_token)
+            assert user is not None
+            assert Email.objects.get().user == user
+            assert TokenBackend().authenticate(request, token=token.login_token) is None
+
+    def test_async_lookup_and_consume(self):
+        """Test the async versions against the same cache entries."""
+        user = User.objects.create_user(username="testuser")
+        email = Email.objects.create(email="test@example.com", user=user)
+        token = AuthToken(email=email)
+        token.set_token("abcdefgh")
+        self.store.save(token)
+
+        found = async_to_sync(self.store.alookup)("abcdefgh", channel="email")
+        assert found is not None
+        assert found.email.user == user  # type: ignore[union-attr]
+        assert async_to_sync(self.store.alookup)("abcdefgh", channel="sms") is None
+        assert async_to_sync(self.store.aconsume)("abcdefgh") is not None
+        assert async_to_sync(self.store.aconsume)("abcdefgh") is None
+        assert async_to_sync(self.store.apurge)() == 0
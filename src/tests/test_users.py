@@ -0,0 +1,39 @@
+"""
+Tests for django-stagedoor user model introspection.
+"""
+
+from django.contrib.auth import get_user_model
+from django.core.signals import setting_changed
+
+from stagedoor.users import user_model_fields
+
+
+class TestUserModelFields:
+    """Test the cached user model description."""
+
+    def test_describes_default_user_model(self):
+        """Test the description of django.contrib.auth's User."""
+        fields = user_model_fields()
+
+        assert fields.model is get_user_model()
+        assert fields.has_username
+        assert fields.has_email
+        assert not fields.has_phone_number
+
+    def test_description_is_cached(self):
+        """Test that the description is computed once."""
+        assert user_model_fields() is user_model_fields()
+
+    def test_cleared_when_user_model_changes(self):
+        """Test that changing AUTH_USER_MODEL drops the cached description."""
+        before = user_model_fields()
+
+        setting_changed.send(sender=None, setting="SITE_ID", value=2, enter=True)
+        assert user_model_fields() is before
+
+        setting_changed.send(
+            sender=None, setting="AUTH_USER_MODEL", value="auth.User", enter=True
+        )
+        after = user_model_fields()
+        assert after is not before
+        assert after == before
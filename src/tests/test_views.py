@@ -7,12 +7,19 @@ from django.contrib.auth.models import AnonymousUser
 from django.contrib.messages import get_messages
 from django.contrib.messages.middleware import MessageMiddleware
 from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.cache import caches
 from django.http import HttpResponse
 from django.test import Client, RequestFactory, TestCase
 from django.urls import reverse
 
 from stagedoor import settings as stagedoor_settings
-from stagedoor.models import AuthToken, Email, PhoneNumber, generate_token_string
+from stagedoor.models import (
+    AuthToken,
+    Delivery,
+    Email,
+    PhoneNumber,
+    generate_token_string,
+)
 from stagedoor.views import (
     LoginForm,
     login_post,
@@ -183,6 +190,31 @@ class LoginPostTests(TestCase):
             ).first()
         )
 
+    @patch("stagedoor.settings.ASYNC_DELIVERY", True)
+    def test_async_delivery_queues_message(self):
+        factory = RequestFactory()
+        request = factory.post("/", {"email": TEST_EMAIL})
+        self.setup_request(request)
+        with patch("stagedoor.views.email_login_link") as mock_email:
+            response = login_post(request)
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(reverse("stagedoor:token-post"), response.url)  # type: ignore
+        mock_email.assert_not_called()
+        token = AuthToken.objects.get(email__email=TEST_EMAIL)
+        delivery = Delivery.objects.get()
+        self.assertEqual(TEST_EMAIL, delivery.recipient)
+        self.assertEqual(token, delivery.auth_token)
+
+    @patch("stagedoor.settings.ASYNC_DELIVERY", True)
+    def test_async_delivery_queues_sms(self):
+        factory = RequestFactory()
+        request = factory.post("/", {"phone_number": TEST_PHONE_NUMBER})
+        self.setup_request(request)
+        with patch("stagedoor.views.sms_login_link") as mock_sms:
+            login_post(request)
+        mock_sms.assert_not_called()
+        self.assertEqual(TEST_PHONE_NUMBER, Delivery.objects.get().recipient)
+
     def test_admin_approval(self):
         factory = RequestFactory()
         with patch("stagedoor.settings.REQUIRE_ADMIN_APPROVAL", True):
@@ -526,6 +558,51 @@ class LoginPostTests(TestCase):
             self.assertEqual(302, response.status_code)
             self.assertEqual(stagedoor_settings.LOGIN_URL, response.url)  # type: ignore
 
+    @patch("stagedoor.settings.LOGIN_RATE_PER_CONTACT", (2, 60))
+    def test_rate_limited_contact(self):
+        caches["default"].clear()
+        factory = RequestFactory()
+        for _ in range(2):
+            request = factory.post("/", {"email": TEST_EMAIL})
+            self.setup_request(request)
+            login_post(request)
+
+        request = factory.post("/", {"email": TEST_EMAIL.upper()})
+        self.setup_request(request)
+        with self.assertNumQueries(0):
+            response = login_post(request)
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(stagedoor_settings.LOGIN_URL, response.url)  # type: ignore
+        self.assertIn("Too many login attempts", str(list(get_messages(request))[0]))
+        self.assertEqual(2, AuthToken.objects.count())
+
+        # Other contacts are unaffected.
+        request = factory.post("/", {"phone_number": TEST_PHONE_NUMBER})
+        self.setup_request(request)
+        response = login_post(request)
+        self.assertEqual(reverse("stagedoor:token-post"), response.url)  # type: ignore
+
+    @patch("stagedoor.settings.LOGIN_RATE_PER_IP", (1, 60))
+    def test_rate_limited_ip(self):
+        caches["default"].clear()
+        factory = RequestFactory()
+        request = factory.post("/", {"email": TEST_EMAIL})
+        self.setup_request(request)
+        login_post(request)
+
+        request = factory.post("/", {"email": "other@example.com"})
+        self.setup_request(request)
+        response = login_post(request)
+        self.assertEqual(stagedoor_settings.LOGIN_URL, response.url)  # type: ignore
+        self.assertEqual(1, AuthToken.objects.count())
+
+        request = factory.post(
+            "/", {"email": "other@example.com"}, REMOTE_ADDR="10.0.0.2"
+        )
+        self.setup_request(request)
+        response = login_post(request)
+        self.assertEqual(reverse("stagedoor:token-post"), response.url)  # type: ignore
+
 
 class TokenPostTests(TestCase):
     def setup_request(self, request):
@@ -611,6 +688,47 @@ class TokenPostTests(TestCase):
         self.assertEqual("/othernext", response.url)  # type: ignore
         self.assertEqual(num_users + 1, len(get_user_model().objects.all()))
 
+    @patch("stagedoor.settings.SMS_CODE_REQUIRES_CONTACT", True)
+    def test_sms_code_with_phone_number(self):
+        phone_number = PhoneNumber.objects.create(phone_number=TEST_PHONE_NUMBER)
+        other_phone_number = PhoneNumber.objects.create(phone_number="+14155551234")
+        AuthToken.objects.create(phone_number=other_phone_number, token="123456")
+        AuthToken.objects.create(phone_number=phone_number, token="123456")
+        factory = RequestFactory()
+        request = factory.post(
+            "/", {"token": "123456", "phone_number": TEST_PHONE_NUMBER}
+        )
+        self.setup_request(request)
+        response = token_post(request)
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(stagedoor_settings.LOGIN_REDIRECT, response.url)  # type: ignore
+        phone_number.refresh_from_db()
+        other_phone_number.refresh_from_db()
+        self.assertIsNotNone(phone_number.user)
+        self.assertIsNone(other_phone_number.user)
+
+    @patch("stagedoor.settings.SMS_CODE_REQUIRES_CONTACT", True)
+    def test_sms_code_without_phone_number(self):
+        phone_number = PhoneNumber.objects.create(phone_number=TEST_PHONE_NUMBER)
+        AuthToken.objects.create(phone_number=phone_number, token="123456")
+        factory = RequestFactory()
+        request = factory.post("/", {"token": "123456"})
+        self.setup_request(request)
+        response = token_post(request)
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(stagedoor_settings.LOGIN_URL, response.url)  # type: ignore
+
+    @patch("stagedoor.settings.SMS_CODE_REQUIRES_CONTACT", True)
+    def test_phone_number_remembered_from_login(self):
+        client = Client()
+        client.post(reverse("stagedoor:login"), {"phone_number": TEST_PHONE_NUMBER})
+        response = client.get(reverse("stagedoor:token-post"))
+        self.assertContains(response, f'value="{TEST_PHONE_NUMBER}"')
+
+        token = AuthToken.objects.get(phone_number__phone_number=TEST_PHONE_NUMBER)
+        response = client.post(reverse("stagedoor:token-post"), {"token": token.token})
+        self.assertEqual(stagedoor_settings.LOGIN_REDIRECT, response.url)  # type: ignore
+
 
 @pytest.mark.django_db
 class TestLoginForm:
@@ -1,7 +1,11 @@
 from django.contrib import admin
 from django.urls import include, path
 
+from stagedoor.views import prometheus_metrics
+
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("auth/", include("stagedoor.urls", namespace="stagedoor")),
+    path("api/auth/", include("stagedoor.api_urls", namespace="stagedoor-api")),
+    path("metrics", prometheus_metrics, name="metrics"),
 ]